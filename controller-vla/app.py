@@ -9,7 +9,14 @@ Modified to support:
 import os
 import sys
 import time
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
+
+try:
+    import wire
+except ImportError:
+    # Docker外で直接起動した場合は sim-runner/wire.py を使う（イメージにはビルド時にコピーされる）
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'sim-runner'))
+    import wire
 
 # Debug: Check environment and imports
 print("=" * 60)
@@ -50,7 +57,7 @@ if os.path.exists(utils_dir):
 
 print("\n[DEBUG] Attempting to import VLAController...")
 try:
-    from training.controller import VLAController
+    from vla_bank import VLABank
     print("✓ VLAController imported successfully")
 except ImportError as e:
     print(f"✗ Failed to import VLAController: {e}")
@@ -80,104 +87,23 @@ print(f"Result directory: {os.path.join(OUTPUT_PATH, EXP_ID)}")
 print("=" * 60)
 print()
 
-# Create result directory
-exp_result_dir = os.path.join(OUTPUT_PATH, EXP_ID)
-os.makedirs(exp_result_dir, exist_ok=True)
-
-# Initialize VLA controllers (will be populated when receiving first control request)
-vla_controllers = {}
-current_episode = 0  # グローバルエピソードカウンタ
-
-# Import required modules
-import time
-import redis
-import requests
-from models.sac_agent import SACAgent
-from utils.image_fetcher import ImageFetcher
-from utils.prompt_generator import PromptGenerator
-from utils.reward import RewardCalculator
-from utils.data_logger import DataLogger
+# VLA controllers (populated on init / first control request)
+bank = VLABank(
+    exp_id=EXP_ID,
+    output_path=OUTPUT_PATH,
+    redis_url=REDIS_URL,
+    image_generator_url=IMAGE_GENERATOR_URL,
+    data_collector_url=DATA_COLLECTOR_URL,
+    vla_model=VLA_MODEL,
+    vla_checkpoint=VLA_CHECKPOINT
+)
 
 
-def initialize_controller(loop_id, loop_config):
-    """Initialize VLA controller for a control loop"""
-    
-    # Initialize VLA model
-    if VLA_MODEL == 'simple_dnn':
-        from models.simple_dnn_vla import SimpleDNNVLAWrapper
-        vla_model = SimpleDNNVLAWrapper()
-        print("Initialized SimpleDNN VLA Model")
-    elif VLA_MODEL == 'tiny_vla':
-        from models.tiny_vla import TinyVLAWrapper
-        vla_model = TinyVLAWrapper()
-        print("Initialized TinyVLA Model")
-    elif VLA_MODEL == 'smolvla':
-        from models.smolvla import SmolVLAWrapper
-        vla_model = SmolVLAWrapper()
-        print("Initialized SmolVLA Model")
-    elif VLA_MODEL == 'openvla':
-        from models.openvla import OpenVLAWrapper
-        vla_model = OpenVLAWrapper()
-        print("Initialized OpenVLA Model")
-    elif VLA_MODEL == 'dummy':
-        from models.dummy_agent import DummyVLA
-        vla_model = DummyVLA()
-        print("Initialized Dummy VLA Model")
-    else:
-        raise ValueError(f"Unknown VLA model: {VLA_MODEL}")
-    
-    # Extract VLA parameters
-    vla_params = loop_config.get('vla_params', {})
-    
-    # Initialize SAC agent
-    agent = SACAgent(config=vla_params)
-    print("SAC Agent initialized")
-    
-    # Initialize utilities
-    image_fetcher = ImageFetcher(
-        redis_url=REDIS_URL,
-        image_generator_url=IMAGE_GENERATOR_URL
-    )
-    
-    prompt_generator = PromptGenerator()
-    
-    reward_config = vla_params.get('reward', {})
-    reward_calculator = RewardCalculator(
-        tracking_weight=reward_config.get('tracking_weight', 1.0),
-        stability_weight=reward_config.get('stability_weight', 0.5),
-        safety_weight=reward_config.get('safety_weight', 10.0),
-        safety_bounds=reward_config.get('safety_bounds', {}),
-        normalize=reward_config.get('normalize', True),
-        clip_range=reward_config.get('clip_range', [-10, 10])
-    )
-    
-    data_logger = DataLogger(DATA_COLLECTOR_URL)
-    print(f"DataLogger initialized: {DATA_COLLECTOR_URL}")
-    
-    # Initialize VLA controller
-    controller = VLAController(
-        loop_id=loop_id,
-        vla_model=vla_model,
-        agent=agent,
-        reward_calculator=reward_calculator,
-        image_fetcher=image_fetcher,
-        prompt_generator=prompt_generator,
-        data_logger=data_logger,
-        exp_id=EXP_ID,
-        exp_result_dir=exp_result_dir,
-        config=vla_params
-    )
-    
-    # Load checkpoint if specified
-    if VLA_CHECKPOINT and os.path.exists(VLA_CHECKPOINT):
-        controller.load_checkpoint(VLA_CHECKPOINT)
-    
-    print(f"VLA Controller Initialized for Loop '{loop_id}':")
-    print(f"  Model: {VLA_MODEL}")
-    print(f"  Learning Mode: {vla_params.get('learning_mode', 'online')}")
-    print(f"  Experiment ID: {EXP_ID}")
-    
-    return controller
+def _reply(result, fmt):
+    """リクエストと同じ形式で応答する"""
+    if fmt == wire.JSON:
+        return jsonify(result)
+    return Response(wire.encode(result, fmt), mimetype=wire.CONTENT_TYPES[fmt])
 
 
 @app.route('/control', methods=['POST'])
@@ -189,238 +115,26 @@ def control():
     1. Initialization: {"init": true, "control_loops": [...], "control_mode": "..."}
     2. Control step: {"exp_id": "...", "step": ..., "sensor_data": [...]}
     """
-    global vla_controllers, current_episode
-    
-    data = request.json
+    # JSON / msgpack（init時にネゴシエーションした形式、wire.py参照）
+    fmt = wire.format_of(request.content_type)
+    data = wire.decode(request.get_data(), fmt)
     
     # ========================================
     # Mode 1: Initialization Request
     # ========================================
     if data.get('init', False):
-        print("\n" + "=" * 70)
-        print(f"📋 INITIALIZATION REQUEST RECEIVED (Episode {current_episode + 1})")
-        print("=" * 70)
-        
-        # Finalize previous episode for all controllers
-        if vla_controllers:
-            print(f"🔚 Finalizing previous episode {current_episode}...")
-            for loop_id, controller in vla_controllers.items():
-                try:
-                    # Force episode completion if there's data in buffer
-                    if len(controller.episode_buffer) > 0:
-                        print(f"   Finalizing {loop_id} (buffer size: {len(controller.episode_buffer)})")
-                        controller._finish_episode()
-                except Exception as e:
-                    print(f"   ⚠ Error finalizing {loop_id}: {e}")
-            
-            print("✓ Previous episode finalized")
-        
-        # Increment episode counter
-        current_episode += 1
-        print(f"🎬 Starting Episode {current_episode}")
-        
-        # Get control loops from initialization data
-        control_loops = data.get('control_loops', [])
-        control_mode = data.get('control_mode', 'pressure')
-        
-        print(f"⚙️  Control mode: {control_mode}")
-        print(f"🔄 Number of loops: {len(control_loops)}")
-        
-        # Initialize or reset controllers for each loop
-        for loop_data in control_loops:
-            loop_id = loop_data.get('loop_id', 'default')
-            print(f"\n   Initializing loop: {loop_id}")
-            
-            # Build loop config from loop_data
-            loop_config = {
-                'vla_params': loop_data.get('vla_params', {
-                    'model_type': VLA_MODEL,
-                    'learning_mode': 'online',
-                    'training': {
-                        'buffer_size': 10000,
-                        'batch_size': 32,
-                        'learning_starts': 100,
-                        'learning_rate_actor': 0.0003,
-                        'learning_rate_critic': 0.0003,
-                        'learning_rate_alpha': 0.0003,
-                        'gamma': 0.99,
-                        'tau': 0.005,
-                        'alpha': 0.2
-                    },
-                    'exploration': {
-                        'initial_random_steps': 50
-                    },
-                    'reward': {
-                        'tracking_weight': 1.0,
-                        'stability_weight': 0.5,
-                        'safety_weight': 10.0,
-                        'safety_bounds': {
-                            'pressure_min': 100.0,
-                            'pressure_max': 150.0
-                        },
-                        'normalize': True,
-                        'clip_range': [-10, 10]
-                    },
-                    'action': {
-                        'delta_range': [-0.1, 0.1],
-                        'absolute_range': [0.0, 2.0]
-                    }
-                })
-            }
-            
-            # Create new controller or reset existing one
-            if loop_id in vla_controllers:
-                print(f"   Resetting existing controller for {loop_id}")
-                # Reset controller state for new episode
-                controller = vla_controllers[loop_id]
-                controller.current_episode = current_episode
-                controller.step_in_episode = 0
-                controller.prev_state = None
-                controller.prev_action = None
-                controller.episode_buffer = []
-                print(f"   ✓ Controller {loop_id} reset")
-            else:
-                print(f"   Creating new controller for {loop_id}")
-                vla_controllers[loop_id] = initialize_controller(loop_id, loop_config)
-                vla_controllers[loop_id].current_episode = current_episode
-                print(f"   ✓ Controller {loop_id} created")
-        
-        print("\n✅ Episode {} initialized successfully!".format(current_episode))
-        print("=" * 70)
-        print()
-        
-        return jsonify({
-            "status": "initialized",
-            "episode": current_episode,
-            "control_mode": control_mode,
-            "num_loops": len(control_loops),
-            "loop_ids": [loop.get('loop_id', 'default') for loop in control_loops]
-        })
+        response = bank.init(data)
+        # sim-runnerが提示した形式から、対応しているものを選ぶ
+        response['wire_format'] = wire.negotiate(data.get('wire_formats'))
+        return jsonify(response)
     
     # ========================================
     # Mode 2: Control Step Request
     # ========================================
-    else:
-        # ★ NEW: Extract exp_id and step from request
-        exp_id = data.get('exp_id', EXP_ID)
-        step = data.get('step', 0)
-        
-        # ★ CRITICAL FIX: sensor_data配列を展開
-        # sim-runnerは sensor_data: [{...}] の形式で送ってくる
-        if 'sensor_data' in data and isinstance(data['sensor_data'], list) and len(data['sensor_data']) > 0:
-            # sensor_data配列の最初の要素を取得
-            sensor_data_item = data['sensor_data'][0]
-            
-            # トップレベルのtime_stepを保持しつつ、sensor_dataの内容を展開
-            actual_data = {
-                'time_step': data.get('time_step', sensor_data_item.get('time_step', 0)),
-                **sensor_data_item  # sensor_dataの内容を展開
-            }
-            
-            # DEBUG: 最初のリクエストでデータ構造を表示
-            if step == 0 or step == 1:
-                print(f"\n[DEBUG] Original request keys: {list(data.keys())}")
-                print(f"[DEBUG] Extracted data keys: {list(actual_data.keys())}")
-                print(f"[DEBUG] exp_id={exp_id}, step={step}")
-        else:
-            # sensor_data配列がない場合（旧形式）
-            actual_data = data
-            if step == 0 or step == 1:
-                print(f"\n[DEBUG] Using legacy format (no sensor_data array)")
-                print(f"[DEBUG] Request keys: {list(data.keys())}")
-        
-        # loop_idを取得
-        loop_id = actual_data.get('loop_id')
-        
-        # ★ FALLBACK: loop_idがNoneの場合、既存のコントローラーから取得
-        if loop_id is None:
-            if len(vla_controllers) > 0:
-                loop_id = list(vla_controllers.keys())[0]
-                if step == 0:
-                    print(f"⚠️  WARNING: No loop_id in request, using default: {loop_id}")
-            else:
-                print(f"❌ ERROR: No loop_id and no controllers initialized!")
-                return jsonify({"error": "No loop_id provided and no controllers available"}), 400
-        
-        # Initialize controller on first request (backward compatibility)
-        if loop_id not in vla_controllers:
-            print(f"\n⚠️  WARNING: Controller {loop_id} not initialized via init request")
-            print(f"   Creating controller with default config...")
-            
-            loop_config = {
-                'vla_params': {
-                    'model_type': VLA_MODEL,
-                    'learning_mode': 'online',
-                    'training': {
-                        'buffer_size': 10000,
-                        'batch_size': 32,
-                        'learning_starts': 100,
-                        'learning_rate_actor': 0.0003,
-                        'learning_rate_critic': 0.0003,
-                        'learning_rate_alpha': 0.0003,
-                        'gamma': 0.99,
-                        'tau': 0.005,
-                        'alpha': 0.2
-                    },
-                    'exploration': {
-                        'initial_random_steps': 50
-                    },
-                    'reward': {
-                        'tracking_weight': 1.0,
-                        'stability_weight': 0.5,
-                        'safety_weight': 10.0,
-                        'safety_bounds': {
-                            'pressure_min': 100.0,
-                            'pressure_max': 150.0
-                        },
-                        'normalize': True,
-                        'clip_range': [-10, 10]
-                    },
-                    'action': {
-                        'delta_range': [-0.1, 0.1],
-                        'absolute_range': [0.0, 2.0]
-                    }
-                }
-            }
-            vla_controllers[loop_id] = initialize_controller(loop_id, loop_config)
-        
-        controller = vla_controllers[loop_id]
-        
-        # Prepare sensor data from actual_data
-        sensor_data = {
-            'loop_id': loop_id,  # 確実に設定
-            'pressure': actual_data.get('pressure', 0.0),
-            'target': actual_data.get('target', 0.0),
-            'prev_action': actual_data.get('prev_action', 0.0),
-            # Additional fields that PromptGenerator might need
-            'valve_opening': actual_data.get('valve_opening', actual_data.get('prev_action', 0.0) * 100),  # Convert to percentage
-            'upstream_pressure': actual_data.get('upstream_pressure', 0.0),
-            'downstream_pressure': actual_data.get('downstream_pressure', actual_data.get('pressure', 0.0)),
-            'flow': actual_data.get('flow', 0.0)
-        }
-        
-        time_step = actual_data.get('time_step', 0)
-        
-        # Log first and every 50th step
-        if step == 0:
-            print(f"\n🎮 Starting control loop for {loop_id} (Episode {current_episode})...")
-            print(f"   exp_id={exp_id}, step={step}")
-            print(f"   Sensor data keys: {list(sensor_data.keys())}")
-            print(f"   Pressure: {sensor_data['pressure']:.2f}, Target: {sensor_data['target']:.2f}")
-        elif step % 50 == 0:
-            print(f"   Step {step}... (loop_id={loop_id}, pressure={sensor_data['pressure']:.2f})")
-        
-        # ★ NEW: Compute action with exp_id and step for image fetching
-        delta_action = controller.compute_action(
-            sensor_data=sensor_data,
-            step=step,
-            time_step=time_step,
-            exp_id=exp_id  # ★ Pass exp_id for ImageFetcher
-        )
-        
-        return jsonify({
-            'delta_action': float(delta_action)
-        })
+    try:
+        return _reply(bank.step(data), fmt)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
 
 @app.route('/episode_end', methods=['POST'])
@@ -440,16 +154,7 @@ def episode_end():
     
     print(f"\n[/episode_end] Received episode end for {loop_id}")
     
-    if loop_id in vla_controllers:
-        controller = vla_controllers[loop_id]
-        
-        # Force episode end (in case auto-detection missed it)
-        if len(controller.episode_buffer) > 0:
-            print(f"   Forcing episode completion (buffer size: {len(controller.episode_buffer)})")
-            controller._finish_episode()
-        
-        print(f"✓ Episode {controller.current_episode} ended for {loop_id}")
-        
+    if bank.episode_end(loop_id):
         return jsonify({'status': 'ok', 'message': 'Episode ended'})
     else:
         return jsonify({'status': 'error', 'message': f'Controller {loop_id} not found'}), 404
@@ -461,14 +166,8 @@ def save_checkpoint():
     data = request.json
     loop_id = data.get('loop_id')
     
-    if loop_id in vla_controllers:
-        controller = vla_controllers[loop_id]
-        checkpoint_path = os.path.join(
-            exp_result_dir,
-            f'{EXP_ID}_{loop_id}_ep{controller.current_episode}.pt'
-        )
-        controller.save_checkpoint(checkpoint_path)
-        print(f"💾 Checkpoint saved: {checkpoint_path}")
+    checkpoint_path = bank.save_checkpoint(loop_id)
+    if checkpoint_path is not None:
         return jsonify({'status': 'ok', 'checkpoint': checkpoint_path})
     else:
         return jsonify({'status': 'error', 'message': f'Controller {loop_id} not found'}), 404
@@ -480,9 +179,9 @@ def status():
     return jsonify({
         'status': 'running',
         'exp_id': EXP_ID,
-        'current_episode': current_episode,
-        'controllers': list(vla_controllers.keys()),
-        'num_controllers': len(vla_controllers)
+        'current_episode': bank.current_episode,
+        'controllers': list(bank.vla_controllers.keys()),
+        'num_controllers': len(bank.vla_controllers)
     })
 
 
@@ -492,7 +191,7 @@ def health():
     return jsonify({
         'status': 'ok',
         'exp_id': EXP_ID,
-        'controllers': list(vla_controllers.keys())
+        'controllers': list(bank.vla_controllers.keys())
     })
 
 
@@ -509,4 +208,5 @@ if __name__ == '__main__':
     print("=" * 60)
     print()
     
-    app.run(host='0.0.0.0', port=5000, debug=False)
\ No newline at end of file
+    # sim-runnerはループごとのリクエストを並列に送るため、スレッドで同時に処理する
+    app.run(host='0.0.0.0', port=5000, debug=False, threaded=True)
\ No newline at end of file
@@ -95,7 +95,7 @@ class VLAController:
         print(f"[DEBUG] _calculate_max_steps() = {max_steps}")
         return max_steps
     
-    def compute_action(self, sensor_data, step, time_step, exp_id=None):
+    def compute_action(self, sensor_data, step, time_step, exp_id=None, image_step=None):
         """
         Compute control action using VLA model
         
@@ -104,6 +104,7 @@ class VLAController:
             step: Current step number
             time_step: Current simulation time
             exp_id: Experiment ID (optional, uses self.exp_id if not provided)
+            image_step: Step whose images to fetch (optional, defaults to step)
             
         Returns:
             delta_action: Action to take (delta valve setting)
@@ -119,8 +120,10 @@ class VLAController:
             print(f"[DEBUG]   Using provided exp_id: {exp_id}")
         
         # Fetch images
-        print(f"[DEBUG] Fetching images for exp_id={exp_id}, step={step}...")
-        images = self.image_fetcher.fetch(exp_id, step, sensor_data)
+        if image_step is None:
+            image_step = step
+        print(f"[DEBUG] Fetching images for exp_id={exp_id}, step={image_step}...")
+        images = self.image_fetcher.fetch(exp_id, image_step, sensor_data)
         print(f"[DEBUG]   Got {len(images)} images: {list(images.keys())}")
         
         # Generate prompt
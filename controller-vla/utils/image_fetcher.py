@@ -45,10 +45,14 @@ class ImageFetcher:
         NOTE: 画像生成はsim-runnerが事前に行っているため、
               ここでは既にRedisに保存されている画像を取得するのみ
         
+        sim-runnerはループごとの画像を "{exp_id}:step_{step}:{loop_id}:{image_type}"
+        に保存する。ループ別の画像がない場合は従来のキー
+        "{exp_id}:step_{step}:{image_type}" を参照する。
+        
         Args:
             exp_id: 実験ID
             step: ステップ番号
-            state: センサーデータ（未使用、互換性のため保持）
+            state: センサーデータ（loop_id を使用）
         
         Returns:
             dict: {image_type: PIL.Image}
@@ -61,13 +65,20 @@ class ImageFetcher:
             print("[ImageFetcher] Redis client not available, returning dummy images")
             return self._create_dummy_images()
         
+        loop_id = (state or {}).get('loop_id')
+        
         # Redisから画像を取得
         for img_type in self.image_types:
-            redis_key = f"{exp_id}:step_{step}:{img_type}"
+            legacy_key = f"{exp_id}:step_{step}:{img_type}"
+            redis_key = f"{exp_id}:step_{step}:{loop_id}:{img_type}" if loop_id is not None else legacy_key
             print(f"[ImageFetcher]   Fetching {img_type} from Redis: {redis_key}")
             
             try:
                 img_bytes = self.redis_client.get(redis_key)
+                if not img_bytes and redis_key != legacy_key:
+                    # ループ別の画像がない場合（旧sim-runner）は従来のキー
+                    redis_key = legacy_key
+                    img_bytes = self.redis_client.get(redis_key)
                 
                 if img_bytes:
                     print(f"[ImageFetcher]     Got {len(img_bytes)} bytes from Redis")
@@ -0,0 +1,391 @@
+"""
+VLA Controller Bank
+
+Flask-independent container for the per-loop VLAController instances.
+Used by app.py (HTTP) and by sim-runner's in-process controller plugin,
+so both paths run exactly the same control code.
+"""
+import os
+import time
+
+from training.controller import VLAController
+from models.sac_agent import SACAgent
+from utils.image_fetcher import ImageFetcher
+from utils.prompt_generator import PromptGenerator
+from utils.reward import RewardCalculator
+from utils.data_logger import DataLogger
+
+
+def default_vla_params(vla_model):
+    """Fallback VLA parameters for loops without an explicit 'vla_params' block"""
+    return {
+        'model_type': vla_model,
+        'learning_mode': 'online',
+        'training': {
+            'buffer_size': 10000,
+            'batch_size': 32,
+            'learning_starts': 100,
+            'learning_rate_actor': 0.0003,
+            'learning_rate_critic': 0.0003,
+            'learning_rate_alpha': 0.0003,
+            'gamma': 0.99,
+            'tau': 0.005,
+            'alpha': 0.2
+        },
+        'exploration': {
+            'initial_random_steps': 50
+        },
+        'reward': {
+            'tracking_weight': 1.0,
+            'stability_weight': 0.5,
+            'safety_weight': 10.0,
+            'safety_bounds': {
+                'pressure_min': 100.0,
+                'pressure_max': 150.0
+            },
+            'normalize': True,
+            'clip_range': [-10, 10]
+        },
+        'action': {
+            'delta_range': [-0.1, 0.1],
+            'absolute_range': [0.0, 2.0]
+        }
+    }
+
+
+class VLABank:
+    """Holds one VLAController per control loop and tracks episodes"""
+
+    def __init__(self, exp_id=None, output_path=None, redis_url=None,
+                 image_generator_url=None, data_collector_url=None,
+                 vla_model=None, vla_checkpoint=None):
+        """
+        Initialize the bank (defaults are read from the environment)
+
+        Args:
+            exp_id: Experiment ID
+            output_path: Root directory for results
+            redis_url: Redis URL for image fetching
+            image_generator_url: image-generator service URL
+            data_collector_url: data-collector service URL
+            vla_model: VLA model name (simple_dnn/tiny_vla/smolvla/openvla/dummy)
+            vla_checkpoint: Optional checkpoint path
+        """
+        self.exp_id = exp_id or os.environ.get('EXP_ID', f'vla_exp_{int(time.time())}')
+        self.output_path = output_path or os.environ.get('OUTPUT_PATH', '/shared/results')
+        self.redis_url = redis_url or os.environ.get('REDIS_URL', 'redis://redis:6379')
+        self.image_generator_url = image_generator_url or os.environ.get(
+            'IMAGE_GENERATOR_URL', 'http://image-generator:5000'
+        )
+        self.data_collector_url = data_collector_url or os.environ.get(
+            'DATA_COLLECTOR_URL', 'http://data-collector:5000'
+        )
+        self.vla_model = vla_model or os.environ.get('VLA_MODEL', 'simple_dnn')
+        self.vla_checkpoint = vla_checkpoint if vla_checkpoint is not None else os.environ.get('VLA_CHECKPOINT', '')
+
+        self.exp_result_dir = os.path.join(self.output_path, self.exp_id)
+        os.makedirs(self.exp_result_dir, exist_ok=True)
+
+        self.vla_controllers = {}
+        self.current_episode = 0  # グローバルエピソードカウンタ
+
+    def initialize_controller(self, loop_id, loop_config):
+        """Initialize VLA controller for a control loop"""
+
+        # Initialize VLA model
+        if self.vla_model == 'simple_dnn':
+            from models.simple_dnn_vla import SimpleDNNVLAWrapper
+            vla_model = SimpleDNNVLAWrapper()
+            print("Initialized SimpleDNN VLA Model")
+        elif self.vla_model == 'tiny_vla':
+            from models.tiny_vla import TinyVLAWrapper
+            vla_model = TinyVLAWrapper()
+            print("Initialized TinyVLA Model")
+        elif self.vla_model == 'smolvla':
+            from models.smolvla import SmolVLAWrapper
+            vla_model = SmolVLAWrapper()
+            print("Initialized SmolVLA Model")
+        elif self.vla_model == 'openvla':
+            from models.openvla import OpenVLAWrapper
+            vla_model = OpenVLAWrapper()
+            print("Initialized OpenVLA Model")
+        elif self.vla_model == 'dummy':
+            from models.dummy_agent import DummyVLA
+            vla_model = DummyVLA()
+            print("Initialized Dummy VLA Model")
+        else:
+            raise ValueError(f"Unknown VLA model: {self.vla_model}")
+
+        # Extract VLA parameters
+        vla_params = loop_config.get('vla_params', {})
+
+        # Initialize SAC agent
+        agent = SACAgent(config=vla_params)
+        print("SAC Agent initialized")
+
+        # Initialize utilities
+        image_fetcher = ImageFetcher(
+            redis_url=self.redis_url,
+            image_generator_url=self.image_generator_url
+        )
+
+        prompt_generator = PromptGenerator()
+
+        reward_config = vla_params.get('reward', {})
+        reward_calculator = RewardCalculator(
+            tracking_weight=reward_config.get('tracking_weight', 1.0),
+            stability_weight=reward_config.get('stability_weight', 0.5),
+            safety_weight=reward_config.get('safety_weight', 10.0),
+            safety_bounds=reward_config.get('safety_bounds', {}),
+            normalize=reward_config.get('normalize', True),
+            clip_range=reward_config.get('clip_range', [-10, 10])
+        )
+
+        data_logger = DataLogger(self.data_collector_url)
+        print(f"DataLogger initialized: {self.data_collector_url}")
+
+        # Initialize VLA controller
+        controller = VLAController(
+            loop_id=loop_id,
+            vla_model=vla_model,
+            agent=agent,
+            reward_calculator=reward_calculator,
+            image_fetcher=image_fetcher,
+            prompt_generator=prompt_generator,
+            data_logger=data_logger,
+            exp_id=self.exp_id,
+            exp_result_dir=self.exp_result_dir,
+            config=vla_params
+        )
+
+        # Load checkpoint if specified
+        if self.vla_checkpoint and os.path.exists(self.vla_checkpoint):
+            controller.load_checkpoint(self.vla_checkpoint)
+
+        print(f"VLA Controller Initialized for Loop '{loop_id}':")
+        print(f"  Model: {self.vla_model}")
+        print(f"  Learning Mode: {vla_params.get('learning_mode', 'online')}")
+        print(f"  Experiment ID: {self.exp_id}")
+
+        return controller
+
+    def init(self, data):
+        """
+        Handle an initialization request
+
+        Args:
+            data: {"init": true, "control_loops": [...], "control_mode": "..."}
+
+        Returns:
+            Initialization response dict
+        """
+        print("\n" + "=" * 70)
+        print(f"📋 INITIALIZATION REQUEST RECEIVED (Episode {self.current_episode + 1})")
+        print("=" * 70)
+
+        # Finalize previous episode for all controllers
+        if self.vla_controllers:
+            print(f"🔚 Finalizing previous episode {self.current_episode}...")
+            for loop_id, controller in self.vla_controllers.items():
+                try:
+                    # Force episode completion if there's data in buffer
+                    if len(controller.episode_buffer) > 0:
+                        print(f"   Finalizing {loop_id} (buffer size: {len(controller.episode_buffer)})")
+                        controller._finish_episode()
+                except Exception as e:
+                    print(f"   ⚠ Error finalizing {loop_id}: {e}")
+
+            print("✓ Previous episode finalized")
+
+        # Increment episode counter
+        self.current_episode += 1
+        print(f"🎬 Starting Episode {self.current_episode}")
+
+        # Get control loops from initialization data
+        control_loops = data.get('control_loops', [])
+        control_mode = data.get('control_mode', 'pressure')
+
+        print(f"⚙️  Control mode: {control_mode}")
+        print(f"🔄 Number of loops: {len(control_loops)}")
+
+        # Initialize or reset controllers for each loop
+        for loop_data in control_loops:
+            loop_id = loop_data.get('loop_id', 'default')
+            print(f"\n   Initializing loop: {loop_id}")
+
+            # Build loop config from loop_data
+            loop_config = {
+                'vla_params': loop_data.get('vla_params', default_vla_params(self.vla_model))
+            }
+
+            # Create new controller or reset existing one
+            if loop_id in self.vla_controllers:
+                print(f"   Resetting existing controller for {loop_id}")
+                # Reset controller state for new episode
+                controller = self.vla_controllers[loop_id]
+                controller.current_episode = self.current_episode
+                controller.step_in_episode = 0
+                controller.prev_state = None
+                controller.prev_action = None
+                controller.episode_buffer = []
+                print(f"   ✓ Controller {loop_id} reset")
+            else:
+                print(f"   Creating new controller for {loop_id}")
+                self.vla_controllers[loop_id] = self.initialize_controller(loop_id, loop_config)
+                self.vla_controllers[loop_id].current_episode = self.current_episode
+                print(f"   ✓ Controller {loop_id} created")
+
+        print("\n✅ Episode {} initialized successfully!".format(self.current_episode))
+        print("=" * 70)
+        print()
+
+        return {
+            "status": "initialized",
+            "episode": self.current_episode,
+            "control_mode": control_mode,
+            "num_loops": len(control_loops),
+            "loop_ids": [loop.get('loop_id', 'default') for loop in control_loops]
+        }
+
+    def step(self, data):
+        """
+        Handle a control step request for a single loop
+
+        Args:
+            data: {"exp_id": "...", "step": ..., "sensor_data": [{...}]}
+                (optional "image_step": step whose images to use)
+
+        Returns:
+            {"delta_action": float}
+
+        Raises:
+            ValueError: If no loop_id is given and no controllers exist
+        """
+        # ★ NEW: Extract exp_id and step from request
+        exp_id = data.get('exp_id', self.exp_id)
+        step = data.get('step', 0)
+        # ★ NEW: Pipelined sim-runner may point at a slightly older (ready) image step
+        image_step = data.get('image_step')
+
+        # ★ CRITICAL FIX: sensor_data配列を展開
+        # sim-runnerは sensor_data: [{...}] の形式で送ってくる
+        if 'sensor_data' in data and isinstance(data['sensor_data'], list) and len(data['sensor_data']) > 0:
+            # sensor_data配列の最初の要素を取得
+            sensor_data_item = data['sensor_data'][0]
+
+            # トップレベルのtime_stepを保持しつつ、sensor_dataの内容を展開
+            actual_data = {
+                'time_step': data.get('time_step', sensor_data_item.get('time_step', 0)),
+                **sensor_data_item  # sensor_dataの内容を展開
+            }
+
+            # DEBUG: 最初のリクエストでデータ構造を表示
+            if step == 0 or step == 1:
+                print(f"\n[DEBUG] Original request keys: {list(data.keys())}")
+                print(f"[DEBUG] Extracted data keys: {list(actual_data.keys())}")
+                print(f"[DEBUG] exp_id={exp_id}, step={step}")
+        else:
+            # sensor_data配列がない場合（旧形式）
+            actual_data = data
+            if step == 0 or step == 1:
+                print(f"\n[DEBUG] Using legacy format (no sensor_data array)")
+                print(f"[DEBUG] Request keys: {list(data.keys())}")
+
+        # loop_idを取得
+        loop_id = actual_data.get('loop_id')
+
+        # ★ FALLBACK: loop_idがNoneの場合、既存のコントローラーから取得
+        if loop_id is None:
+            if len(self.vla_controllers) > 0:
+                loop_id = list(self.vla_controllers.keys())[0]
+                if step == 0:
+                    print(f"⚠️  WARNING: No loop_id in request, using default: {loop_id}")
+            else:
+                print(f"❌ ERROR: No loop_id and no controllers initialized!")
+                raise ValueError("No loop_id provided and no controllers available")
+
+        # Initialize controller on first request (backward compatibility)
+        if loop_id not in self.vla_controllers:
+            print(f"\n⚠️  WARNING: Controller {loop_id} not initialized via init request")
+            print(f"   Creating controller with default config...")
+
+            loop_config = {'vla_params': default_vla_params(self.vla_model)}
+            self.vla_controllers[loop_id] = self.initialize_controller(loop_id, loop_config)
+
+        controller = self.vla_controllers[loop_id]
+
+        # Prepare sensor data from actual_data
+        sensor_data = {
+            'loop_id': loop_id,  # 確実に設定
+            'pressure': actual_data.get('pressure', 0.0),
+            'target': actual_data.get('target', 0.0),
+            'prev_action': actual_data.get('prev_action', 0.0),
+            # Additional fields that PromptGenerator might need
+            'valve_opening': actual_data.get('valve_opening', actual_data.get('prev_action', 0.0) * 100),  # Convert to percentage
+            'upstream_pressure': actual_data.get('upstream_pressure', 0.0),
+            'downstream_pressure': actual_data.get('downstream_pressure', actual_data.get('pressure', 0.0)),
+            'flow': actual_data.get('flow', 0.0)
+        }
+
+        time_step = actual_data.get('time_step', 0)
+
+        # Log first and every 50th step
+        if step == 0:
+            print(f"\n🎮 Starting control loop for {loop_id} (Episode {self.current_episode})...")
+            print(f"   exp_id={exp_id}, step={step}")
+            print(f"   Sensor data keys: {list(sensor_data.keys())}")
+            print(f"   Pressure: {sensor_data['pressure']:.2f}, Target: {sensor_data['target']:.2f}")
+        elif step % 50 == 0:
+            print(f"   Step {step}... (loop_id={loop_id}, pressure={sensor_data['pressure']:.2f})")
+
+        # ★ NEW: Compute action with exp_id and step for image fetching
+        delta_action = controller.compute_action(
+            sensor_data=sensor_data,
+            step=step,
+            time_step=time_step,
+            exp_id=exp_id,  # ★ Pass exp_id for ImageFetcher
+            image_step=image_step
+        )
+
+        return {
+            'delta_action': float(delta_action)
+        }
+
+    def episode_end(self, loop_id):
+        """
+        Force episode completion for a loop
+
+        Returns:
+            True if the loop exists, False otherwise
+        """
+        if loop_id not in self.vla_controllers:
+            return False
+
+        controller = self.vla_controllers[loop_id]
+
+        # Force episode end (in case auto-detection missed it)
+        if len(controller.episode_buffer) > 0:
+            print(f"   Forcing episode completion (buffer size: {len(controller.episode_buffer)})")
+            controller._finish_episode()
+
+        print(f"✓ Episode {controller.current_episode} ended for {loop_id}")
+        return True
+
+    def save_checkpoint(self, loop_id):
+        """
+        Save model checkpoint for a loop
+
+        Returns:
+            Checkpoint path, or None if the loop does not exist
+        """
+        if loop_id not in self.vla_controllers:
+            return None
+
+        controller = self.vla_controllers[loop_id]
+        checkpoint_path = os.path.join(
+            self.exp_result_dir,
+            f'{self.exp_id}_{loop_id}_ep{controller.current_episode}.pt'
+        )
+        controller.save_checkpoint(checkpoint_path)
+        print(f"💾 Checkpoint saved: {checkpoint_path}")
+        return checkpoint_path
@@ -50,9 +50,14 @@ def generate():
             "pressure": [29.0, 29.5, 30.0],
             "valve_setting": [0.48, 0.49, 0.5],
             ...
-        }
+        },
+        "prev_state": {...}  (optional, state of the previous step)
     }
     
+    With "prev_state" in the request the change-based generators use it
+    as is. Otherwise the state of the last request of this exp_id is used,
+    which is only correct when requests arrive in step order.
+    
     Response JSON:
     {
         "redis_keys": {
@@ -74,8 +79,11 @@ def generate():
         state = data.get('state', {})
         history = data.get('history', {})
         
-        # Get previous state
-        prev_state = prev_states.get(exp_id)
+        # Get previous state (sent by the client, so concurrent requests stay step-ordered)
+        if 'prev_state' in data:
+            prev_state = data['prev_state']
+        else:
+            prev_state = prev_states.get(exp_id)
         
         # Image size
         size = (IMAGE_WIDTH, IMAGE_HEIGHT)
@@ -99,8 +107,9 @@ def generate():
                 import traceback
                 traceback.print_exc()
         
-        # Save current state for next iteration
-        prev_states[exp_id] = state
+        # Save current state for next iteration (clients without prev_state)
+        if 'prev_state' not in data:
+            prev_states[exp_id] = state
         
         # Debug log
         if step % 10 == 0 or step == 0:
@@ -126,6 +135,104 @@ def generate():
         }), 500
 
 
+@app.route('/generate_batch', methods=['POST'])
+def generate_batch():
+    """
+    Generate images of several control loops in one request
+    
+    Each loop has its own previous state ("prev_state" of the loop entry,
+    or the state of the last request otherwise), and its images are stored under
+    "{exp_id}:step_{step}:{loop_id}:{generator_name}". All images of the
+    request are written to Redis in one pipeline round trip.
+    
+    Request JSON:
+    {
+        "exp_id": "experiment_id",
+        "step": 0,
+        "loops": [
+            {"loop_id": "loop_1", "state": {...}, "history": {...}, "prev_state": {...}},
+            ...
+        ]
+    }
+    
+    Response JSON:
+    {
+        "redis_keys": {
+            "loop_1": {"generator_name": "redis_key", ...},
+            ...
+        },
+        "metadata": {...}
+    }
+    """
+    try:
+        data = request.json
+        
+        exp_id = data.get('exp_id', 'unknown')
+        step = data.get('step', 0)
+        loops = data.get('loops', [])
+        
+        # Image size
+        size = (IMAGE_WIDTH, IMAGE_HEIGHT)
+        
+        redis_keys = {}
+        pipe = redis_client.pipeline(transaction=False)
+        
+        for loop in loops:
+            loop_id = loop.get('loop_id', 'default')
+            state = loop.get('state', {})
+            history = loop.get('history', {})
+            state_key = f"{exp_id}:{loop_id}"
+            if 'prev_state' in loop:
+                prev_state = loop['prev_state']
+            else:
+                prev_state = prev_states.get(state_key)
+            
+            loop_keys = {}
+            for name, generator in generators.items():
+                try:
+                    img_bytes = generator.generate(state, history, prev_state, size)
+                    
+                    redis_key = f"{exp_id}:step_{step}:{loop_id}:{name}"
+                    pipe.setex(redis_key, REDIS_TTL, img_bytes)
+                    loop_keys[name] = redis_key
+                    
+                except Exception as e:
+                    print(f"Error generating {name} for {loop_id}: {e}")
+                    import traceback
+                    traceback.print_exc()
+            
+            redis_keys[loop_id] = loop_keys
+            if 'prev_state' not in loop:
+                prev_states[state_key] = state
+        
+        pipe.execute()
+        
+        # Debug log
+        if step % 10 == 0 or step == 0:
+            num_images = sum(len(keys) for keys in redis_keys.values())
+            print(f"[image-generator] Generated {num_images} images of {len(redis_keys)} loops "
+                  f"for {exp_id}, step {step}")
+        
+        return jsonify({
+            "redis_keys": redis_keys,
+            "metadata": {
+                "image_size": [IMAGE_WIDTH, IMAGE_HEIGHT],
+                "enabled_generators": list(generators.keys()),
+                "num_generators": len(generators),
+                "num_loops": len(redis_keys)
+            }
+        })
+    
+    except Exception as e:
+        print(f"Error in /generate_batch endpoint: {e}")
+        import traceback
+        traceback.print_exc()
+        
+        return jsonify({
+            "error": str(e)
+        }), 500
+
+
 @app.route('/info', methods=['GET'])
 def info():
     """
@@ -31,6 +31,20 @@ docker-compose up -d controller-vla
 echo "Waiting for services to be ready..."
 sleep 10
 
+# 常駐モード: sim-runnerを1回だけ起動し、ネットワークを読み込んだまま全エピソードを実行
+# （コンテナ起動・import・INP読み込みは1回分。controller-vlaは初期化リクエストでエピソードを切り替える）
+if [ "${SIM_RESIDENT:-false}" = "true" ]; then
+    echo ""
+    echo "=== Resident mode: $NUM_EPISODES episodes in one sim-runner process ==="
+    SIM_EPISODES=$NUM_EPISODES docker-compose up sim-runner
+    if [ -f "shared/results/$EXP_ID/episodes.csv" ]; then
+        echo ""
+        echo "--- Per-episode setup time ---"
+        cat "shared/results/$EXP_ID/episodes.csv"
+    fi
+    NUM_EPISODES=0
+fi
+
 # 各エピソードを実行
 for i in $(seq 1 $NUM_EPISODES); do
     echo ""
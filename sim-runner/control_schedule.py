@@ -0,0 +1,134 @@
+"""
+Control interval and event-triggered controller invocation
+
+By default the controller is called on every hydraulic step. A schedule
+decides per step and loop whether the controller is queried; loops that
+are not due hold their valve setting (no controller call, no images):
+
+    periodic  every CONTROL_PERIOD hydraulic steps
+    event     at most every CONTROL_PERIOD steps, and only when
+                  |error| > CONTROL_ERROR_THRESHOLD, or
+                  |error change per step| > CONTROL_RATE_THRESHOLD, or
+                  CONTROL_MAX_HOLD steps passed since the last call
+
+Thresholds are in the unit of the controlled value (pressure or flow).
+The first step of an episode always calls the controller. Batch
+controllers (PID/MPC) answer for all loops in one request, so they are
+called when any loop is due; individual controllers (VLA) are called per
+due loop.
+"""
+import os
+
+import numpy as np
+
+
+TRIGGERS = ('periodic', 'event')
+
+
+class ControlSchedule:
+    """Per-loop controller call decisions and skipped-call counters"""
+
+    def __init__(self, num_loops, period=1, trigger='periodic', error_threshold=1.0,
+                 rate_threshold=0.5, max_hold=6):
+        """
+        Args:
+            num_loops: Number of control loops
+            period: Minimum number of hydraulic steps between calls
+            trigger: 'periodic' or 'event'
+            error_threshold: |error| that triggers a call (event mode)
+            rate_threshold: |error change per step| that triggers a call (event mode)
+            max_hold: Maximum steps without a call (event mode)
+        """
+        if trigger not in TRIGGERS:
+            raise ValueError(f"Unknown control trigger: {trigger} (expected one of {TRIGGERS})")
+        self.num_loops = num_loops
+        self.period = max(1, int(period))
+        self.trigger = trigger
+        self.error_threshold = float(error_threshold)
+        self.rate_threshold = float(rate_threshold)
+        self.max_hold = max(self.period, int(max_hold))
+        self.reset()
+
+    @classmethod
+    def from_env(cls, num_loops):
+        """Schedule configured by CONTROL_PERIOD / CONTROL_TRIGGER / CONTROL_*_THRESHOLD / CONTROL_MAX_HOLD"""
+        return cls(
+            num_loops,
+            period=int(os.environ.get('CONTROL_PERIOD', '1')),
+            trigger=os.environ.get('CONTROL_TRIGGER', 'periodic').lower(),
+            error_threshold=float(os.environ.get('CONTROL_ERROR_THRESHOLD', '1.0')),
+            rate_threshold=float(os.environ.get('CONTROL_RATE_THRESHOLD', '0.5')),
+            max_hold=int(os.environ.get('CONTROL_MAX_HOLD', '6'))
+        )
+
+    @property
+    def active(self):
+        """False when the controller is called on every step (default)"""
+        return self.period > 1 or self.trigger != 'periodic'
+
+    def reset(self):
+        """Start of an episode: every loop is due on the first step"""
+        self.since_call = np.full(self.num_loops, np.iinfo(np.int64).max // 2, dtype=np.int64)
+        self.last_error = None
+        self.calls = np.zeros(self.num_loops, dtype=np.int64)
+        self.skipped = np.zeros(self.num_loops, dtype=np.int64)
+        self.reasons = {"period": 0, "error": 0, "rate": 0, "max_hold": 0}
+
+    def due(self, error):
+        """
+        Loops whose controller should be queried this step
+
+        Call once per step, before mark_called().
+
+        Args:
+            error: Control error per loop
+
+        Returns:
+            np.ndarray: Boolean mask over loops
+        """
+        error = np.asarray(error, dtype=np.float64)
+        rate = np.zeros(self.num_loops) if self.last_error is None else np.abs(error - self.last_error)
+        self.last_error = error.copy()
+
+        self.since_call += 1
+        ready = self.since_call >= self.period
+        if self.trigger == 'periodic':
+            due = ready
+            self.reasons["period"] += int(np.count_nonzero(due))
+            return due
+
+        by_error = ready & (np.abs(error) > self.error_threshold)
+        by_rate = ready & ~by_error & (rate > self.rate_threshold)
+        by_hold = ready & ~by_error & ~by_rate & (self.since_call >= self.max_hold)
+        self.reasons["error"] += int(np.count_nonzero(by_error))
+        self.reasons["rate"] += int(np.count_nonzero(by_rate))
+        self.reasons["max_hold"] += int(np.count_nonzero(by_hold))
+        return by_error | by_rate | by_hold
+
+    def mark_called(self, called):
+        """
+        Record the outcome of this step's decisions
+
+        Args:
+            called: Boolean mask of loops whose controller was queried
+        """
+        called = np.asarray(called, dtype=bool)
+        self.since_call[called] = 0
+        self.calls += called
+        self.skipped += ~called
+
+    def summary(self, loop_ids):
+        """
+        Returns:
+            list of dict: Calls and skipped calls per loop
+        """
+        rows = []
+        for i, loop_id in enumerate(loop_ids):
+            total = int(self.calls[i] + self.skipped[i])
+            rows.append({
+                "loop_id": loop_id,
+                "calls": int(self.calls[i]),
+                "skipped": int(self.skipped[i]),
+                "skip_rate": self.skipped[i] / total if total else 0.0
+            })
+        return rows
@@ -0,0 +1,63 @@
+"""
+Controller Plugin Registry
+
+sim-runner can reach a controller through different transports:
+    http      - POST to the controller service (default)
+    inprocess - load the controller code into the sim-runner process
+    replay    - replay a recorded action trace (no controller at all)
+"""
+from controllers.base import BaseController, ControllerError, pid_sample_time, with_pid_sample_time
+from controllers.http_controller import HTTPController
+from controllers.inprocess import InProcessController, PLUGINS
+from controllers.replay import ReplayController
+
+
+TRANSPORTS = ['http', 'inprocess', 'replay']
+
+
+def infer_plugin(controller_url):
+    """
+    Guess the controller plugin from the controller URL
+
+    Args:
+        controller_url: e.g. http://controller-mpc:5000/control
+
+    Returns:
+        str: Plugin name ('pid', 'mpc' or 'vla')
+    """
+    url = controller_url.lower()
+    for name in PLUGINS:
+        if name in url:
+            return name
+    return 'pid'
+
+
+def create_controller(transport, controller_url, plugin=None, plugin_dir='/plugins',
+                      http_transport=None, trace_path=None, wire_formats=None):
+    """
+    Create a controller plugin
+
+    Args:
+        transport: 'http', 'inprocess' or 'replay'
+        controller_url: URL of the controller service (http transport,
+            and used to infer the plugin when not given)
+        plugin: 'pid', 'mpc' or 'vla' (inprocess transport)
+        plugin_dir: Directory containing the controller service sources
+        http_transport: ServiceTransport used by the http transport
+        trace_path: Action trace to replay (replay transport)
+        wire_formats: Wire formats offered to the controller service
+            (http transport, see wire.py)
+
+    Returns:
+        BaseController instance
+    """
+    if transport == 'http':
+        return HTTPController(controller_url, transport=http_transport, wire_formats=wire_formats)
+    elif transport == 'inprocess':
+        return InProcessController(plugin or infer_plugin(controller_url), plugin_dir)
+    elif transport == 'replay':
+        if not trace_path:
+            raise ValueError("Replay transport requires a trace path (REPLAY_TRACE)")
+        return ReplayController(trace_path)
+    else:
+        raise ValueError(f"Unknown controller transport: {transport} (available: {TRANSPORTS})")
@@ -0,0 +1,103 @@
+"""
+Base class for sim-runner controller plugins
+
+A controller plugin hides how sim-runner talks to a controller:
+over HTTP to a Flask service, or by calling the controller code
+directly inside the sim-runner process.
+"""
+from abc import ABC, abstractmethod
+
+
+def pid_sample_time(pid_params, hydraulic_step):
+    """
+    Sampling period of a PID loop
+
+    Args:
+        pid_params: pid_params section of a control loop
+        hydraulic_step: Simulation hydraulic step in seconds
+
+    Returns:
+        float: pid_params.dt if set, otherwise the hydraulic step
+    """
+    return pid_params.get('dt') or hydraulic_step
+
+
+def with_pid_sample_time(control_loops, hydraulic_step):
+    """
+    Copy of control_loops with pid_params.dt filled in (see pid_sample_time)
+
+    Without dt, simple_pid measures the period as wall-clock time between
+    calls, which depends on the transport (HTTP vs in-process) and the host.
+    """
+    return [
+        dict(loop, pid_params={
+            **loop.get('pid_params', {}),
+            'dt': pid_sample_time(loop.get('pid_params', {}), hydraulic_step)
+        })
+        for loop in control_loops
+    ]
+
+
+class ControllerError(Exception):
+    """Raised when a controller rejects a request (non-200 equivalent)"""
+
+    def __init__(self, status_code, message=""):
+        super().__init__(f"Controller returned status {status_code}: {message}")
+        self.status_code = status_code
+        self.message = message
+
+
+class BaseController(ABC):
+    """
+    Base class for all controller plugins
+
+    Request/response dicts use exactly the same layout as the
+    controllers' /control endpoint, so every plugin is interchangeable.
+    """
+
+    # True if step() may be called concurrently for different loops
+    # (individual-type controllers, see LOOP_DISPATCH_WORKERS)
+    concurrent_loops = False
+
+    def __init__(self, name):
+        """
+        Initialize plugin
+
+        Args:
+            name: Plugin name (used for logging)
+        """
+        self.name = name
+
+    @abstractmethod
+    def init(self, control_mode, control_loops):
+        """
+        Initialize the controller for a new episode
+
+        Args:
+            control_mode: 'pressure' or 'flow'
+            control_loops: List of loop configs from the experiment config
+
+        Returns:
+            dict: Initialization response (status, num_loops, controller_type, ...)
+        """
+        pass
+
+    @abstractmethod
+    def step(self, payload):
+        """
+        Compute actions for one control step
+
+        Args:
+            payload: {"exp_id": ..., "step": ..., "time_step": ..., "sensor_data": [...]}
+
+        Returns:
+            dict: {"actions": [...]} (batch) or {"delta_action": ...} (individual)
+
+        Raises:
+            ControllerError: If the controller rejects the request
+        """
+        pass
+
+    def close(self):
+        """Release resources held by the plugin"""
+        pass
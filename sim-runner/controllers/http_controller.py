@@ -0,0 +1,109 @@
+"""
+HTTP controller plugin (original sim-runner behaviour)
+
+The init request offers the binary wire formats this process supports
+(see wire.py); step requests use the format the controller accepted,
+JSON otherwise.
+"""
+import threading
+import time
+
+import wire
+from controllers.base import BaseController, ControllerError
+from transport import ServiceTransport
+
+
+class HTTPController(BaseController):
+    """Talks to a controller service via POST /control"""
+
+    # Requests for different loops are independent HTTP calls on the pooled session
+    concurrent_loops = True
+
+    def __init__(self, controller_url, transport=None, wire_formats=None):
+        """
+        Args:
+            controller_url: Full URL of the /control endpoint
+            transport: ServiceTransport to send requests through
+                (a default pooled transport is created if omitted)
+            wire_formats: Formats to offer in the init handshake, in order
+                of preference (default: all supported; ['json'] disables
+                the binary encoding)
+        """
+        super().__init__('http')
+        self.controller_url = controller_url
+        self.transport = transport or ServiceTransport('controller')
+        self.wire_formats = [f for f in (wire_formats or wire.supported_formats()) if f in wire.supported_formats()]
+        self.wire_format = wire.JSON
+        self._stats_lock = threading.Lock()
+        self.reset_wire_stats()
+
+    def reset_wire_stats(self):
+        self.wire_stats = {
+            "requests": 0,
+            "bytes_sent": 0,
+            "bytes_received": 0,
+            "encode_s": 0.0,
+            "decode_s": 0.0,
+        }
+
+    def init(self, control_mode, control_loops):
+        payload = {
+            "init": True,
+            "control_mode": control_mode,
+            "control_loops": control_loops,
+            "wire_formats": self.wire_formats
+        }
+        # The handshake itself is always JSON
+        response = self._post(payload, wire.JSON)
+        accepted = response.get("wire_format", wire.JSON)
+        self.wire_format = accepted if accepted in self.wire_formats else wire.JSON
+        self.reset_wire_stats()
+        print(f"  Wire format: {self.wire_format}")
+        return response
+
+    def step(self, payload):
+        return self._post(payload, self.wire_format)
+
+    def _post(self, payload, fmt):
+        start = time.perf_counter()
+        body = wire.encode(payload, fmt)
+        encode_s = time.perf_counter() - start
+
+        content_type = wire.CONTENT_TYPES[fmt]
+        response = self.transport.post(
+            self.controller_url, data=body,
+            headers={"Content-Type": content_type, "Accept": content_type}
+        )
+        if response.status_code != 200:
+            raise ControllerError(response.status_code, response.text[:200])
+
+        start = time.perf_counter()
+        data = wire.decode(response.content, wire.format_of(response.headers.get("Content-Type")))
+        decode_s = time.perf_counter() - start
+        with self._stats_lock:
+            stats = self.wire_stats
+            stats["encode_s"] += encode_s
+            stats["decode_s"] += decode_s
+            stats["requests"] += 1
+            stats["bytes_sent"] += len(body)
+            stats["bytes_received"] += len(response.content)
+        return data
+
+    def wire_summary(self):
+        """
+        Returns:
+            dict: Wire format, request count, bytes and codec time per request
+        """
+        stats = self.wire_stats
+        n = max(1, stats["requests"])
+        return {
+            "wire_format": self.wire_format,
+            "requests": stats["requests"],
+            "bytes_sent_per_request": stats["bytes_sent"] / n,
+            "bytes_received_per_request": stats["bytes_received"] / n,
+            "encode_ms_per_request": stats["encode_s"] * 1000.0 / n,
+            "decode_ms_per_request": stats["decode_s"] * 1000.0 / n,
+        }
+
+    def close(self):
+        self.transport.close()
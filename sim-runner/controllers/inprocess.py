@@ -0,0 +1,90 @@
+"""
+In-process controller plugin
+
+Loads a controller bank (the same class the controller's Flask app uses)
+straight into the sim-runner process, removing the per-step HTTP round-trip.
+Because the identical code computes the actions, results match the HTTP
+transport exactly as long as the controller does not depend on wall-clock
+time. The PID bank does when pid_params.dt is not set (simple_pid then
+measures dt between calls, which are far closer together in-process); set
+PID_DT_HYDRAULIC_STEP=true to sample every transport at the hydraulic step.
+"""
+import importlib
+import os
+import sys
+
+from controllers.base import BaseController, ControllerError
+
+
+# plugin name -> (service directory, module, class)
+PLUGINS = {
+    'pid': ('controller-pid', 'pid_bank', 'PIDBank'),
+    'mpc': ('controller-mpc', 'mpc_bank', 'MPCBank'),
+    'vla': ('controller-vla', 'vla_bank', 'VLABank'),
+}
+
+# plugin name -> requirements file of sim-runner that provides its dependencies
+PLUGIN_REQUIREMENTS = {
+    'vla': 'requirements-vla.txt (docker-compose build --build-arg INSTALL_VLA=true sim-runner)',
+}
+
+
+def load_bank_class(plugin, plugin_dir):
+    """
+    Import a controller bank class from its service directory
+
+    Args:
+        plugin: Plugin name (key of PLUGINS)
+        plugin_dir: Directory containing controller-pid/, controller-mpc/, ...
+
+    Returns:
+        Bank class
+    """
+    if plugin not in PLUGINS:
+        raise ValueError(f"Unknown controller plugin: {plugin} (available: {list(PLUGINS.keys())})")
+
+    service_dir, module_name, class_name = PLUGINS[plugin]
+    module_dir = os.path.join(plugin_dir, service_dir)
+    if not os.path.isdir(module_dir):
+        raise FileNotFoundError(f"Controller plugin directory not found: {module_dir}")
+
+    if module_dir not in sys.path:
+        sys.path.insert(0, module_dir)
+
+    try:
+        module = importlib.import_module(module_name)
+    except ImportError as e:
+        requirements = PLUGIN_REQUIREMENTS.get(plugin, 'requirements.txt')
+        raise ImportError(
+            f"In-process controller plugin '{plugin}' needs '{e.name}', which is not installed "
+            f"in sim-runner. Install {requirements} or use CONTROLLER_TRANSPORT=http"
+        ) from e
+    return getattr(module, class_name)
+
+
+class InProcessController(BaseController):
+    """Calls a controller bank directly as Python functions"""
+
+    def __init__(self, plugin, plugin_dir):
+        """
+        Args:
+            plugin: 'pid', 'mpc' or 'vla'
+            plugin_dir: Directory containing the controller service sources
+        """
+        super().__init__(plugin)
+        bank_class = load_bank_class(plugin, plugin_dir)
+        self.bank = bank_class()
+        print(f"In-process controller loaded: {bank_class.__name__} ({plugin})")
+
+    def init(self, control_mode, control_loops):
+        return self.bank.init({
+            "init": True,
+            "control_mode": control_mode,
+            "control_loops": control_loops
+        })
+
+    def step(self, payload):
+        try:
+            return self.bank.step(payload)
+        except ValueError as e:
+            raise ControllerError(400, str(e))
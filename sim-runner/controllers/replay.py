@@ -0,0 +1,147 @@
+"""
+Replay controller plugin
+
+Replays a recorded action trace instead of asking a controller, so a past
+experiment can be re-simulated deterministically at raw EPANET speed
+(no controller service, no HTTP).
+
+Accepted traces:
+    result.csv / result.parquet  - recorded runs (NewValveSetting per Step/LoopID;
+                                   VLA runs replay their DeltaAction)
+    schedule CSV                 - columns Step (or Time), LoopID, NewValveSetting
+    schedule JSON                - {"schedule": {"<loop_id>": [setting_step0, setting_step1, ...]}}
+
+Steps missing from the trace hold the current valve setting.
+"""
+import json
+import math
+import os
+
+import pandas as pd
+
+from controllers.base import BaseController, ControllerError
+
+
+def _finite(value):
+    return value is not None and not (isinstance(value, float) and math.isnan(value))
+
+
+def load_trace(trace_path):
+    """
+    Load an action trace into a DataFrame
+
+    Returns:
+        pd.DataFrame with at least LoopID, NewValveSetting and Step or Time
+    """
+    if not os.path.exists(trace_path):
+        raise FileNotFoundError(f"Replay trace not found: {trace_path}")
+
+    ext = os.path.splitext(trace_path)[1].lower()
+    if ext == '.json':
+        with open(trace_path, 'r') as f:
+            schedule = json.load(f).get('schedule', {})
+        rows = [
+            {"Step": step, "LoopID": loop_id, "NewValveSetting": setting}
+            for loop_id, settings in schedule.items()
+            for step, setting in enumerate(settings)
+        ]
+        return pd.DataFrame(rows, columns=["Step", "LoopID", "NewValveSetting"])
+    elif ext == '.parquet':
+        return pd.read_parquet(trace_path)
+    else:
+        # round_trip: replayed settings must equal the recorded floats bit for bit
+        return pd.read_csv(trace_path, float_precision='round_trip')
+
+
+class ReplayController(BaseController):
+    """Returns recorded actions for each (step, loop)"""
+
+    def __init__(self, trace_path):
+        """
+        Args:
+            trace_path: result.csv / result.parquet / schedule file to replay
+        """
+        super().__init__('replay')
+        trace = load_trace(trace_path)
+
+        if 'LoopID' not in trace.columns:
+            raise ValueError(f"Replay trace has no LoopID column: {trace_path}")
+        if 'Step' in trace.columns:
+            self.key_column = 'Step'
+        elif 'Time' in trace.columns:
+            self.key_column = 'Time'
+        else:
+            raise ValueError(f"Replay trace needs a Step or Time column: {trace_path}")
+
+        # VLA runs record relative actions; replaying them reproduces clamping exactly
+        self.controller_type = 'individual' if 'DeltaAction' in trace.columns else 'batch'
+        value_column = 'DeltaAction' if self.controller_type == 'individual' else 'NewValveSetting'
+        if value_column not in trace.columns:
+            raise ValueError(f"Replay trace has no {value_column} column: {trace_path}")
+
+        trace = trace.drop_duplicates(subset=[self.key_column, 'LoopID'], keep='first')
+        keys = zip(trace[self.key_column].astype(int).tolist(), trace['LoopID'].astype(str).tolist())
+        values = trace[value_column].astype(float).tolist()
+        self.actions = dict(zip(keys, values))
+
+        # Recorded PID terms are carried into the replayed result rows
+        self.terms = {}
+        if all(c in trace.columns for c in ('PID_P', 'PID_I', 'PID_D')):
+            keys = zip(trace[self.key_column].astype(int).tolist(), trace['LoopID'].astype(str).tolist())
+            self.terms = dict(zip(keys, trace[['PID_P', 'PID_I', 'PID_D']].astype(float).values.tolist()))
+
+        self.loop_ids = sorted(trace['LoopID'].astype(str).unique().tolist())
+        self.trace_path = trace_path
+        self.misses = 0
+        print(f"Replay trace loaded: {trace_path} ({len(self.actions)} actions, "
+              f"{len(self.loop_ids)} loops, keyed by {self.key_column}, {self.controller_type})")
+
+    def init(self, control_mode, control_loops):
+        missing = [loop['loop_id'] for loop in control_loops if str(loop['loop_id']) not in self.loop_ids]
+        if missing:
+            print(f"[WARNING] Replay trace has no actions for loops {missing}; their valves are held")
+        return {
+            "status": "initialized",
+            "control_mode": control_mode,
+            "num_loops": len(control_loops),
+            "controller_type": self.controller_type
+        }
+
+    def _key(self, payload, sensor):
+        if self.key_column == 'Step':
+            return int(sensor.get('step', payload.get('step', 0)))
+        return int(sensor.get('time_step', payload.get('time_step', 0)))
+
+    def step(self, payload):
+        sensor_data = payload.get('sensor_data')
+        if not isinstance(sensor_data, list) or not sensor_data:
+            raise ControllerError(400, "Replay controller requires sensor_data as a list")
+
+        if self.controller_type == 'individual':
+            sensor = sensor_data[0]
+            delta_action = self.actions.get((self._key(payload, sensor), str(sensor.get('loop_id'))))
+            if not _finite(delta_action):
+                self.misses += 1
+                delta_action = 0.0
+            return {"delta_action": delta_action}
+
+        actions = []
+        for sensor in sensor_data:
+            key = (self._key(payload, sensor), str(sensor.get('loop_id')))
+            setting = self.actions.get(key)
+            if not _finite(setting):
+                self.misses += 1
+                setting = sensor.get('prev_action')
+            p_term, i_term, d_term = self.terms.get(key, (0.0, 0.0, 0.0))
+            actions.append({
+                "loop_id": sensor.get('loop_id'),
+                "action": setting,
+                "p_term": p_term,
+                "i_term": i_term,
+                "d_term": d_term
+            })
+        return {"actions": actions}
+
+    def close(self):
+        if self.misses:
+            print(f"[WARNING] Replay: {self.misses} steps had no recorded action (valve held)")
@@ -0,0 +1,208 @@
+"""
+Simulation fidelity profiles
+
+RL training does not need the hydraulic accuracy of a final evaluation.
+`simulation.profile` in the experiment config selects a named profile
+that is applied through the toolkit before every openHydraulicAnalysis:
+
+    accuracy         convergence limit (sum of flow changes / total flow)
+    max_trials       maximum solver trials per step
+    hydraulic_step   hydraulic time step in seconds (None = simulation.hydraulic_step)
+    status_report    hydraulic status report level 'no' | 'yes' | 'full' (None = INP setting)
+    save_hydraulics  write the hydraulics file every step (EN_SAVE_AND_INIT)
+                     instead of only initializing flows (EN_INITFLOW)
+
+Single options can be overridden with `simulation.profile_options`.
+Without a profile the INP options are used unchanged.
+
+After an episode the valve trajectory of result.csv is replayed
+solver-only with the episode's profile and with the eval profile. Solver
+throughput of both and the pressure/flow deviation of the loops from the
+eval replay are appended to fidelity.csv (FIDELITY_COMPARE_EVERY).
+"""
+import time
+
+import numpy as np
+import pandas as pd
+
+
+PROFILES = {
+    # Reference for final evaluation: tight convergence, everything reported
+    "eval": {
+        "accuracy": 1e-6,
+        "max_trials": 200,
+        "hydraulic_step": None,
+        "status_report": None,
+        "save_hydraulics": True,
+    },
+    # Training: loose convergence, no status report, no hydraulics file
+    "train": {
+        "accuracy": 1e-2,
+        "max_trials": 20,
+        "hydraulic_step": None,
+        "status_report": "no",
+        "save_hydraulics": False,
+    },
+}
+
+
+def resolve_profile(sim_config):
+    """
+    Profile settings of an experiment's simulation section
+
+    Args:
+        sim_config: `simulation` section of the experiment config
+
+    Returns:
+        (name, settings) or (None, None) when no profile is configured
+    """
+    name = sim_config.get('profile')
+    if not name:
+        return None, None
+    if name not in PROFILES:
+        raise ValueError(f"Unknown simulation profile: {name} (available: {sorted(PROFILES)})")
+    settings = dict(PROFILES[name])
+    overrides = sim_config.get('profile_options', {})
+    unknown = set(overrides) - set(settings)
+    if unknown:
+        raise ValueError(f"Unknown profile options: {sorted(unknown)} (available: {sorted(settings)})")
+    settings.update(overrides)
+    return name, settings
+
+
+def apply_profile(epanet_api, settings):
+    """
+    Set the solver and reporting options of a profile (hydraulics must be closed)
+
+    Returns:
+        int: Flag for initializeHydraulicAnalysis
+    """
+    epanet_api.setOptionsAccuracyValue(float(settings["accuracy"]))
+    epanet_api.setOptionsMaxTrials(int(settings["max_trials"]))
+    if settings.get("status_report"):
+        epanet_api.setReportStatus(settings["status_report"])
+    constants = epanet_api.ToolkitConstants
+    return constants.EN_SAVE_AND_INIT if settings["save_hydraulics"] else constants.EN_INITFLOW
+
+
+def _trajectory(result_path, loop_ids):
+    """Recorded times and the valve settings in effect at each (time x loop)"""
+    if str(result_path).endswith('.parquet'):
+        df = pd.read_parquet(result_path)
+    else:
+        df = pd.read_csv(result_path)
+    df["LoopID"] = df["LoopID"].astype(str)
+    valves = df.pivot_table(index="Time", columns="LoopID", values="ValveSetting", aggfunc="last")
+    # Loops without a row at a step (individual controllers) kept their valve
+    valves = valves.reindex(columns=loop_ids).sort_index().ffill().bfill()
+    return valves.index.to_numpy(dtype=np.int64), valves.to_numpy(dtype=float)
+
+
+def replay(network_path, control_loops, times, valves, duration, hydraulic_step, settings):
+    """
+    Solve a recorded valve trajectory with the given profile (solver only)
+
+    At every solve the settings of the latest recorded time <= t are applied.
+    settings=None solves with the INP options (as without a profile).
+
+    Returns:
+        dict: times, pressure, flow (time x loop) and solver seconds
+    """
+    from epyt import epanet
+    from network_io import NetworkIO
+
+    api = epanet(network_path)
+    try:
+        node_idx = [int(np.asarray(api.getNodeIndex(loop['target']['node_id'])).item()) for loop in control_loops]
+        link_idx = [int(np.asarray(api.getLinkIndex(loop['actuator']['link_id'])).item()) for loop in control_loops]
+        io = NetworkIO(api, node_idx, link_idx)
+        api.setTimeSimulationDuration(duration)
+        api.setTimeHydraulicStep(hydraulic_step)
+        init_flag = api.ToolkitConstants.EN_SAVE_AND_INIT
+        if settings is not None:
+            init_flag = apply_profile(api, settings)
+
+        solved_times, pressures, flows = [], [], []
+        solver_seconds = 0.0
+        api.openHydraulicAnalysis()
+        api.initializeHydraulicAnalysis(init_flag)
+        current_time = 0
+        while current_time <= duration:
+            k = np.searchsorted(times, current_time, side='right') - 1
+            io.write_settings(io.link_idx, valves[max(k, 0)])
+            start = time.perf_counter()
+            io.solve()
+            solver_seconds += time.perf_counter() - start
+            pressure, flow = io.read()
+            solved_times.append(current_time)
+            pressures.append(pressure)
+            flows.append(flow)
+            start = time.perf_counter()
+            advanced = io.advance()
+            solver_seconds += time.perf_counter() - start
+            current_time += hydraulic_step
+            if advanced == 0:
+                break
+        api.closeHydraulicAnalysis()
+    finally:
+        api.unload()
+    return {
+        "times": np.asarray(solved_times, dtype=np.int64),
+        "pressure": np.asarray(pressures),
+        "flow": np.asarray(flows),
+        "solver_s": solver_seconds,
+    }
+
+
+def compare_to_eval(network_path, control_loops, result_path, duration, hydraulic_step, name, settings,
+                    eval_hydraulic_step):
+    """
+    Throughput of a profile and its deviation from the eval profile on one episode
+
+    Args:
+        hydraulic_step: Step of the episode (profile)
+        eval_hydraulic_step: Step of the eval replay (the configured simulation.hydraulic_step)
+
+    Returns:
+        dict: One fidelity.csv row
+    """
+    loop_ids = [str(loop['loop_id']) for loop in control_loops]
+    times, valves = _trajectory(result_path, loop_ids)
+    run = replay(network_path, control_loops, times, valves, duration, hydraulic_step, settings)
+    if name == "eval":
+        reference = run
+    else:
+        eval_settings = dict(PROFILES["eval"])
+        reference = replay(network_path, control_loops, times, valves, duration,
+                           eval_settings["hydraulic_step"] or eval_hydraulic_step, eval_settings)
+
+    # Deviation at the times both replays solved
+    common, in_run, in_ref = np.intersect1d(run["times"], reference["times"], return_indices=True)
+    dp = run["pressure"][in_run] - reference["pressure"][in_ref]
+    dq = run["flow"][in_run] - reference["flow"][in_ref]
+    steps = len(run["times"])
+    eval_steps = len(reference["times"])
+    row = {
+        "profile": name,
+        "accuracy": settings["accuracy"],
+        "max_trials": settings["max_trials"],
+        "hydraulic_step": hydraulic_step,
+        "status_report": settings["status_report"] or "inp",
+        "save_hydraulics": settings["save_hydraulics"],
+        "steps": steps,
+        "solver_s": run["solver_s"],
+        "steps_per_s": steps / run["solver_s"] if run["solver_s"] > 0 else 0.0,
+        "eval_steps": eval_steps,
+        "eval_solver_s": reference["solver_s"],
+        "eval_steps_per_s": eval_steps / reference["solver_s"] if reference["solver_s"] > 0 else 0.0,
+        "compared_steps": int(common.size),
+        "pressure_rmse": float(np.sqrt(np.mean(dp ** 2))) if dp.size else 0.0,
+        "pressure_max_abs": float(np.max(np.abs(dp))) if dp.size else 0.0,
+        "flow_rmse": float(np.sqrt(np.mean(dq ** 2))) if dq.size else 0.0,
+        "flow_max_abs": float(np.max(np.abs(dq))) if dq.size else 0.0,
+    }
+    # Simulated time per solver second, so profiles with a different step compare fairly
+    run_rate = duration / run["solver_s"] if run["solver_s"] > 0 else 0.0
+    eval_rate = duration / reference["solver_s"] if reference["solver_s"] > 0 else 0.0
+    row["speedup"] = run_rate / eval_rate if eval_rate > 0 else 0.0
+    return row
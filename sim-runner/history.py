@@ -0,0 +1,119 @@
+"""
+Fixed-capacity per-loop history for image generation
+
+Every channel (pressure, valve setting, flow, error) of every loop is
+kept in one preallocated NumPy ring buffer. Each sample is written twice,
+at `head` and at `head + capacity` of a buffer of length 2 * capacity, so
+the last n samples are always one contiguous slice:
+
+    append()  O(1) per step for all loops (one vectorized write per channel)
+    window()  zero-copy view of the last n samples, oldest first
+
+Memory is bounded by the capacity regardless of episode length.
+"""
+import numpy as np
+
+
+CHANNELS = ("pressure", "valve_setting", "flow", "error")
+
+
+class LoopHistory:
+    """Ring buffers of the last `capacity` samples per loop and channel"""
+
+    def __init__(self, loop_ids, capacity=30, channels=CHANNELS):
+        """
+        Args:
+            loop_ids: Loop IDs in loop position order
+            capacity: Number of samples kept per loop
+            channels: Channel names
+        """
+        self.loop_ids = list(loop_ids)
+        self.capacity = max(1, int(capacity))
+        self.channels = tuple(channels)
+        self._channel_pos = {name: i for i, name in enumerate(self.channels)}
+        self._buffer = np.zeros((len(self.channels), len(self.loop_ids), 2 * self.capacity))
+        self.reset()
+
+    def reset(self):
+        """Forget all samples (start of an episode)"""
+        self._head = 0  # Next write position in [0, capacity)
+        self._count = 0
+
+    def __len__(self):
+        """Number of stored samples per loop (at most capacity)"""
+        return self._count
+
+    def append(self, **values):
+        """
+        Append one sample for every loop
+
+        Args:
+            **values: channel name -> array over all loops
+        """
+        head = self._head
+        for name, value in values.items():
+            row = self._buffer[self._channel_pos[name]]
+            row[:, head] = value
+            row[:, head + self.capacity] = value
+        self._head = (head + 1) % self.capacity
+        self._count = min(self._count + 1, self.capacity)
+
+    def window(self, channel, n=None):
+        """
+        Last n samples of one channel, oldest first
+
+        Args:
+            channel: Channel name
+            n: Number of samples (default: all stored)
+
+        Returns:
+            np.ndarray: View of shape (num_loops, n); valid until the next
+                append() overwrites the oldest samples
+        """
+        n = self._count if n is None else min(int(n), self._count)
+        end = self._head + self.capacity
+        return self._buffer[self._channel_pos[channel], :, end - n:end]
+
+    def loop_window(self, position, n=None):
+        """
+        Returns:
+            dict: channel name -> view of the last n samples of one loop
+        """
+        return {name: self.window(name, n)[position] for name in self.channels}
+
+    def to_snapshot(self):
+        """JSON-serializable copy of the stored samples (see restore())"""
+        return {
+            "loops": {
+                loop_id: {name: window.tolist() for name, window in self.loop_window(i).items()}
+                for i, loop_id in enumerate(self.loop_ids)
+            }
+        }
+
+    def restore(self, history):
+        """
+        Load samples saved by to_snapshot()
+
+        Older snapshots hold flat per-channel lists of the first loop only;
+        those are loaded into the first loop. Loops without saved samples
+        are zero-filled, and only the newest `capacity` samples are kept.
+        """
+        self.reset()
+        if "loops" in history:
+            per_loop = history["loops"]
+        elif self.loop_ids:
+            per_loop = {self.loop_ids[0]: history}
+        else:
+            per_loop = {}
+
+        count = max([len(values) for loop in per_loop.values() for values in loop.values()] or [0])
+        count = min(count, self.capacity)
+        block = np.zeros((len(self.channels), len(self.loop_ids), count))
+        for i, loop_id in enumerate(self.loop_ids):
+            for name, values in per_loop.get(loop_id, {}).items():
+                if name in self._channel_pos and count > 0:
+                    values = np.asarray(values[-count:], dtype=np.float64)
+                    block[self._channel_pos[name], i, count - len(values):] = values
+
+        for k in range(count):
+            self.append(**{name: block[c, :, k] for c, name in enumerate(self.channels)})
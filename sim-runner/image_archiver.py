@@ -0,0 +1,150 @@
+"""
+Background archival of generated images (Redis -> disk)
+
+The simulation thread only enqueues (step, redis_keys). A single worker
+thread owns one pooled Redis client, fetches all images of a step with
+one MGET and writes the PNGs, so disk and Redis latency stay off the
+step loop.
+
+When the queue is full the configured policy applies:
+    block   Wait for the worker (no frame is lost, the step loop slows down)
+    drop    Discard the step and count it
+"""
+import os
+import queue
+import threading
+import time
+
+import redis
+
+
+class ImageArchiver:
+    """Queue-fed worker that copies step images from Redis to disk"""
+
+    POLICIES = ('block', 'drop')
+
+    def __init__(self, redis_url, save_dir, queue_size=64, policy='block'):
+        """
+        Args:
+            redis_url: Redis URL (images are stored by image-generator)
+            save_dir: Destination directory for step_XXXX_<type>.png
+            queue_size: Maximum number of queued steps
+            policy: 'block' (backpressure) or 'drop' when the queue is full
+        """
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown archive policy: {policy} (expected one of {self.POLICIES})")
+
+        self.redis_url = redis_url
+        self.save_dir = save_dir
+        self.policy = policy
+        self.queue = queue.Queue(maxsize=max(1, int(queue_size)))
+        self.redis_client = redis.from_url(redis_url, decode_responses=False)
+
+        # Counters
+        self.enqueued = 0
+        self.dropped = 0
+        self.archived_steps = 0
+        self.images_written = 0
+        self.images_missing = 0
+        self.errors = 0
+        self.backpressure_time = 0.0
+        self._lock = threading.Lock()  # submit() is also called from image pipeline workers
+
+        self._worker = threading.Thread(target=self._run, name='image-archiver', daemon=True)
+        self._worker.start()
+
+    def submit(self, step, redis_keys):
+        """
+        Queue the images of one step for archival
+
+        Args:
+            step: Step number
+            redis_keys: {image_type: redis_key}
+
+        Returns:
+            bool: False if the step was dropped
+        """
+        if not redis_keys:
+            return True
+
+        item = (step, dict(redis_keys))
+        if self.policy == 'drop':
+            try:
+                self.queue.put_nowait(item)
+            except queue.Full:
+                with self._lock:
+                    self.dropped += 1
+                    dropped = self.dropped
+                if dropped == 1 or dropped % 50 == 0:
+                    print(f"  [WARNING] Image archive queue full, dropped {dropped} steps so far")
+                return False
+            with self._lock:
+                self.enqueued += 1
+        else:
+            start = time.perf_counter()
+            self.queue.put(item)
+            with self._lock:
+                self.backpressure_time += time.perf_counter() - start
+                self.enqueued += 1
+        return True
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                self._archive(*item)
+            finally:
+                self.queue.task_done()
+
+    def _archive(self, step, redis_keys):
+        image_types = list(redis_keys.keys())
+        try:
+            blobs = self.redis_client.mget([redis_keys[t] for t in image_types])
+        except Exception as e:
+            self.errors += 1
+            print(f"  [WARNING] Failed to fetch images for step {step}: {e}")
+            return
+
+        saved_count = 0
+        for img_type, img_bytes in zip(image_types, blobs):
+            if not img_bytes:
+                self.images_missing += 1
+                print(f"    [WARNING] Image not found in Redis: {redis_keys[img_type]}")
+                continue
+            filepath = os.path.join(self.save_dir, f"step_{step:04d}_{img_type}.png")
+            try:
+                with open(filepath, 'wb') as f:
+                    f.write(img_bytes)
+                saved_count += 1
+            except Exception as e:
+                self.errors += 1
+                print(f"    [WARNING] Failed to save {img_type}: {e}")
+
+        self.images_written += saved_count
+        self.archived_steps += 1
+        if saved_count > 0:
+            print(f"  💾 Saved {saved_count} images for step {step} to {self.save_dir}")
+
+    def close(self):
+        """Drain the queue and stop the worker"""
+        self.queue.put(None)
+        self._worker.join()
+        self.redis_client.close()
+
+    def summary(self):
+        """
+        Returns:
+            dict: Archival counters
+        """
+        return {
+            "policy": self.policy,
+            "enqueued": self.enqueued,
+            "dropped": self.dropped,
+            "archived_steps": self.archived_steps,
+            "images_written": self.images_written,
+            "images_missing": self.images_missing,
+            "errors": self.errors,
+            "backpressure_time_s": self.backpressure_time,
+        }
@@ -0,0 +1,164 @@
+"""
+Pipelined image generation for sim-runner
+
+Generation requests are handed to a small worker pool instead of being
+sent synchronously inside the step. The main loop keeps solving
+hydraulics and talking to the controller while image-generator renders.
+
+    depth       Maximum number of in-flight requests. When the pipeline
+                is full, submit() blocks on the oldest request
+                (backpressure), so images never lag more than `depth`
+                steps behind the simulation.
+    readiness   wait_ready(step) blocks until the images of a recent
+                enough step are in Redis and returns that step. The VLA
+                controller fetches images for the returned step.
+
+The time the main loop spends blocked, compared with the total render
+time, gives the achieved overlap (1.0 = fully hidden, 0.0 = serial).
+"""
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+class ImagePipeline:
+    """Bounded asynchronous image-generation queue with per-step readiness"""
+
+    def __init__(self, request_fn, depth=1, wait_timeout=10.0):
+        """
+        Args:
+            request_fn: Callable(step, payload) -> bool, True when the
+                images of `step` were stored
+            depth: Maximum in-flight requests (also the staleness bound)
+            wait_timeout: Maximum seconds to block on a single request
+        """
+        self.request_fn = request_fn
+        self.depth = max(1, int(depth))
+        self.wait_timeout = wait_timeout
+        self.executor = ThreadPoolExecutor(max_workers=self.depth, thread_name_prefix='image-gen')
+
+        self.futures = OrderedDict()  # step -> Future (recent steps only)
+        self._lock = threading.Lock()
+
+        # Accounting
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.render_time = 0.0  # Sum of request durations (worker side)
+        self.backpressure_time = 0.0  # Main loop blocked in submit()
+        self.ready_wait_time = 0.0  # Main loop blocked in wait_ready()
+        self.ready_waits = 0
+        self.stale_steps = []  # step - image_step of every wait_ready()
+
+    def _run(self, step, payload):
+        start = time.perf_counter()
+        try:
+            ok = bool(self.request_fn(step, payload))
+        except Exception as e:
+            print(f"  [WARNING] Image pipeline request failed at step {step}: {e}")
+            ok = False
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.render_time += elapsed
+            if ok:
+                self.completed += 1
+            else:
+                self.failed += 1
+        return ok
+
+    def _in_flight(self):
+        return [f for f in self.futures.values() if not f.done()]
+
+    def submit(self, step, payload):
+        """
+        Queue image generation for a step
+
+        Blocks while `depth` requests are still in flight.
+        """
+        in_flight = self._in_flight()
+        if len(in_flight) >= self.depth:
+            start = time.perf_counter()
+            wait(in_flight, timeout=self.wait_timeout, return_when=FIRST_COMPLETED)
+            self.backpressure_time += time.perf_counter() - start
+
+        self.futures[step] = self.executor.submit(self._run, step, payload)
+        self.submitted += 1
+
+        # Only the last `depth` steps can still be requested by wait_ready()
+        while len(self.futures) > self.depth and next(iter(self.futures.values())).done():
+            self.futures.popitem(last=False)
+
+    def wait_ready(self, step):
+        """
+        Block until images no older than `depth - 1` steps are available
+
+        Args:
+            step: Current simulation step
+
+        Returns:
+            int or None: Newest step <= `step` whose images are stored
+                (None if generation failed for the whole window)
+        """
+        oldest_allowed = step - (self.depth - 1)
+        start = time.perf_counter()
+        image_step = None
+
+        # Newest step already done wins; otherwise block on the oldest allowed one
+        for s in range(step, oldest_allowed - 1, -1):
+            future = self.futures.get(s)
+            if future is not None and future.done() and future.result():
+                image_step = s
+                break
+
+        if image_step is None:
+            for s in range(oldest_allowed, step + 1):
+                future = self.futures.get(s)
+                if future is None:
+                    continue
+                try:
+                    if future.result(timeout=self.wait_timeout):
+                        image_step = s
+                        break
+                except Exception:
+                    continue
+            # Waiting may have let newer steps finish as well
+            if image_step is not None:
+                for s in range(step, image_step, -1):
+                    future = self.futures.get(s)
+                    if future is not None and future.done() and future.result():
+                        image_step = s
+                        break
+
+        self.ready_wait_time += time.perf_counter() - start
+        self.ready_waits += 1
+        if image_step is not None:
+            self.stale_steps.append(step - image_step)
+        return image_step
+
+    def close(self):
+        """Wait for outstanding requests and stop the workers"""
+        start = time.perf_counter()
+        self.executor.shutdown(wait=True)
+        self.backpressure_time += time.perf_counter() - start
+
+    def summary(self):
+        """
+        Returns:
+            dict: Counters, blocked times and achieved overlap
+        """
+        blocked = self.backpressure_time + self.ready_wait_time
+        overlap = 1.0 - blocked / self.render_time if self.render_time > 0 else 0.0
+        return {
+            "depth": self.depth,
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "render_time_s": self.render_time,
+            "backpressure_time_s": self.backpressure_time,
+            "ready_wait_time_s": self.ready_wait_time,
+            "blocked_time_s": blocked,
+            "overlap_ratio": max(0.0, min(1.0, overlap)),
+            "mean_staleness_steps": (sum(self.stale_steps) / len(self.stale_steps)) if self.stale_steps else 0.0,
+            "max_staleness_steps": max(self.stale_steps) if self.stale_steps else 0,
+        }
@@ -0,0 +1,175 @@
+"""
+Struct-of-arrays state of the control loops
+
+The control_loops config (nested dicts) is compiled once into typed
+NumPy arrays: sensor node index, actuator link index, targets, setting
+bounds and the current valve setting of every loop. The step loop then
+computes errors, clamps actions and builds result columns with array
+operations over all loops instead of per-loop dict lookups, so the
+bookkeeping cost stays small next to the hydraulic solve even with
+hundreds of loops.
+"""
+import numpy as np
+
+
+def to_floats(values):
+    """Float array from controller-supplied values (non-numeric -> NaN)"""
+    try:
+        return np.asarray(values, dtype=np.float64)
+    except (TypeError, ValueError):
+        out = np.empty(len(values))
+        for i, value in enumerate(values):
+            try:
+                out[i] = float(value)
+            except (TypeError, ValueError):
+                out[i] = np.nan
+        return out
+
+
+class LoopState:
+    """Per-loop arrays indexed by loop position (config order)"""
+
+    def __init__(self, control_loops, node_indices, link_indices, control_mode='pressure'):
+        """
+        Args:
+            control_loops: control_loops section of the experiment config
+            node_indices: EPANET (1-based) sensor node index of each loop
+            link_indices: EPANET (1-based) actuator link index of each loop
+            control_mode: 'pressure' or 'flow' (selects the controlled target)
+        """
+        targets = [loop.get('target', {}) for loop in control_loops]
+        actuators = [loop.get('actuator', {}) for loop in control_loops]
+        absolute_ranges = [
+            loop.get('vla_params', {}).get('action', {}).get('absolute_range', [0.0, 2.0])
+            for loop in control_loops
+        ]
+
+        self.control_mode = control_mode
+        self.loop_ids = np.array([loop['loop_id'] for loop in control_loops], dtype=object)
+        self.node_idx = np.asarray(node_indices, dtype=np.int64)
+        self.link_idx = np.asarray(link_indices, dtype=np.int64)
+
+        # Controlled target (defaults as used by the controllers) ...
+        if control_mode == 'flow':
+            self.target = np.array([t.get('target_flow', 100.0) for t in targets], dtype=np.float64)
+        else:
+            self.target = np.array([t.get('target_pressure', 30.0) for t in targets], dtype=np.float64)
+        # ... and the configured targets as recorded in result.csv (0 = not set)
+        self.target_pressure = np.array([t.get('target_pressure', 0) for t in targets], dtype=np.float64)
+        self.target_flow = np.array([t.get('target_flow', 0) for t in targets], dtype=np.float64)
+
+        # Absolute setting bounds: actuator limits for batch controllers,
+        # vla_params.action.absolute_range for individual (delta) controllers
+        self.actuator_min = np.array([a.get('min_setting', 0.1) for a in actuators], dtype=np.float64)
+        self.actuator_max = np.array([a.get('max_setting', 1.0) for a in actuators], dtype=np.float64)
+        self.absolute_min = np.array([r[0] for r in absolute_ranges], dtype=np.float64)
+        self.absolute_max = np.array([r[1] for r in absolute_ranges], dtype=np.float64)
+
+        self.initial_valve = np.array([a['initial_setting'] for a in actuators], dtype=np.float64)
+        self.current_valve = self.initial_valve.copy()
+
+    def __len__(self):
+        return len(self.loop_ids)
+
+    def reset(self):
+        """Put every valve back to its initial setting (start of an episode)"""
+        self.current_valve = self.initial_valve.copy()
+
+    def measure(self, pressures, flows):
+        """
+        Controlled values and errors of all loops
+
+        Args:
+            pressures: Sensor node pressure per loop
+            flows: Actuator link flow per loop
+
+        Returns:
+            dict of arrays: pressure, flow, controlled, target, error
+        """
+        controlled = flows if self.control_mode == 'flow' else pressures
+        return {
+            "pressure": pressures,
+            "flow": flows,
+            "controlled": controlled,
+            "target": self.target,
+            "error": self.target - controlled,
+        }
+
+    def perturbation(self, fraction, lower, upper):
+        """
+        Signed setting perturbation per loop for sensitivity solves
+
+        Args:
+            fraction: Step as a fraction of the setting range
+            lower, upper: Setting bounds per loop
+
+        Returns:
+            np.ndarray: fraction * (upper - lower), negative where the step would exceed upper
+        """
+        span = upper - lower
+        step = fraction * np.where(span > 0, span, np.maximum(np.abs(self.current_valve), 1.0))
+        return np.where(self.current_valve + step > upper, -step, step)
+
+    def sensor_data(self, measured, step, time_step, sensitivity=None):
+        """
+        Controller payload entries (one dict per loop)
+
+        Args:
+            measured: dict from measure()
+            step: Step number
+            time_step: Simulation time in seconds
+            sensitivity: Optional (loops x loops) d controlled / d setting. Adds
+                "sensitivity" (own valve) and "sensitivity_row" (every loop's valve)
+        """
+        if sensitivity is not None:
+            return [
+                {
+                    "loop_id": loop_id,
+                    "pressure": controlled,
+                    "target": target,
+                    "prev_action": prev_action,
+                    "step": step,
+                    "time_step": time_step,
+                    "sensitivity": row[i],
+                    "sensitivity_row": row
+                }
+                for i, (loop_id, controlled, target, prev_action, row) in enumerate(zip(
+                    self.loop_ids.tolist(), measured["controlled"].tolist(),
+                    self.target.tolist(), self.current_valve.tolist(), sensitivity.tolist()))
+            ]
+        return [
+            {
+                "loop_id": loop_id,
+                "pressure": controlled,
+                "target": target,
+                "prev_action": prev_action,
+                "step": step,
+                "time_step": time_step
+            }
+            for loop_id, controlled, target, prev_action in zip(
+                self.loop_ids.tolist(), measured["controlled"].tolist(),
+                self.target.tolist(), self.current_valve.tolist())
+        ]
+
+    def clamp(self, requested, positions, lower, upper, verbose=True):
+        """
+        Clamp requested settings into [lower, upper]
+
+        Args:
+            requested: Requested settings for the loops at `positions`
+            positions: Loop positions (index array)
+            lower, upper: Bounds for the loops at `positions`
+            verbose: Print a warning per clamped loop
+
+        Returns:
+            np.ndarray: Clamped settings
+        """
+        too_low = requested < lower
+        too_high = ~too_low & (requested > upper)
+        clamped = np.where(too_low, lower, np.where(too_high, upper, requested))
+        if verbose and (too_low.any() or too_high.any()):
+            for j in np.flatnonzero(too_low | too_high).tolist():
+                direction, bound = ("low", lower[j]) if too_low[j] else ("high", upper[j])
+                print(f"[WARNING] Loop {self.loop_ids[positions[j]]}: Valve {requested[j]:.4f} "
+                      f"too {direction}, clamping to {bound}")
+        return clamped
@@ -2,14 +2,39 @@ import os
 import json
 import time
 import shutil
+import threading
+import traceback
 import requests
 import pandas as pd
 from epyt import epanet
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+from controllers import create_controller, ControllerError, with_pid_sample_time
+from transport import LatencyRecorder, ServiceTransport, write_latency_report
+from network_io import NetworkIO
+from network_recorder import NetworkRecorder
+from loop_state import LoopState, to_floats
+from history import LoopHistory
+from result_writer import StreamingResultWriter, columns_for
+from image_pipeline import ImagePipeline
+from image_archiver import ImageArchiver
+from step_timer import StepTimer, NullStepTimer
+from realtime import FALLBACKS, DeadlineCaller, DeadlineRecorder, LocalPID
+from control_schedule import ControlSchedule
+from fidelity import apply_profile, compare_to_eval, resolve_profile
+from skeleton import DEFAULT_MERGE_DEMAND, build_skeleton
+from surrogate import SurrogateModel, SurrogateNetwork, validate_against_epanet
+from snapshot import (SNAPSHOT_VERSION, capture_hydraulics, restore_hydraulics, network_base,
+                      reset_network, save_snapshot, load_snapshot)
+from solve_cache import SolveCache
 
 
 class RemoteValveControlEnv:
-    def __init__(self, config_path, network_dir, controller_url, output_root, exp_id):
+    # ★ NEW: Observation columns of the Gym-style interface (reset() / step())
+    OBS_FIELDS = ("controlled", "target", "error", "valve", "pressure", "flow", "time_of_day")
+    
+    def __init__(self, config_path, network_dir, controller_url, output_root, exp_id, controller=None):
         self.config_path = config_path
         self.controller_url = controller_url
         self.output_root = output_root
@@ -27,11 +52,16 @@ class RemoteValveControlEnv:
             'true'
         ).lower() == 'true'
         
+        # ★ NEW: Replay runs are solver-only (no image-generator, no images)
+        controller_transport = os.environ.get('CONTROLLER_TRANSPORT', 'http').lower()
+        if controller_transport == 'replay':
+            self.enable_image_generation = False
+        
         # ★ NEW: Image saving configuration
         self.save_images = os.environ.get(
             'SAVE_IMAGES',
             'true'
-        ).lower() == 'true'
+        ).lower() == 'true' and controller_transport != 'replay'
         self.image_save_interval = int(os.environ.get(
             'IMAGE_SAVE_INTERVAL',
             '10'  # Save every 10 steps
@@ -48,12 +78,62 @@ class RemoteValveControlEnv:
             print(f"Images will be saved to: {self.image_save_dir}")
             print(f"Save interval: every {self.image_save_interval} steps")
         
+        # ★ NEW: Images are copied Redis -> disk by a background worker (started per episode)
+        self.image_archiver = None
+        self.image_archive_queue_size = int(os.environ.get('IMAGE_ARCHIVE_QUEUE_SIZE', '64'))
+        self.image_archive_policy = os.environ.get('IMAGE_ARCHIVE_POLICY', 'block').lower()
+        
         # Controller type detection (will be set during initialization)
         self.controller_type = None  # 'batch' (PID/MPC) or 'individual' (VLA)
         
         with open(config_path, 'r') as f:
             self.config = json.load(f)
         
+        # ★ NEW: Concurrent per-loop requests of individual controllers (0 = one worker per loop, 1 = sequential)
+        self.loop_dispatch_workers = int(os.environ.get('LOOP_DISPATCH_WORKERS', '0')) or \
+            max(1, len(self.config.get('control_loops', [])))
+        
+        # ★ NEW: Pooled keep-alive transports with latency accounting
+        self.controller_http = ServiceTransport.from_env('controller', 'CONTROLLER', read_timeout=30,
+                                                         pool_size=max(4, self.loop_dispatch_workers))
+        # ★ NEW: Pipelined image generation (0 = synchronous, N = up to N steps in flight)
+        self.image_pipeline_depth = int(os.environ.get('IMAGE_PIPELINE_DEPTH', '0'))
+        # ★ NEW: Loops per /generate_batch request (the read timeout is per loop)
+        self.image_batch_loops = max(1, int(os.environ.get('IMAGE_BATCH_LOOPS', '8')))
+        self._image_stats_lock = threading.Lock()  # pipeline workers update the counts
+        self.image_stats = None  # reset per episode
+        
+        # Image generation is best-effort, so it is not retried by default
+        self.image_generator_http = ServiceTransport.from_env(
+            'image_generator', 'IMAGE_GENERATOR', read_timeout=10, max_retries=0,
+            pool_size=max(4, self.image_pipeline_depth)
+        )
+        
+        self.image_pipeline = None  # started per episode
+        
+        # ★ NEW: Controller plugin (HTTP service, in-process bank or trace replay)
+        if controller is None:
+            controller = create_controller(
+                controller_transport,
+                controller_url,
+                plugin=os.environ.get('CONTROLLER_PLUGIN') or None,
+                plugin_dir=os.environ.get('CONTROLLER_PLUGIN_DIR', '/plugins'),
+                http_transport=self.controller_http,
+                trace_path=os.environ.get('REPLAY_TRACE') or None,
+                # ★ NEW: Wire formats offered in the init handshake (e.g. "json" to disable msgpack)
+                wire_formats=[f.strip() for f in os.environ.get('CONTROLLER_WIRE_FORMATS', '').split(',')
+                              if f.strip()] or None
+            )
+        self.controller = controller
+        print(f"Controller transport: {self.controller.name}")
+        
+        # Plugins that are not safe to call concurrently (in-process banks, replay) stay sequential
+        self.loop_dispatch_pool = None
+        if self.loop_dispatch_workers > 1 and self.controller.concurrent_loops:
+            self.loop_dispatch_pool = ThreadPoolExecutor(max_workers=self.loop_dispatch_workers,
+                                                         thread_name_prefix='loop-dispatch')
+        self.loop_latency = LatencyRecorder('controller_loop')  # reset per episode
+        
         dest_config_path = os.path.join(self.exp_dir, f"{self.exp_id}_config.json")
         shutil.copy(self.config_path, dest_config_path)
         print(f"Config copied to: {dest_config_path}")
@@ -61,7 +141,44 @@ class RemoteValveControlEnv:
         inp_file = self.config.get('network', {}).get('inp_file', 'Net1.inp')
         self.network_path = os.path.join(network_dir, inp_file)
         
+        # ★ NEW: Train on a skeletonized network, evaluate on the full one (see skeleton.py)
+        # SKELETON_NETWORK: skeleton INP (in NETWORK_DIR or absolute), or 'auto' to build <exp_dir>/skeleton.inp
+        # SKELETON_VALIDATE_EVERY: replay every N-th episode on the full network (0 = never)
+        self.full_network_path = self.network_path
+        skeleton_network = os.environ.get('SKELETON_NETWORK')
+        self.skeleton_validate_every = int(os.environ.get('SKELETON_VALIDATE_EVERY', '1'))
+        if skeleton_network and os.environ.get('SURROGATE_MODEL'):
+            raise ValueError("The surrogate does not solve a network; unset SKELETON_NETWORK "
+                             "when using SURROGATE_MODEL")
+        if skeleton_network == 'auto':
+            self.network_path = os.path.join(self.exp_dir, "skeleton.inp")
+            build_skeleton(self.config, self.full_network_path, self.network_path,
+                           float(os.environ.get('SKELETON_MERGE_DEMAND', DEFAULT_MERGE_DEMAND)))
+        elif skeleton_network:
+            self.network_path = os.path.join(network_dir, skeleton_network)
+        self.skeleton_network = self.network_path != self.full_network_path
+        if self.skeleton_network:
+            print(f"Skeleton network: {self.network_path} (evaluated on {self.full_network_path})")
+        
         self.sim_config = self.config['simulation']
+        
+        # ★ NEW: Fidelity profile (simulation.profile: train|eval, see fidelity.py)
+        # FIDELITY_COMPARE_EVERY: compare every N-th episode with the eval profile (0 = never)
+        self.fidelity_profile, self.fidelity_settings = resolve_profile(self.sim_config)
+        self.fidelity_compare_every = int(os.environ.get('FIDELITY_COMPARE_EVERY', '1'))
+        self.configured_hydraulic_step = self.sim_config['hydraulic_step']
+        if self.fidelity_profile is not None and os.environ.get('SURROGATE_MODEL'):
+            print(f"[WARNING] Simulation profile '{self.fidelity_profile}' ignored with SURROGATE_MODEL")
+            self.fidelity_profile, self.fidelity_settings = None, None
+        if self.fidelity_profile is not None:
+            if self.fidelity_settings['hydraulic_step']:
+                self.sim_config = dict(self.sim_config, hydraulic_step=int(self.fidelity_settings['hydraulic_step']))
+            print(f"Simulation profile: {self.fidelity_profile} (accuracy={self.fidelity_settings['accuracy']}, "
+                  f"max trials={self.fidelity_settings['max_trials']}, "
+                  f"hydraulic step={self.sim_config['hydraulic_step']}s, "
+                  f"status report={self.fidelity_settings['status_report'] or 'inp'}, "
+                  f"save hydraulics={self.fidelity_settings['save_hydraulics']})")
+        self.hydraulic_init_flag = None  # set by _open_hydraulics()
         self.control_mode = self.config.get('control_mode', 'pressure')
         self.control_loops = self.config.get('control_loops', [])
         
@@ -75,207 +192,535 @@ class RemoteValveControlEnv:
                 "mpc_params": self.config.get('mpc_params', {})
             }]
         
-        self.results = []
+        # ★ NEW: Control interval / event-triggered calls (default: controller called every step)
+        self.control_schedule = ControlSchedule.from_env(len(self.control_loops))
+        
+        # ★ NEW: Opt-in: PID loops without pid_params.dt sample at the hydraulic step (every transport)
+        # (times the control period, the interval at which the controller is actually called)
+        if os.environ.get('PID_DT_HYDRAULIC_STEP', 'false').lower() == 'true':
+            self.control_loops = with_pid_sample_time(
+                self.control_loops, self.sim_config['hydraulic_step'] * self.control_schedule.period
+            )
+        
+        # ★ NEW: Streaming result writer (created in run() once the controller type is known)
+        self.results = None
+        self.result_flush_interval = int(os.environ.get('RESULT_FLUSH_INTERVAL', '50'))
+        self.result_parquet = os.environ.get('RESULT_PARQUET', 'true').lower() == 'true'
+        
+        # ★ NEW: Per-phase step timing (timings.csv / timings.parquet)
+        self.step_timing = os.environ.get('STEP_TIMING', 'true').lower() == 'true'
+        self.step_timer = NullStepTimer()
+        
+        # ★ NEW: Deadline-paced real-time mode (fixed wall-clock budget per step, 0 = off)
+        # REALTIME_FALLBACK: action when the controller misses the deadline ('hold' or 'pid')
+        self.realtime_budget = float(os.environ.get('REALTIME_STEP_BUDGET_MS', '0')) / 1000.0
+        self.realtime_fallback = os.environ.get('REALTIME_FALLBACK', 'hold').lower()
+        if self.realtime_fallback not in FALLBACKS:
+            raise ValueError(f"Unknown REALTIME_FALLBACK: {self.realtime_fallback} (expected one of {FALLBACKS})")
+        self.deadline_caller = None  # started per episode
+        self.local_pid = None
+        
+        # ★ NEW: Episode counter (several episodes can run on one loaded network)
+        self.episode = 0
         
-        # ★ NEW: History tracking for image generation
-        self.pressure_history = []
-        self.valve_history = []
-        self.flow_history = []
-        self.error_history = []
+        # ★ NEW: Per-loop history for image generation (fixed-capacity ring buffers)
+        self.image_history_length = int(os.environ.get('IMAGE_HISTORY_LENGTH', '30'))
+        self.history = None
+        # Image states of the previous step, sent along so that pipelined
+        # (concurrent) requests do not depend on their arrival order
+        self.image_prev_states = None
         
-        print(f"Loading Network: {self.network_path}")
+        # ★ NEW: Snapshot / restore of the simulation state
+        # SNAPSHOT_TIMES: comma-separated simulation times (s) to save snapshots at
+        # START_FROM_SNAPSHOT: snapshot JSON to start the run from instead of t=0
+        self.snapshot_times = {
+            int(t) for t in os.environ.get('SNAPSHOT_TIMES', '').split(',') if t.strip()
+        }
+        start_snapshot_path = os.environ.get('START_FROM_SNAPSHOT')
+        self.start_snapshot = load_snapshot(start_snapshot_path) if start_snapshot_path else None
+        if self.start_snapshot is not None:
+            print(f"Starting from snapshot: {start_snapshot_path} (t={self.start_snapshot['time']}s)")
+        self.loops = None
+        self.current_time = 0
+        self.step_count = 0
+        self.hydraulic_time = 0
+        self.hydraulic_time_offset = 0
+        
+        # ★ NEW: Learned surrogate instead of EPANET (see surrogate.py)
+        # SURROGATE_VALIDATE_EVERY: replay every N-th surrogate episode on the real network (0 = never)
+        surrogate_path = os.environ.get('SURROGATE_MODEL')
+        self.surrogate = SurrogateModel.load(surrogate_path) if surrogate_path else None
+        self.surrogate_validate_every = int(os.environ.get('SURROGATE_VALIDATE_EVERY', '0'))
+        if self.surrogate is not None and (self.snapshot_times or self.start_snapshot is not None):
+            raise ValueError("Snapshots need the EPANET solver; unset SNAPSHOT_TIMES/START_FROM_SNAPSHOT "
+                             "when using SURROGATE_MODEL")
+        
+        # ★ NEW: Local sensitivity d(controlled)/d(valve) in the sensor payload (perturbation solves)
+        # SENSITIVITY_DELTA: valve perturbation as a fraction of the setting range
+        self.sensitivity = os.environ.get('SENSITIVITY', 'false').lower() == 'true'
+        self.sensitivity_delta = float(os.environ.get('SENSITIVITY_DELTA', '0.01'))
+        if self.surrogate is not None and self.sensitivity:
+            raise ValueError("Sensitivities need a re-solve of the current step; unset SENSITIVITY "
+                             "when using SURROGATE_MODEL")
+        
+        # ★ NEW: Opt-in full-network state recording (see network_recorder.py)
+        self.network_record = os.environ.get('NETWORK_RECORD', 'false').lower() == 'true'
+        self.network_record_chunk_steps = int(os.environ.get('NETWORK_RECORD_CHUNK_STEPS', '64'))
+        self.network_recorder = None  # created per episode
+        if self.surrogate is not None and self.network_record:
+            raise ValueError("The surrogate only models the control loops; unset NETWORK_RECORD "
+                             "when using SURROGATE_MODEL")
+        
+        # ★ NEW: Memoized step solves keyed on (pattern time, valve settings, tank levels) (see solve_cache.py)
+        # SOLVE_CACHE_VALVE_QUANTUM / SOLVE_CACHE_TANK_QUANTUM: key bin widths (setting / length units)
+        # SOLVE_CACHE_VERIFY_EVERY: re-solve every N-th hit to measure the quantization error (0 = never)
+        # SOLVE_CACHE_PATH: persisted entries (default <exp_dir>/solve_cache.npz)
+        self.solve_cache_enabled = os.environ.get('SOLVE_CACHE', 'false').lower() == 'true'
+        self.solve_cache_path = os.environ.get('SOLVE_CACHE_PATH') or os.path.join(self.exp_dir, "solve_cache.npz")
+        if self.solve_cache_enabled:
+            if self.surrogate is not None:
+                raise ValueError("The solve cache memoizes EPANET solves; unset SOLVE_CACHE "
+                                 "when using SURROGATE_MODEL")
+            if self.network_record or self.snapshot_times:
+                raise ValueError("Cached steps do not solve the whole network; unset NETWORK_RECORD/SNAPSHOT_TIMES "
+                                 "when using SOLVE_CACHE")
+        
+        print(f"Loading Network: {self.network_path}" + (f" (surrogate: {surrogate_path})" if self.surrogate else ""))
         print(f"Control Mode: {self.control_mode}")
         print(f"Number of Control Loops: {len(self.control_loops)}")
         print(f"Image Generation: {'Enabled' if self.enable_image_generation else 'Disabled'}")
+        if self.control_schedule.active:
+            print(f"Control schedule: {self.control_schedule.trigger}, period={self.control_schedule.period} steps"
+                  + (f", |error|>{self.control_schedule.error_threshold}, "
+                     f"|d error|>{self.control_schedule.rate_threshold}, max hold={self.control_schedule.max_hold} steps"
+                     if self.control_schedule.trigger == 'event' else ""))
         
+        load_start = time.perf_counter()
         try:
-            self.epanet_api = epanet(self.network_path)
+            if self.surrogate is not None:
+                self.epanet_api = SurrogateNetwork(self.surrogate, self.control_loops)
+            else:
+                self.epanet_api = epanet(self.network_path)
         except Exception as e:
             print(f"Error loading INP file: {self.network_path}")
             print("Please ensure the file exists in shared/networks/")
             raise e
+        self.load_seconds = time.perf_counter() - load_start
+        # Original initial conditions, to reset the network between episodes
+        # (read lazily by the first snapshot restore, which is what modifies them)
+        self._network_base = None
+        self._network_modified = False
+        self._gym_open = False  # hydraulic analysis opened by reset()
+        
+        # ★ NEW: Loop state compiled once into typed arrays (indices, targets, bounds, valves)
+        self.loops = self._compile_loops()
+        # ★ NEW: Per-step toolkit calls through the ctypes binding (TOOLKIT_BINDING=false: epyt wrappers)
+        self.network_io = NetworkIO(self.epanet_api, self.loops.node_idx, self.loops.link_idx,
+                                    direct=os.environ.get('TOOLKIT_BINDING', 'true').lower() == 'true')
+        print(f"Toolkit calls: {'direct (ctypes binding)' if self.network_io.binding is not None else 'epyt'}")
+        self.solve_cache = None
+        if self.solve_cache_enabled:
+            # Cache hits set tank levels, which also changes the initial levels
+            self._network_base = network_base(self.epanet_api)
+            self.solve_cache = SolveCache(
+                self.epanet_api, self.network_io, self.loops,
+                valve_quantum=float(os.environ.get('SOLVE_CACHE_VALVE_QUANTUM', '0.01')),
+                tank_quantum=float(os.environ.get('SOLVE_CACHE_TANK_QUANTUM', '0.01')),
+                max_entries=int(os.environ.get('SOLVE_CACHE_MAX_ENTRIES', '100000')),
+                verify_every=int(os.environ.get('SOLVE_CACHE_VERIFY_EVERY', '20')),
+                meta={"network": os.path.basename(self.network_path),
+                      "hydraulic_step": self.sim_config['hydraulic_step'],
+                      "profile": self.fidelity_profile}
+            )
+            loaded = self.solve_cache.load(self.solve_cache_path) if os.path.exists(self.solve_cache_path) else 0
+            print(f"Solve cache: valve quantum {self.solve_cache.valve_quantum:g}, "
+                  f"tank quantum {self.solve_cache.tank_quantum:g}, max {self.solve_cache.max_entries} entries, "
+                  f"verify every {self.solve_cache.verify_every} hits ({loaded} entries loaded)")
+        # Step solves go through the cache when enabled (same solve/read/advance interface)
+        self.step_solver = self.solve_cache if self.solve_cache is not None else self.network_io
+        if self.sensitivity:
+            print(f"Sensitivity: {len(self.loops) + 2} extra solves per step (delta {self.sensitivity_delta:g} of the setting range)")
+        self.history = LoopHistory(self.loops.loop_ids.tolist(), capacity=self.image_history_length)
+        # Configured target flow shown in the images (image default 100)
+        self.image_target_flow = np.array(
+            [loop.get('target', {}).get('target_flow', 100.0) for loop in self.control_loops], dtype=np.float64
+        )
+        print(f"Sensor reads: {'whole-network bulk' if self.network_io.bulk else 'indexed list'}")
     
-    def _to_float(self, value):
-        if isinstance(value, np.ndarray):
-            if value.ndim == 0:
-                return float(value.item())
-            else:
-                return float(value.flat[0])
-        return float(value)
-    
-    def _save_images_from_redis(self, redis_keys, step_count):
+    def _compile_loops(self):
         """
-        Save images from Redis to disk
-        
-        Args:
-            redis_keys: Dictionary of {image_type: redis_key}
-            step_count: Current step number
+        Resolve the sensor/actuator IDs of every control loop and compile
+        the loop configuration into a LoopState
         """
-        try:
-            import redis
-            from PIL import Image
-            import io
+        # Debug: Network info
+        print("\n=== Network Debug Info ===")
+        print(f"Total Nodes: {self.epanet_api.getNodeCount()}")
+        print(f"Total Links: {self.epanet_api.getLinkCount()}")
+        print(f"Node IDs: {self.epanet_api.getNodeNameID()}")
+        print(f"Link IDs: {self.epanet_api.getLinkNameID()}")
+        print("========================\n")
+        
+        node_indices = []
+        link_indices = []
+        for loop in self.control_loops:
+            node_id = loop['target']['node_id']
+            link_id = loop['actuator']['link_id']
             
-            # Connect to Redis
-            redis_client = redis.from_url(
-                os.environ.get('REDIS_URL', 'redis://redis:6379'),
-                decode_responses=False
-            )
+            print(f"\n=== Loop {loop['loop_id']} ===")
+            print(f"Requested Node ID: {node_id} (type: {type(node_id)})")
+            print(f"Requested Link ID: {link_id} (type: {type(link_id)})")
             
-            saved_count = 0
-            for img_type, redis_key in redis_keys.items():
-                try:
-                    # Get image from Redis
-                    img_bytes = redis_client.get(redis_key)
-                    
-                    if img_bytes:
-                        # Save to disk
-                        filename = f"step_{step_count:04d}_{img_type}.png"
-                        filepath = os.path.join(self.image_save_dir, filename)
-                        
-                        with open(filepath, 'wb') as f:
-                            f.write(img_bytes)
-                        
-                        saved_count += 1
-                    else:
-                        print(f"    [WARNING] Image not found in Redis: {redis_key}")
-                
-                except Exception as e:
-                    print(f"    [WARNING] Failed to save {img_type}: {e}")
+            try:
+                node_idx = self.epanet_api.getNodeIndex(node_id)
+                print(f"Node Index: {node_idx} (type: {type(node_idx)})")
+            except Exception as e:
+                print(f"ERROR getting node index: {e}")
+                raise
+            
+            try:
+                link_idx = self.epanet_api.getLinkIndex(link_id)
+                print(f"Link Index: {link_idx} (type: {type(link_idx)})")
+            except Exception as e:
+                print(f"ERROR getting link index: {e}")
+                raise
+            
+            if isinstance(node_idx, np.ndarray):
+                node_idx = int(node_idx.item())
+            if isinstance(link_idx, np.ndarray):
+                link_idx = int(link_idx.item())
             
-            if saved_count > 0:
-                print(f"  💾 Saved {saved_count} images for step {step_count} to {self.image_save_dir}")
+            node_indices.append(node_idx)
+            link_indices.append(link_idx)
+            print(f"Loop {loop['loop_id']}: Node={node_id} (idx={node_idx}), Link={link_id} (idx={link_idx})")
         
-        except Exception as e:
-            print(f"  [WARNING] Failed to save images: {e}")
+        return LoopState(self.control_loops, node_indices, link_indices, self.control_mode)
+    
+    def set_output(self, exp_id, output_root=None):
+        """
+        Send the outputs of the next episodes to another experiment directory
+        
+        Args:
+            exp_id: New experiment ID (directory name, image keys)
+            output_root: New results root (unchanged if omitted)
+        """
+        if output_root is not None:
+            self.output_root = output_root
+        self.exp_id = exp_id
+        self.exp_dir = os.path.join(self.output_root, self.exp_id)
+        os.makedirs(self.exp_dir, exist_ok=True)
+        shutil.copy(self.config_path, os.path.join(self.exp_dir, f"{self.exp_id}_config.json"))
+    
+    def snapshot(self):
+        """
+        Capture the current simulation state (start of the current step)
+        
+        Returns:
+            dict: JSON-serializable snapshot (see snapshot.py)
+        """
+        return {
+            "version": SNAPSHOT_VERSION,
+            "exp_id": self.exp_id,
+            "inp_file": os.path.basename(self.network_path),
+            "time": self.current_time,
+            "step": self.step_count,
+            "hydraulics": capture_hydraulics(self.epanet_api, self.hydraulic_time),
+            "loops": [
+                {"loop_id": loop_id, "current_valve": current_valve}
+                for loop_id, current_valve in zip(self.loops.loop_ids.tolist(), self.loops.current_valve.tolist())
+            ],
+            "history": self.history.to_snapshot()
+        }
+    
+    def restore(self, snapshot):
+        """
+        Restore a snapshot into the running simulation
+        
+        Hydraulic analysis must be open (as during run()); it is
+        re-initialized at the snapshot time.
+        
+        Args:
+            snapshot: dict from snapshot() / load_snapshot()
+        
+        Returns:
+            (current_time, step_count) to continue the step loop from
+        """
+        if snapshot.get('inp_file') != os.path.basename(self.network_path):
+            raise ValueError(f"Snapshot is for {snapshot.get('inp_file')}, not {os.path.basename(self.network_path)}")
+        saved_loops = {loop['loop_id']: loop for loop in snapshot['loops']}
+        missing = [loop_id for loop_id in self.loops.loop_ids.tolist() if loop_id not in saved_loops]
+        if missing:
+            raise ValueError(f"Snapshot has no state for loops {missing}")
+        
+        self.epanet_api.closeHydraulicAnalysis()
+        self._network_modified = True
+        self._network_base = restore_hydraulics(
+            self.epanet_api, snapshot['hydraulics'], self.sim_config['duration'], base=self._network_base,
+            init_flag=self.hydraulic_init_flag
+        )
+        self.hydraulic_time_offset = snapshot['hydraulics']['time']
+        
+        self.loops.current_valve = np.array(
+            [saved_loops[loop_id]['current_valve'] for loop_id in self.loops.loop_ids.tolist()], dtype=np.float64
+        )
+        # Actuators may be pipes, whose initial setting is not restored by restore_hydraulics()
+        self.network_io.write_settings(self.loops.link_idx, self.loops.current_valve)
+        
+        self.history.restore(snapshot.get('history', {}))
+        
+        self.current_time = snapshot['time']
+        self.step_count = snapshot['step']
+        return self.current_time, self.step_count
     
     def wait_for_controller(self):
         print("Waiting for controller...")
         max_retries = 10
         for i in range(max_retries):
             try:
-                payload = {
-                    "init": True,
-                    "control_mode": self.control_mode,
-                    "control_loops": self.control_loops
-                }
-                response = requests.post(self.controller_url, json=payload, timeout=30)  # ★ INCREASED
-                if response.status_code == 200:
-                    resp_data = response.json()
-                    print(f"Controller connected and initialized.")
-                    print(f"  Response keys: {list(resp_data.keys())}")
-                    print(f"  Initialized {resp_data.get('num_loops', len(self.control_loops))} control loops")
-                    
-                    # Improved controller type detection
-                    if 'controller_type' in resp_data:
-                        self.controller_type = resp_data['controller_type']
-                        print(f"  Detected controller type (explicit): {self.controller_type}")
-                    elif 'episode' in resp_data or 'loop_ids' in resp_data:
+                resp_data = self.controller.init(self.control_mode, self.control_loops)
+                print(f"Controller connected and initialized.")
+                print(f"  Response keys: {list(resp_data.keys())}")
+                print(f"  Initialized {resp_data.get('num_loops', len(self.control_loops))} control loops")
+                
+                # Improved controller type detection
+                if 'controller_type' in resp_data:
+                    self.controller_type = resp_data['controller_type']
+                    print(f"  Detected controller type (explicit): {self.controller_type}")
+                elif 'episode' in resp_data or 'loop_ids' in resp_data:
+                    self.controller_type = 'individual'
+                    print(f"  Detected controller type (VLA indicators): {self.controller_type}")
+                elif 'status' in resp_data and resp_data.get('status') == 'initialized':
+                    if 'vla' in self.controller_url.lower():
                         self.controller_type = 'individual'
-                        print(f"  Detected controller type (VLA indicators): {self.controller_type}")
-                    elif 'status' in resp_data and resp_data.get('status') == 'initialized':
-                        if 'vla' in self.controller_url.lower():
-                            self.controller_type = 'individual'
-                            print(f"  Detected controller type (URL contains 'vla'): {self.controller_type}")
-                        else:
-                            self.controller_type = 'batch'
-                            print(f"  Detected controller type (batch style): {self.controller_type}")
+                        print(f"  Detected controller type (URL contains 'vla'): {self.controller_type}")
                     else:
-                        self.controller_type = 'individual'
-                        print(f"  Detected controller type (default): {self.controller_type}")
-                    
-                    return
+                        self.controller_type = 'batch'
+                        print(f"  Detected controller type (batch style): {self.controller_type}")
+                else:
+                    self.controller_type = 'individual'
+                    print(f"  Detected controller type (default): {self.controller_type}")
+                
+                return
             except requests.exceptions.ConnectionError:
                 print(f"Connection failed, retrying... ({i+1}/{max_retries})")
                 time.sleep(2)
+            except ControllerError as e:
+                print(f"Initialization rejected, retrying... ({i+1}/{max_retries}): {e}")
         raise Exception("Could not connect to controller")
     
-    def _generate_images(self, step_count, current_time, loop_data, loop_measurements):
+    def _generate_images(self, step_count, current_time, measured, positions=None):
         """
-        Generate visualization images via image-generator service
+        Generate visualization images of every loop via image-generator
+        
+        All loops go in one /generate_batch request; image-generator stores
+        the images of each loop under its own Redis key
+        ({exp_id}:step_{step}:{loop_id}:{image_type}).
+        
+        Synchronous by default; with IMAGE_PIPELINE_DEPTH > 0 the request is
+        queued on the image pipeline and this returns immediately.
         
         Args:
             step_count: Current step number
             current_time: Current simulation time
-            loop_data: List of loop information
-            loop_measurements: List of measurements for each loop
+            measured: Per-loop measurement arrays (LoopState.measure())
+            positions: Loop positions to render (default: all loops)
         """
         if not self.enable_image_generation:
             return
         
+        if len(self.loops) == 0 or (positions is not None and len(positions) == 0):
+            return
+        
+        pressures = measured['pressure'].tolist()
+        target_pressures = measured['target'].tolist()
+        flows = measured['flow'].tolist()
+        valves = self.loops.current_valve.tolist()
+        target_flows = self.image_target_flow.tolist()
+        # History windows (last IMAGE_HISTORY_LENGTH steps, including this one)
+        windows = {name: self.history.window(name).tolist() for name in self.history.channels}
+        
+        if self.image_prev_states is None:
+            self.image_prev_states = [None] * len(self.loops)
+        prev_states = self.image_prev_states
+        loop_ids = self.loops.loop_ids.tolist()
+        loops = []
+        for i in (range(len(loop_ids)) if positions is None else positions.tolist()):
+            loop_id = loop_ids[i]
+            loops.append({
+                "loop_id": loop_id,
+                "state": {
+                    "pressure": pressures[i],
+                    "target_pressure": target_pressures[i],
+                    "valve_setting": valves[i],
+                    "flow": flows[i],
+                    "target_flow": target_flows[i],
+                    "upstream_pressure": 150.0,  # Placeholder
+                    "downstream_pressure": pressures[i],
+                    "timestamp": f"{current_time}s"
+                },
+                "history": {name: window[i] for name, window in windows.items()},
+                "prev_state": prev_states[i]
+            })
+            # Loops that are not rendered keep their last rendered state
+            prev_states[i] = loops[-1]["state"]
+        
+        # Request payload
+        payload = {
+            "exp_id": self.exp_id,
+            "step": step_count,
+            "loops": loops
+        }
+        
+        # ★ NEW: Pipelined mode - render while the step continues
+        if self.image_pipeline is not None:
+            self.image_pipeline.submit(step_count, payload)
+        else:
+            self._request_images(step_count, payload)
+    
+    def _request_images(self, step_count, payload):
+        """
+        Send the generation requests of one step to image-generator
+        
+        The loops are split into requests of at most IMAGE_BATCH_LOOPS
+        loops; the read timeout of each request scales with its number of
+        loops (image-generator renders them one after another). Failed
+        loops are counted (see image_generation.csv).
+        
+        Runs on the main thread (synchronous mode) or on an image pipeline
+        worker (pipelined mode).
+        
+        Returns:
+            bool: True if the images of every loop were stored in Redis
+        """
+        loops = payload["loops"]
+        redis_keys = {}  # {loop_id: {image_type: redis_key}}
+        failed_loops = 0
+        for start in range(0, len(loops), self.image_batch_loops):
+            chunk = loops[start:start + self.image_batch_loops]
+            chunk_keys = self._request_image_chunk(step_count, dict(payload, loops=chunk))
+            if chunk_keys is None:
+                failed_loops += len(chunk)
+            else:
+                redis_keys.update(chunk_keys)
+                failed_loops += sum(1 for loop in chunk if not chunk_keys.get(loop["loop_id"]))
+        
+        with self._image_stats_lock:
+            stats = self.image_stats
+            stats["steps"] += 1
+            stats["loops_requested"] += len(loops)
+            stats["loops_failed"] += failed_loops
+            if failed_loops:
+                stats["steps_incomplete"] += 1
+        
+        # Log image generation (only occasionally to avoid spam)
+        if step_count == 0 or step_count % 50 == 0:
+            num_images = sum(len(keys) for keys in redis_keys.values())
+            print(f"  Generated {num_images} images of {len(redis_keys)} loops for step {step_count}")
+            if step_count == 0 and redis_keys:
+                print(f"    Image types: {list(next(iter(redis_keys.values())).keys())}")
+        
+        # ★ NEW: Save images to disk at specified intervals (off the step loop)
+        # Single-loop runs keep the step_XXXX_<type>.png layout; otherwise the loop ID is added
+        if redis_keys and self.image_archiver is not None and (step_count % self.image_save_interval == 0):
+            single_loop = len(self.control_loops) == 1
+            self.image_archiver.submit(step_count, {
+                img_type if single_loop else f"{loop_id}_{img_type}": key
+                for loop_id, keys in redis_keys.items() for img_type, key in keys.items()
+            })
+        return failed_loops == 0
+    
+    def _request_image_chunk(self, step_count, payload):
+        """
+        Send one /generate_batch request
+        
+        Returns:
+            dict or None: {loop_id: {image_type: redis_key}}, None on failure
+        """
+        num_loops = len(payload["loops"])
+        reason = None
         try:
-            # Use first loop for simplicity (can be extended for multi-loop)
-            if len(loop_data) == 0 or len(loop_measurements) == 0:
-                return
-            
-            loop_info = loop_data[0]
-            measurements = loop_measurements[0]
-            loop_config = self.control_loops[0]
-            
-            # Prepare state data
-            state = {
-                "pressure": measurements['measured_pressure'],
-                "target_pressure": measurements['target_value'],
-                "valve_setting": loop_info['current_valve'],
-                "flow": measurements['flow'],
-                "target_flow": loop_config['target'].get('target_flow', 100.0),
-                "upstream_pressure": 150.0,  # Placeholder
-                "downstream_pressure": measurements['measured_pressure'],
-                "timestamp": f"{current_time}s"
-            }
-            
-            # Prepare history data (last 30 steps for better temporal visualization)
-            history = {
-                "pressure": self.pressure_history[-30:] if len(self.pressure_history) > 0 else [measurements['measured_pressure']],
-                "valve_setting": self.valve_history[-30:] if len(self.valve_history) > 0 else [loop_info['current_valve']],
-                "flow": self.flow_history[-30:] if len(self.flow_history) > 0 else [measurements['flow']],
-                "error": self.error_history[-30:] if len(self.error_history) > 0 else [0.0]
-            }
-            
-            # Request payload
-            payload = {
-                "exp_id": self.exp_id,
-                "step": step_count,
-                "state": state,
-                "history": history
-            }
-            
-            # Send request to image-generator
-            response = requests.post(
-                f"{self.image_generator_url}/generate",
+            response = self.image_generator_http.post(
+                f"{self.image_generator_url}/generate_batch",
                 json=payload,
-                timeout=10  # ★ INCREASED from 5 to 10 for image generation
+                read_timeout=self.image_generator_http.read_timeout * num_loops
             )
-            
             if response.status_code == 200:
-                data = response.json()
-                redis_keys = data.get('redis_keys', {})
-                
-                # Log image generation (only occasionally to avoid spam)
-                if step_count == 0 or step_count % 50 == 0:
-                    print(f"  Generated {len(redis_keys)} images for step {step_count}")
-                    if step_count == 0:
-                        print(f"    Image types: {list(redis_keys.keys())}")
-                
-                # ★ NEW: Save images to disk at specified intervals
-                if self.save_images and (step_count % self.image_save_interval == 0):
-                    self._save_images_from_redis(redis_keys, step_count)
-            else:
-                if step_count % 50 == 0:
-                    print(f"  [WARNING] Image generation failed at step {step_count}: status {response.status_code}")
-        
+                return response.json().get('redis_keys', {})
+            reason = f"status {response.status_code}"
         except requests.exceptions.Timeout:
-            if step_count % 50 == 0:
-                print(f"  [WARNING] Image generation timeout at step {step_count}")
+            reason = "timeout"
         except requests.exceptions.ConnectionError:
-            if step_count == 0:
-                print(f"  [WARNING] Cannot connect to image-generator service")
-                print(f"    Make sure image-generator is running at {self.image_generator_url}")
+            reason = f"cannot connect to image-generator at {self.image_generator_url}"
         except Exception as e:
-            if step_count % 50 == 0:
-                print(f"  [WARNING] Error generating images at step {step_count}: {e}")
+            reason = str(e)
+        
+        with self._image_stats_lock:
+            self.image_stats["requests_failed"] += 1
+            failures = self.image_stats["requests_failed"]
+        if failures == 1 or failures % 50 == 0:
+            print(f"  [WARNING] Image generation failed at step {step_count} ({num_loops} loops): {reason} "
+                  f"({failures} failed requests so far)")
+        return None
+    
+    def _start_episode(self):
+        """Reset per-episode state and start the per-episode workers"""
+        self.episode += 1
+        
+        # A snapshot restore changes the network's initial conditions; put them back.
+        # (Only then: the toolkit getters are single precision, so an unconditional
+        # reset would perturb e.g. tank levels in the last digits.)
+        if self._network_modified:
+            reset_network(self.epanet_api, self._network_base)
+            self._network_modified = False
+        
+        self.history.reset()
+        self.control_schedule.reset()
+        self.image_prev_states = None
+        self.image_stats = {"steps": 0, "steps_incomplete": 0, "loops_requested": 0,
+                            "loops_failed": 0, "requests_failed": 0}
+        self.step_timer = StepTimer() if self.step_timing else NullStepTimer()
+        for transport in (self.controller_http, self.image_generator_http):
+            transport.latency = LatencyRecorder(transport.service)
+        self.loop_latency = LatencyRecorder('controller_loop')
+        
+        if self.save_images and self.enable_image_generation:
+            self.image_archiver = ImageArchiver(
+                os.environ.get('REDIS_URL', 'redis://redis:6379'),
+                self.image_save_dir,
+                queue_size=self.image_archive_queue_size,
+                policy=self.image_archive_policy
+            )
+            print(f"Image archive: queue={self.image_archiver.queue.maxsize}, policy={self.image_archiver.policy}")
+        
+        if self.realtime_budget > 0:
+            self.deadline_caller = DeadlineCaller(
+                self.controller, DeadlineRecorder(self.realtime_budget, self.realtime_fallback)
+            )
+            print(f"Real-time mode: {self.realtime_budget * 1000.0:.1f}ms per step, "
+                  f"fallback={self.realtime_fallback}")
+        
+        if self.enable_image_generation and self.image_pipeline_depth > 0:
+            self.image_pipeline = ImagePipeline(
+                self._request_images,
+                depth=self.image_pipeline_depth,
+                wait_timeout=self.image_generator_http.read_timeout
+            )
+            print(f"Image pipeline: depth={self.image_pipeline_depth} (images lag at most "
+                  f"{self.image_pipeline_depth - 1} steps)")
     
     def run(self):
+        """
+        Run one episode
+        
+        Can be called repeatedly: the loaded network is reused and only
+        the hydraulic solver is re-initialized.
+        
+        Returns:
+            dict: Episode summary (setup time, step-loop time, steps, records)
+        """
+        episode_start = time.perf_counter()
+        self._start_episode()
+        print(f"\n=== Episode {self.episode} ({self.exp_id}) ===")
+        
         self.wait_for_controller()
         
         duration = self.sim_config['duration']
@@ -283,57 +728,40 @@ class RemoteValveControlEnv:
         self.epanet_api.setTimeSimulationDuration(duration)
         self.epanet_api.setTimeHydraulicStep(step_size)
         
-        # Debug: Network info
-        print("\n=== Network Debug Info ===")
-        print(f"Total Nodes: {self.epanet_api.getNodeCount()}")
-        print(f"Total Links: {self.epanet_api.getLinkCount()}")
-        print(f"Node IDs: {self.epanet_api.getNodeNameID()}")
-        print(f"Link IDs: {self.epanet_api.getLinkNameID()}")
-        print("========================\n")
+        # ★ NEW: Loop state was compiled at init; only the valves are reset per episode
+        self.loops.reset()
+        self.network_io.write_settings(self.loops.link_idx, self.loops.current_valve)
         
-        loop_data = []
-        for loop in self.control_loops:
-            node_id = loop['target']['node_id']
-            link_id = loop['actuator']['link_id']
-            
-            print(f"\n=== Loop {loop['loop_id']} ===")
-            print(f"Requested Node ID: {node_id} (type: {type(node_id)})")
-            print(f"Requested Link ID: {link_id} (type: {type(link_id)})")
-            
-            try:
-                node_idx = self.epanet_api.getNodeIndex(node_id)
-                print(f"Node Index: {node_idx} (type: {type(node_idx)})")
-            except Exception as e:
-                print(f"ERROR getting node index: {e}")
-                raise
-            
-            try:
-                link_idx = self.epanet_api.getLinkIndex(link_id)
-                print(f"Link Index: {link_idx} (type: {type(link_idx)})")
-            except Exception as e:
-                print(f"ERROR getting link index: {e}")
-                raise
-            
-            current_valve = loop['actuator']['initial_setting']
-            
-            if isinstance(node_idx, np.ndarray):
-                node_idx = int(node_idx.item())
-            if isinstance(link_idx, np.ndarray):
-                link_idx = int(link_idx.item())
-            
-            print(f"Final Node Index: {node_idx}")
-            print(f"Final Link Index: {link_idx}")
-            
-            self.epanet_api.setLinkSettings(link_idx, current_valve)
-            
-            loop_data.append({
-                "loop_id": loop['loop_id'],
-                "node_idx": node_idx,
-                "link_idx": link_idx,
-                "current_valve": current_valve
-            })
-            
-            print(f"Loop {loop['loop_id']}: Node={node_id} (idx={node_idx}), Link={link_id} (idx={link_idx})")
+        # ★ NEW: Local fallback controller for deadline misses (real-time mode)
+        self.local_pid = None
+        if self.deadline_caller is not None and self.realtime_fallback == 'pid':
+            if self.controller_type == 'batch':
+                bounds = (self.loops.actuator_min, self.loops.actuator_max)
+            else:
+                bounds = (self.loops.absolute_min, self.loops.absolute_max)
+            self.local_pid = LocalPID(self.control_loops, self.control_mode, *bounds, sample_time=step_size)
+        
+        # ★ NEW: Preallocated column buffers, flushed every RESULT_FLUSH_INTERVAL steps
+        self.results = StreamingResultWriter(
+            self.exp_dir,
+            columns_for(self.controller_type, schedule=self.control_schedule.active),
+            rows_per_step=len(self.loops),
+            flush_interval=self.result_flush_interval,
+            write_parquet=self.result_parquet
+        )
+        print(f"Result flush interval: every {self.result_flush_interval} steps "
+              f"({'parquet + csv' if self.results.write_parquet else 'csv only'})")
+        
+        if self.network_record:
+            self.network_recorder = NetworkRecorder(
+                os.path.join(self.exp_dir, "network_state"),
+                self.epanet_api.getNodeNameID(),
+                self.epanet_api.getLinkNameID(),
+                duration // step_size + 1,
+                chunk_steps=self.network_record_chunk_steps
+            )
+            print(f"Network state recording: {len(self.network_recorder.node_ids)} nodes, "
+                  f"{len(self.network_recorder.link_ids)} links, {self.network_recorder.chunk_steps} steps per chunk")
         
         print(f"\nStarting Simulation Loop for Experiment: {self.exp_id}...")
         print(f"  Duration: {duration}s")
@@ -341,65 +769,104 @@ class RemoteValveControlEnv:
         print(f"  Expected steps: {duration // step_size}")
         print(f"  Controller type: {self.controller_type}")
         
-        self.epanet_api.openHydraulicAnalysis()
-        self.epanet_api.initializeHydraulicAnalysis()
+        self.hydraulic_time_offset = 0
+        
+        # Re-initialize flows too, so later episodes do not start from the previous episode's flows
+        self._open_hydraulics()
         current_time = 0
         step_count = 0
         
+        # ★ NEW: Resume from a snapshot instead of re-simulating from t=0
+        if self.start_snapshot is not None:
+            current_time, step_count = self.restore(self.start_snapshot)
+            print(f"Restored snapshot: t={current_time}s, step={step_count}")
+        if self.solve_cache is not None:
+            self.solve_cache.start_episode()
+        
+        loop_start = time.perf_counter()
+        first_step = step_count
+        # ★ NEW: Everything before the first step (controller init, network setup, restore)
+        setup_seconds = loop_start - episode_start
+        print(f"Episode setup: {setup_seconds:.3f}s"
+              + (f" (+ network load {self.load_seconds:.3f}s)" if self.episode == 1 else ""))
+        
+        timer = self.step_timer
+        
         while current_time <= duration:
-            t = self.epanet_api.runHydraulicAnalysis()
+            timer.start_step(step_count, current_time)
+            step_deadline = time.perf_counter() + self.realtime_budget
+            t = self.step_solver.solve()
+            timer.lap("hydraulics")
+            self.current_time, self.step_count = current_time, step_count
+            self.hydraulic_time = self.hydraulic_time_offset + int(t)
             
-            sensor_data = []
-            loop_measurements = []
+            # ★ NEW: Save snapshots at the requested times
+            if current_time in self.snapshot_times:
+                snapshot_path = os.path.join(self.exp_dir, "snapshots", f"t_{current_time:06d}.json")
+                save_snapshot(self.snapshot(), snapshot_path)
+                print(f"  Snapshot saved: {snapshot_path}")
             
-            for i, loop_info in enumerate(loop_data):
-                loop_config = self.control_loops[i]
-                
-                try:
-                    measured_pressure = self._to_float(self.epanet_api.getNodePressure(loop_info['node_idx']))
-                except Exception as e:
-                    print(f"ERROR: getNodePressure failed for node_idx={loop_info['node_idx']}: {e}")
-                    raise
-                
-                try:
-                    flow = self._to_float(self.epanet_api.getLinkFlows(loop_info['link_idx']))
-                except Exception as e:
-                    print(f"ERROR: getLinkFlows failed for link_idx={loop_info['link_idx']}: {e}")
-                    raise
-                
-                if self.control_mode == 'flow':
-                    controlled_value = flow
-                    target_value = loop_config['target'].get('target_flow', 100.0)
+            timer.lap("bookkeeping")
+            
+            # ★ NEW: One network read per step, fancy-indexed per loop
+            try:
+                loop_pressures, loop_flows = self.step_solver.read()
+            except Exception as e:
+                print(f"ERROR: sensor read failed for node_idx={self.network_io.node_idx.tolist()}, "
+                      f"link_idx={self.network_io.link_idx.tolist()}: {e}")
+                raise
+            if self.network_recorder is not None:
+                recorder = self.network_recorder
+                recorder.append(current_time, self.network_io.read_state(recorder.node_fields, recorder.link_fields))
+            timer.lap("sensors")
+            
+            # ★ NEW: Controlled values and errors of all loops at once
+            loops = self.loops
+            measured = loops.measure(loop_pressures, loop_flows)
+            sensitivity = None
+            if self.sensitivity:
+                if self.controller_type == 'batch':
+                    lower, upper = loops.actuator_min, loops.actuator_max
                 else:
-                    controlled_value = measured_pressure
-                    target_value = loop_config['target'].get('target_pressure', 30.0)
-                
-                sensor_data.append({
-                    "loop_id": loop_info['loop_id'],
-                    "pressure": controlled_value,
-                    "target": target_value,
-                    "prev_action": loop_info['current_valve'],
-                    "step": step_count,
-                    "time_step": current_time
-                })
-                
-                loop_measurements.append({
-                    "measured_pressure": measured_pressure,
-                    "flow": flow,
-                    "controlled_value": controlled_value,
-                    "target_value": target_value
-                })
-                
-                # ★ NEW: Update history (for first loop only, can be extended)
-                if i == 0:
-                    self.pressure_history.append(measured_pressure)
-                    self.valve_history.append(loop_info['current_valve'])
-                    self.flow_history.append(flow)
-                    self.error_history.append(target_value - controlled_value)
+                    lower, upper = loops.absolute_min, loops.absolute_max
+                d_pressure, d_flow = self.network_io.sensitivity(
+                    loops.current_valve, loops.perturbation(self.sensitivity_delta, lower, upper)
+                )
+                sensitivity = d_flow if self.control_mode == 'flow' else d_pressure
+                timer.lap("sensitivity")
+            sensor_data = loops.sensor_data(measured, step_count, current_time, sensitivity)
+            
+            # Valve settings applied in a single bulk write before advancing
+            pending_links = loops.link_idx[:0]
+            pending_settings = loops.current_valve[:0]
+            
+            # ★ NEW: The fallback PID runs every step so it can take over bumplessly
+            if self.local_pid is not None:
+                fallback = self.local_pid.update(measured['controlled'], loops.target)
+            
+            # ★ NEW: Update the history of every loop (one ring-buffer write per channel)
+            self.history.append(
+                pressure=measured['pressure'], valve_setting=loops.current_valve,
+                flow=measured['flow'], error=measured['error']
+            )
+            
+            # ★ NEW: Control schedule - loops that are not due hold their valve (no call, no images)
+            # Batch controllers answer for all loops at once, so they are called when any loop is due
+            called = None
+            if self.control_schedule.active:
+                called = self.control_schedule.due(measured['error'])
+                if self.controller_type == 'batch':
+                    called = np.full(len(loops), called.any())
+                self.control_schedule.mark_called(called)
+            
+            timer.lap("bookkeeping")
             
             # ★ NEW: Generate images BEFORE sending control request
             # This ensures VLA controller has fresh images available
-            self._generate_images(step_count, current_time, loop_data, loop_measurements)
+            # (pipelined mode: only queued here, see wait_ready() below)
+            self._generate_images(step_count, current_time, measured,
+                                  None if called is None else np.flatnonzero(called))
+            timer.lap("images")
             
             # Send requests based on controller type
             if self.controller_type == 'batch':
@@ -412,58 +879,64 @@ class RemoteValveControlEnv:
                 }
                 
                 try:
-                    response = requests.post(self.controller_url, json=payload, timeout=30)  # ★ INCREASED from 5 to 30
+                    if called is not None and not called.any():
+                        # ★ NEW: Not due - hold every valve without calling the controller
+                        response_data = self._fallback_actions(None)
+                        remote = False
+                    elif self.deadline_caller is not None:
+                        # ★ NEW: Real-time mode - no reply by the deadline means fallback actions
+                        response_data = self.deadline_caller.call(
+                            payload, step_deadline, step_count, current_time, loops.loop_ids.tolist()
+                        )
+                        remote = response_data is not None
+                        if not remote:
+                            response_data = self._fallback_actions(fallback if self.local_pid is not None else None)
+                    else:
+                        try:
+                            response_data = self.controller.step(payload)
+                        except ControllerError as e:
+                            print(f"[WARNING] Controller returned status {e.status_code}")
+                            timer.lap("controller")
+                            continue
+                        remote = True
                     
-                    if response.status_code != 200:
-                        print(f"[WARNING] Controller returned status {response.status_code}")
-                        continue
+                    # Actions are matched to loops by position
+                    actions = response_data.get("actions", [])[:len(loops)]
+                    k = len(actions)
+                    positions = np.arange(k)
+                    held = loops.current_valve[:k]
                     
-                    response_data = response.json()
-                    actions = response_data.get("actions", [])
+                    # Non-numeric actions hold the current setting
+                    requested = to_floats([a.get("action", v) for a, v in zip(actions, held.tolist())])
+                    requested = np.where(np.isfinite(requested), requested, held)
+                    new_valves = loops.clamp(requested, positions, loops.actuator_min[:k], loops.actuator_max[:k])
                     
-                    for i, action_data in enumerate(actions):
-                        if i >= len(loop_data):
-                            break
-                        
-                        loop_info = loop_data[i]
-                        loop_config = self.control_loops[i]
-                        measurements = loop_measurements[i]
-                        
-                        new_valve = action_data.get("action", loop_info['current_valve'])
-                        
-                        action_config = loop_config.get('actuator', {})
-                        min_valve = action_config.get('min_setting', 0.1)
-                        max_valve = action_config.get('max_setting', 1.0)
-                        
-                        if new_valve < min_valve:
-                            print(f"[WARNING] Loop {loop_info['loop_id']}: Valve {new_valve:.4f} too low, clamping to {min_valve}")
-                            new_valve = min_valve
-                        elif new_valve > max_valve:
-                            print(f"[WARNING] Loop {loop_info['loop_id']}: Valve {new_valve:.4f} too high, clamping to {max_valve}")
-                            new_valve = max_valve
-                        
-                        self.epanet_api.setLinkSettings(loop_info['link_idx'], new_valve)
-                        
-                        self.results.append({
-                            "Time": current_time,
-                            "Step": step_count,
-                            "LoopID": loop_info['loop_id'],
-                            "Pressure": measurements['measured_pressure'],
-                            "Flow": measurements['flow'],
-                            "ControlMode": self.control_mode,
-                            "ControlledValue": measurements['controlled_value'],
-                            "TargetValue": measurements['target_value'],
-                            "TargetPressure": loop_config['target'].get('target_pressure', 0),
-                            "TargetFlow": loop_config['target'].get('target_flow', 0),
-                            "ValveSetting": loop_info['current_valve'],
-                            "NewValveSetting": new_valve,
-                            "PID_P": action_data.get("p_term", 0),
-                            "PID_I": action_data.get("i_term", 0),
-                            "PID_D": action_data.get("d_term", 0),
-                            "Error": action_data.get("error", measurements['target_value'] - measurements['controlled_value'])
-                        })
-                        
-                        loop_info['current_valve'] = new_valve
+                    self.results.append_block({
+                        "Time": current_time,
+                        "Step": step_count,
+                        "LoopID": loops.loop_ids[:k],
+                        "Pressure": measured['pressure'][:k],
+                        "Flow": measured['flow'][:k],
+                        "ControlMode": self.control_mode,
+                        "ControlledValue": measured['controlled'][:k],
+                        "TargetValue": measured['target'][:k],
+                        "TargetPressure": loops.target_pressure[:k],
+                        "TargetFlow": loops.target_flow[:k],
+                        "ValveSetting": held,
+                        "NewValveSetting": new_valves,
+                        "PID_P": [a.get("p_term", 0) for a in actions],
+                        "PID_I": [a.get("i_term", 0) for a in actions],
+                        "PID_D": [a.get("d_term", 0) for a in actions],
+                        "Error": [a.get("error", e) for a, e in zip(actions, measured['error'][:k].tolist())],
+                        "ControllerCalled": 1 if called is None else called[:k],
+                        "SkippedCalls": self.control_schedule.skipped[:k]
+                    }, k)
+                    
+                    pending_links = loops.link_idx[:k]
+                    pending_settings = new_valves
+                    loops.current_valve[:k] = new_valves
+                    if remote and self.local_pid is not None:
+                        self.local_pid.track(positions, new_valves)
                     
                 except Exception as e:
                     print(f"Error communicating with controller: {e}")
@@ -471,119 +944,513 @@ class RemoteValveControlEnv:
                     traceback.print_exc()
                     
             else:
+                # ★ NEW: Pipelined mode - wait for the readiness of a recent enough image step
+                image_step = None
+                if self.image_pipeline is not None and (called is None or called.any()):
+                    image_step = self.image_pipeline.wait_ready(step_count)
+                    if image_step is None:
+                        image_step = step_count
+                
+                # Relative actions of the loops that answered (NaN = no usable answer)
+                delta_actions = np.full(len(loops), np.nan)
+                remote = np.zeros(len(loops), dtype=bool)
+                
                 # VLA style: Send individual requests for each loop
-                for i, loop_info in enumerate(loop_data):
-                    loop_config = self.control_loops[i]
-                    measurements = loop_measurements[i]
-                    sensor = sensor_data[i]
-                    
+                # ★ NEW: Payloads are built first and sent concurrently (LOOP_DISPATCH_WORKERS);
+                # responses are applied in loop order, so logs and results do not depend on timing
+                requests_due = []
+                for i, sensor in enumerate(sensor_data):
+                    loop_id = sensor['loop_id']
+                    if called is not None and not called[i]:
+                        delta_actions[i] = 0.0  # ★ NEW: Not due - hold the valve
+                        continue
                     payload = {
                         "exp_id": self.exp_id,  # ★ ADD: for image fetching
                         "step": step_count,      # ★ ADD: for image fetching
                         "time_step": current_time,
                         "sensor_data": [sensor]
                     }
+                    if image_step is not None:
+                        payload["image_step"] = image_step
                     
                     if step_count == 0:
-                        print(f"\n[DEBUG] VLA payload for loop {loop_info['loop_id']}: {payload}")
-                    
+                        print(f"\n[DEBUG] VLA payload for loop {loop_id}: {payload}")
+                    requests_due.append((i, loop_id, payload))
+                
+                outcomes = self._dispatch_loops(requests_due, step_deadline, step_count, current_time)
+                for (i, loop_id, _), (response_data, error) in zip(requests_due, outcomes):
                     try:
-                        response = requests.post(self.controller_url, json=payload, timeout=30)  # ★ INCREASED from 5 to 30
-                        
-                        if response.status_code != 200:
-                            print(f"[WARNING] Controller returned status {response.status_code}")
-                            continue
-                        
-                        response_data = response.json()
+                        if error is not None:
+                            raise error
+                        if response_data is None:
+                            # ★ NEW: Real-time mode - fallback delta for a missed deadline
+                            response_data = {"delta_action": (
+                                fallback[0][i] - loops.current_valve[i] if self.local_pid is not None else 0.0
+                            )}
+                        else:
+                            remote[i] = True
                         
                         if step_count == 0:
                             print(f"[DEBUG] VLA response: {response_data}")
                         
                         if "delta_action" in response_data:
-                            delta_action = response_data.get("delta_action", 0.0)
-                            new_valve = loop_info['current_valve'] + delta_action
-                            
-                            action_config = loop_config.get('vla_params', {}).get('action', {})
-                            min_valve = action_config.get('absolute_range', [0.0, 2.0])[0]
-                            max_valve = action_config.get('absolute_range', [0.0, 2.0])[1]
-                            
-                            if new_valve < min_valve:
-                                if step_count % 10 == 0:
-                                    print(f"[WARNING] Loop {loop_info['loop_id']}: Valve {new_valve:.4f} too low, clamping to {min_valve}")
-                                new_valve = min_valve
-                            elif new_valve > max_valve:
-                                if step_count % 10 == 0:
-                                    print(f"[WARNING] Loop {loop_info['loop_id']}: Valve {new_valve:.4f} too high, clamping to {max_valve}")
-                                new_valve = max_valve
-                            
-                            self.epanet_api.setLinkSettings(loop_info['link_idx'], new_valve)
-                            
-                            self.results.append({
-                                "Time": current_time,
-                                "Step": step_count,
-                                "LoopID": loop_info['loop_id'],
-                                "Pressure": measurements['measured_pressure'],
-                                "Flow": measurements['flow'],
-                                "ControlMode": self.control_mode,
-                                "ControlledValue": measurements['controlled_value'],
-                                "TargetValue": measurements['target_value'],
-                                "TargetPressure": loop_config['target'].get('target_pressure', 0),
-                                "TargetFlow": loop_config['target'].get('target_flow', 0),
-                                "ValveSetting": loop_info['current_valve'],
-                                "DeltaAction": delta_action,
-                                "NewValveSetting": new_valve,
-                                "Error": measurements['target_value'] - measurements['controlled_value']
-                            })
-                            
-                            loop_info['current_valve'] = new_valve
-                            
-                            if step_count == 0:
-                                print(f"[DEBUG] Recorded data for step {step_count}, loop {loop_info['loop_id']}")
-                            
+                            delta_actions[i] = to_floats([response_data.get("delta_action", 0.0)])[0]
+                            if not np.isfinite(delta_actions[i]):
+                                print(f"[WARNING] Loop {loop_id}: non-numeric delta_action "
+                                      f"{response_data.get('delta_action')!r}, valve held")
+                            elif step_count == 0:
+                                print(f"[DEBUG] Recorded data for step {step_count}, loop {loop_id}")
                         else:
                             print(f"[WARNING] Unexpected response format from controller: {response_data.keys()}")
-                            
+                    
+                    except ControllerError as e:
+                        print(f"[WARNING] Controller returned status {e.status_code}")
                     except Exception as e:
                         print(f"Error communicating with controller at step {step_count}: {e}")
-                        import traceback
                         traceback.print_exc()
+                
+                # ★ NEW: Clamp and record all answered loops at once
+                positions = np.flatnonzero(np.isfinite(delta_actions))
+                if positions.size > 0:
+                    held = loops.current_valve[positions]
+                    new_valves = loops.clamp(
+                        held + delta_actions[positions], positions,
+                        loops.absolute_min[positions], loops.absolute_max[positions],
+                        verbose=step_count % 10 == 0
+                    )
+                    
+                    self.results.append_block({
+                        "Time": current_time,
+                        "Step": step_count,
+                        "LoopID": loops.loop_ids[positions],
+                        "Pressure": measured['pressure'][positions],
+                        "Flow": measured['flow'][positions],
+                        "ControlMode": self.control_mode,
+                        "ControlledValue": measured['controlled'][positions],
+                        "TargetValue": measured['target'][positions],
+                        "TargetPressure": loops.target_pressure[positions],
+                        "TargetFlow": loops.target_flow[positions],
+                        "ValveSetting": held,
+                        "DeltaAction": delta_actions[positions],
+                        "NewValveSetting": new_valves,
+                        "Error": measured['error'][positions],
+                        "ControllerCalled": 1 if called is None else called[positions],
+                        "SkippedCalls": self.control_schedule.skipped[positions]
+                    }, positions.size)
+                    
+                    pending_links = loops.link_idx[positions]
+                    pending_settings = new_valves
+                    loops.current_valve[positions] = new_valves
+                    if self.local_pid is not None:
+                        tracked = remote[positions]
+                        self.local_pid.track(positions[tracked], new_valves[tracked])
             
-            step_advanced = self.epanet_api.nextHydraulicAnalysisStep()
+            timer.lap("controller")
+            
+            self.network_io.write_settings(pending_links, pending_settings)
+            timer.lap("actuation")
+            
+            step_advanced = self.step_solver.advance()
+            timer.lap("advance")
             current_time += step_size
             step_count += 1
             
             if step_count % 10 == 0:
                 print(f"  Step {step_count}/{duration // step_size} completed (t={current_time}s, recorded={len(self.results)})")
+            timer.lap("bookkeeping")
+            
+            # ★ NEW: Real-time mode - pace steps at the wall-clock budget
+            if self.deadline_caller is not None:
+                remaining = step_deadline - time.perf_counter()
+                if remaining > 0:
+                    time.sleep(remaining)
+                else:
+                    self.deadline_caller.recorder.step_overruns += 1
+                timer.lap("pacing")
             
             if step_advanced == 0:
                 print(f"[INFO] EPANET simulation completed at step {step_count}")
                 break
         
         self.epanet_api.closeHydraulicAnalysis()
+        if self.solve_cache is not None:
+            self._finish_solve_cache()
+        
+        # ★ NEW: Step-loop throughput (replay mode gives the solver-only baseline)
+        loop_seconds = time.perf_counter() - loop_start
+        steps_run = step_count - first_step
+        print(f"Step loop: {steps_run} steps in {loop_seconds:.3f}s "
+              f"({steps_run / loop_seconds if loop_seconds > 0 else 0.0:.1f} steps/s, controller={self.controller.name})")
+        
+        if self.image_pipeline is not None:
+            self.image_pipeline.close()
+        if self.image_archiver is not None:
+            self.image_archiver.close()
+        if self.deadline_caller is not None:
+            self.deadline_caller.close()
+        if self.network_recorder is not None:
+            state_path = self.network_recorder.close()
+            record = self.network_recorder.summary()
+            print(f"Network state saved to {state_path}: {record['steps']} steps in {record['chunks']} chunks, "
+                  f"{record['bytes'] / 1e6:.2f}MB (compression {record['compression_ratio']:.1f}x)")
         
         print(f"\n[DEBUG] Total results before save: {len(self.results)}")
         if len(self.results) > 0:
-            print(f"[DEBUG] First result: {self.results[0]}")
-            print(f"[DEBUG] Last result: {self.results[-1]}")
+            print(f"[DEBUG] First result: {self.results.first_row}")
+            print(f"[DEBUG] Last result: {self.results.last_row}")
         
         self.save_results()
+        
+        # ★ NEW: Periodic check of the surrogate against EPANET on this episode's valve trajectory
+        if (self.surrogate is not None and self.surrogate_validate_every > 0
+                and self.episode % self.surrogate_validate_every == 0 and len(self.results) > 0):
+            self._validate_surrogate(duration, step_size)
+        
+        # ★ NEW: Skeleton episodes replayed on the full network
+        if (self.skeleton_network and self.skeleton_validate_every > 0
+                and self.episode % self.skeleton_validate_every == 0 and len(self.results) > 0):
+            self._validate_skeleton(duration, step_size)
+        
+        # ★ NEW: Speed/accuracy of the fidelity profile against the eval profile
+        if (self.fidelity_profile is not None and self.fidelity_compare_every > 0
+                and self.episode % self.fidelity_compare_every == 0 and len(self.results) > 0):
+            self._compare_fidelity(duration, step_size)
+        
+        # ★ NEW: One row per episode in episodes.csv
+        episode_summary = {
+            "episode": self.episode,
+            "load_s": self.load_seconds if self.episode == 1 else 0.0,
+            "setup_s": setup_seconds,
+            "loop_s": loop_seconds,
+            "steps": steps_run,
+            "records": len(self.results)
+        }
+        if self.fidelity_profile is not None:
+            episode_summary["profile"] = self.fidelity_profile
+        if self.control_schedule.active:
+            episode_summary["controller_calls"] = int(self.control_schedule.calls.sum())
+            episode_summary["skipped_calls"] = int(self.control_schedule.skipped.sum())
+        episodes_path = os.path.join(self.exp_dir, "episodes.csv")
+        pd.DataFrame([episode_summary]).to_csv(
+            episodes_path, mode='a', header=not os.path.exists(episodes_path), index=False
+        )
+        self.image_pipeline = None
+        self.image_archiver = None
+        self.deadline_caller = None
+        self.network_recorder = None
+        
         print(f"Simulation {self.exp_id} Completed.")
+        return episode_summary
     
-    def save_results(self):
-        filename = f"result.csv"
-        output_path = os.path.join(self.exp_dir, filename)
+    def reset(self):
+        """
+        Start an episode driven by step() instead of run()
+        
+        The caller acts in place of a controller: no controller calls,
+        images or result files. The first hydraulic solve (t=0) is done
+        here, as at the top of the run() step loop.
+        
+        Returns:
+            np.ndarray: Observation, shape (loops, len(OBS_FIELDS))
+        """
+        if self._gym_open:
+            self.epanet_api.closeHydraulicAnalysis()
+        if self.solve_cache is not None and self.solve_cache.lookups > 0:
+            self._finish_solve_cache()
+        if self._network_modified:
+            reset_network(self.epanet_api, self._network_base)
+            self._network_modified = False
+        
+        self.epanet_api.setTimeSimulationDuration(self.sim_config['duration'])
+        self.epanet_api.setTimeHydraulicStep(self.sim_config['hydraulic_step'])
+        self.loops.reset()
+        self.network_io.write_settings(self.loops.link_idx, self.loops.current_valve)
+        
+        self._open_hydraulics()
+        self._gym_open = True
+        if self.solve_cache is not None:
+            self.solve_cache.start_episode()
+        self.current_time = 0
+        self.step_count = 0
+        self.hydraulic_time_offset = 0
+        return self._solve_and_observe()
+    
+    def step(self, actions):
+        """
+        Apply valve settings and advance one hydraulic step
+        
+        Args:
+            actions: Absolute valve setting per loop (clamped to the
+                actuator limits; NaN holds the current setting)
+        
+        Returns:
+            (obs, reward, done, info): reward is the negative mean absolute
+                control error after the step (0 once the episode is done)
+        """
+        if not self._gym_open:
+            raise RuntimeError("reset() must be called before step()")
+        loops = self.loops
+        requested = np.asarray(actions, dtype=np.float64).reshape(-1)
+        if requested.size != len(loops):
+            raise ValueError(f"Expected {len(loops)} actions, got {requested.size}")
+        requested = np.where(np.isfinite(requested), requested, loops.current_valve)
+        loops.current_valve = loops.clamp(requested, np.arange(len(loops)), loops.actuator_min, loops.actuator_max,
+                                          verbose=False)
+        self.network_io.write_settings(loops.link_idx, loops.current_valve)
         
-        df = pd.DataFrame(self.results)
-        df.to_csv(output_path, index=False)
+        step_advanced = self.step_solver.advance()
+        self.current_time += self.sim_config['hydraulic_step']
+        self.step_count += 1
+        info = {"time": self.current_time, "step": self.step_count}
+        if step_advanced == 0 or self.current_time > self.sim_config['duration']:
+            self.epanet_api.closeHydraulicAnalysis()
+            self._gym_open = False
+            return self._observation, 0.0, True, info
+        
+        obs = self._solve_and_observe()
+        return obs, -float(np.mean(np.abs(self._measured['error']))), False, info
+    
+    def _open_hydraulics(self):
+        """Apply the fidelity profile (if any), then open and initialize the hydraulic solver"""
+        self.hydraulic_init_flag = self.epanet_api.ToolkitConstants.EN_SAVE_AND_INIT
+        if self.fidelity_settings is not None:
+            self.hydraulic_init_flag = apply_profile(self.epanet_api, self.fidelity_settings)
+        self.epanet_api.openHydraulicAnalysis()
+        self.epanet_api.initializeHydraulicAnalysis(self.hydraulic_init_flag)
+    
+    def _compare_fidelity(self, duration, step_size):
+        """Replay the episode with its profile and the eval profile and log throughput and deviation"""
+        row = compare_to_eval(
+            self.network_path, self.control_loops, self.results.csv_path if self.results.write_csv
+            else self.results.parquet_path, duration, step_size, self.fidelity_profile, self.fidelity_settings,
+            self.configured_hydraulic_step
+        )
+        row = {"episode": self.episode, **row}
+        fidelity_path = os.path.join(self.exp_dir, "fidelity.csv")
+        pd.DataFrame([row]).to_csv(fidelity_path, mode='a', header=not os.path.exists(fidelity_path), index=False)
+        print(f"Fidelity ({self.fidelity_profile}): {row['steps_per_s']:.0f} solver steps/s vs eval "
+              f"{row['eval_steps_per_s']:.0f} ({row['speedup']:.2f}x simulated time per second), "
+              f"pressure RMSE {row['pressure_rmse']:.2e} (max {row['pressure_max_abs']:.2e}), "
+              f"flow RMSE {row['flow_rmse']:.2e} (max {row['flow_max_abs']:.2e}) -> {fidelity_path}")
+    
+    def _finish_solve_cache(self):
+        """Log the solve cache statistics of the episode to solve_cache.csv and persist the entries"""
+        cache = self.solve_cache
+        if cache.hits > cache.verified:
+            self._network_modified = True
+        row = {"episode": self.episode, **cache.summary()}
+        cache_csv = os.path.join(self.exp_dir, "solve_cache.csv")
+        pd.DataFrame([row]).to_csv(cache_csv, mode='a', header=not os.path.exists(cache_csv), index=False)
+        cache.save(self.solve_cache_path)
+        print(f"Solve cache: {row['hits']}/{row['lookups']} hits ({row['hit_rate']:.1%}), "
+              f"{row['entries']} entries, ~{row['saved_s_est']:.3f}s solver time saved, "
+              f"error bound from {row['verified']} verified hits: pressure {row['pressure_max_abs']:.2e}, "
+              f"flow {row['flow_max_abs']:.2e}, tank {row['tank_max_abs']:.2e} -> {cache_csv}")
+        cache.start_episode()
+    
+    def _solve_and_observe(self):
+        """Solve the current step and build the observation (reset() / step())"""
+        t = self.step_solver.solve()
+        self.hydraulic_time = self.hydraulic_time_offset + int(t)
+        pressures, flows = self.step_solver.read()
+        measured = self.loops.measure(pressures, flows)
+        self._measured = measured
+        self._observation = np.column_stack([
+            measured['controlled'], measured['target'], measured['error'], self.loops.current_valve,
+            measured['pressure'], measured['flow'],
+            np.full(len(self.loops), (self.current_time % 86400) / 86400.0)
+        ])
+        return self._observation
+    
+    def _validate_surrogate(self, duration, step_size):
+        """Replay the episode's valve settings on EPANET and log the surrogate error"""
+        validation = validate_against_epanet(
+            self.network_path, self.control_loops, self.results.csv_path, duration, step_size
+        )
+        validation.insert(0, "episode", self.episode)
+        validation_path = os.path.join(self.exp_dir, "surrogate_validation.csv")
+        validation.to_csv(validation_path, mode='a', header=not os.path.exists(validation_path), index=False)
+        print(f"Surrogate validation against EPANET (episode {self.episode}): {validation_path}")
+        for _, row in validation.iterrows():
+            print(f"  {row['LoopID']}: pressure RMSE {row['pressure_rmse']:.4f}, flow RMSE {row['flow_rmse']:.4f} "
+                  f"over {row['steps']} steps")
+    
+    def _validate_skeleton(self, duration, step_size):
+        """Replay the episode's valve settings on the full network and log the skeleton error"""
+        validation = validate_against_epanet(
+            self.full_network_path, self.control_loops, self.results.csv_path, duration, step_size
+        )
+        validation.insert(0, "episode", self.episode)
+        validation_path = os.path.join(self.exp_dir, "skeleton_validation.csv")
+        validation.to_csv(validation_path, mode='a', header=not os.path.exists(validation_path), index=False)
+        print(f"Skeleton validation on the full network (episode {self.episode}): {validation_path}")
+        for _, row in validation.iterrows():
+            print(f"  {row['LoopID']}: pressure RMSE {row['pressure_rmse']:.4f}, flow RMSE {row['flow_rmse']:.4f} "
+                  f"over {row['steps']} steps")
+    
+    def _dispatch_loops(self, requests_due, deadline, step_count, current_time):
+        """
+        Send the per-loop requests of one step (individual controllers)
+        
+        Requests run concurrently on the loop dispatch pool when the plugin
+        allows it. Real-time mode stays sequential (deadline calls never overlap).
+        
+        Args:
+            requests_due: List of (position, loop_id, payload)
+            deadline, step_count, current_time: Passed to the deadline caller
+        
+        Returns:
+            list: (response, exception) per request in request order;
+                (None, None) means the deadline was missed
+        """
+        def call(request):
+            _, loop_id, payload = request
+            start = time.perf_counter()
+            try:
+                if self.deadline_caller is not None:
+                    response = self.deadline_caller.call(payload, deadline, step_count, current_time, [loop_id])
+                else:
+                    response = self.controller.step(payload)
+            except Exception as e:
+                self.loop_latency.record_error(loop_id)
+                return None, e
+            self.loop_latency.record(loop_id, time.perf_counter() - start)
+            return response, None
+        
+        start = time.perf_counter()
+        if self.loop_dispatch_pool is None or self.deadline_caller is not None or len(requests_due) < 2:
+            outcomes = [call(request) for request in requests_due]
+        else:
+            outcomes = list(self.loop_dispatch_pool.map(call, requests_due))
+        if requests_due:
+            # Wall time of all requests of the step (compare with the per-loop latencies)
+            self.loop_latency.record("step", time.perf_counter() - start)
+        return outcomes
+    
+    def _fallback_actions(self, fallback):
+        """
+        Batch response used when the controller missed its deadline
+        
+        Args:
+            fallback: (output, p, i, d) arrays of the local PID, or None to hold
+        """
+        if fallback is None:
+            return {"actions": [{"action": valve} for valve in self.loops.current_valve.tolist()]}
+        output, p_term, i_term, d_term = (values.tolist() for values in fallback)
+        return {"actions": [
+            {"action": a, "p_term": p, "i_term": i, "d_term": d}
+            for a, p, i, d in zip(output, p_term, i_term, d_term)
+        ]}
+    
+    def close(self):
+        """Release the controller and HTTP sessions (after the last episode)"""
+        if self._gym_open:
+            self.epanet_api.closeHydraulicAnalysis()
+            self._gym_open = False
+        if self.solve_cache is not None and self.solve_cache.lookups > 0:
+            self._finish_solve_cache()
+        if self.loop_dispatch_pool is not None:
+            self.loop_dispatch_pool.shutdown()
+        self.controller.close()
+        self.image_generator_http.close()
+    
+    def save_results(self):
+        # ★ NEW: Flush the last partial block and publish result.csv / result.parquet atomically
+        output_path = self.results.finalize()
         print(f"Results saved to {output_path}")
-        print(f"  Total records: {len(df)}")
+        if self.results.write_parquet:
+            print(f"  Columnar copy: {self.results.parquet_path} ({self.results.num_flushes} row groups)")
+        print(f"  Total records: {len(self.results)}")
         
-        if len(df) > 0:
-            print(f"  Loops: {df['LoopID'].nunique()}")
-            print(f"  Time range: {df['Time'].min():.0f}s - {df['Time'].max():.0f}s")
-            print(f"  Steps: {df['Step'].nunique()}")
+        if len(self.results) > 0:
+            print(f"  Loops: {len(self.results.loop_ids)}")
+            print(f"  Time range: {self.results.time_min:.0f}s - {self.results.time_max:.0f}s")
+            print(f"  Steps: {self.results.num_steps}")
         else:
             print("[WARNING] No data recorded!")
+        
+        # ★ NEW: Per-service call latency next to result.csv
+        latency_path = os.path.join(self.exp_dir, "latency.csv")
+        latency_df = write_latency_report([self.controller_http, self.image_generator_http], latency_path,
+                                          recorders=[self.loop_latency])
+        print(f"Latency report saved to {latency_path}")
+        for _, row in latency_df.iterrows():
+            if row['calls'] > 0:
+                print(f"  {row['service']}/{row['endpoint']}: {row['calls']} calls, "
+                      f"p50={row['p50_ms']:.1f}ms p95={row['p95_ms']:.1f}ms p99={row['p99_ms']:.1f}ms, "
+                      f"errors={row['errors']}, retries={row['retries']}")
+        
+        # ★ NEW: Negotiated wire format, payload size and codec cost per controller request
+        if hasattr(self.controller, 'wire_summary'):
+            wire_summary = self.controller.wire_summary()
+            if wire_summary['requests'] > 0:
+                pd.DataFrame([wire_summary]).to_csv(os.path.join(self.exp_dir, "wire.csv"), index=False)
+                print(f"Controller wire format: {wire_summary['wire_format']}, "
+                      f"{wire_summary['bytes_sent_per_request']:.0f}B sent / "
+                      f"{wire_summary['bytes_received_per_request']:.0f}B received per request, "
+                      f"codec {wire_summary['encode_ms_per_request'] + wire_summary['decode_ms_per_request']:.3f}ms "
+                      f"per request")
+        
+        # ★ NEW: Where the step loop spent its time
+        if self.step_timer.n > 0:
+            timing_paths = self.step_timer.write(self.exp_dir)
+            print(f"Step timings saved to {', '.join(timing_paths)}")
+            print(f"  {'phase':<12} {'total_s':>9} {'share':>7} {'mean_ms':>9} {'p50_ms':>9} {'p95_ms':>9} {'p99_ms':>9} {'max_ms':>9}")
+            for _, row in self.step_timer.summary().iterrows():
+                print(f"  {row['phase']:<12} {row['total_s']:>9.3f} {row['share']:>7.1%} {row['mean_ms']:>9.3f} "
+                      f"{row['p50_ms']:>9.3f} {row['p95_ms']:>9.3f} {row['p99_ms']:>9.3f} {row['max_ms']:>9.3f}")
+        
+        # ★ NEW: Achieved overlap of pipelined image generation
+        if self.image_pipeline is not None:
+            pipeline_summary = self.image_pipeline.summary()
+            pipeline_path = os.path.join(self.exp_dir, "image_pipeline.csv")
+            pd.DataFrame([pipeline_summary]).to_csv(pipeline_path, index=False)
+            print(f"Image pipeline report saved to {pipeline_path}")
+            print(f"  depth={pipeline_summary['depth']}, submitted={pipeline_summary['submitted']}, "
+                  f"failed={pipeline_summary['failed']}, overlap={pipeline_summary['overlap_ratio']:.1%} "
+                  f"(render {pipeline_summary['render_time_s']:.2f}s, blocked {pipeline_summary['blocked_time_s']:.2f}s), "
+                  f"staleness mean={pipeline_summary['mean_staleness_steps']:.2f} max={pipeline_summary['max_staleness_steps']}")
+        
+        # ★ NEW: Loops whose images could not be generated
+        if self.image_stats and self.image_stats["steps"] > 0:
+            stats = self.image_stats
+            pd.DataFrame([stats]).to_csv(os.path.join(self.exp_dir, "image_generation.csv"), index=False)
+            message = (f"Image generation: {stats['loops_requested'] - stats['loops_failed']}/"
+                       f"{stats['loops_requested']} loop images generated, "
+                       f"{stats['steps_incomplete']}/{stats['steps']} steps incomplete, "
+                       f"{stats['requests_failed']} failed requests")
+            print(f"[WARNING] {message}" if stats['loops_failed'] else message)
+        
+        # ★ NEW: Controller calls skipped by the control schedule
+        if self.control_schedule.active:
+            schedule = self.control_schedule
+            print(f"Control schedule ({schedule.trigger}, period={schedule.period}): "
+                  f"{int(schedule.calls.sum())} calls, {int(schedule.skipped.sum())} skipped "
+                  f"(triggers: {', '.join(f'{k}={v}' for k, v in schedule.reasons.items() if v)})")
+            for row in schedule.summary(self.loops.loop_ids.tolist()):
+                print(f"  {row['loop_id']}: {row['calls']} calls, {row['skipped']} skipped ({row['skip_rate']:.1%})")
+        
+        # ★ NEW: Deadline misses, slack and controller latency per loop (real-time mode)
+        if self.deadline_caller is not None:
+            recorder = self.deadline_caller.recorder
+            deadline_df = recorder.write(self.exp_dir)
+            print(f"Deadline report saved to {os.path.join(self.exp_dir, 'deadline_summary.csv')} "
+                  f"(budget {recorder.budget * 1000.0:.1f}ms, fallback={recorder.fallback}, "
+                  f"{recorder.step_overruns} step overruns)")
+            for _, row in deadline_df.iterrows():
+                print(f"  {row['LoopID']}: {row['ok']}/{row['steps']} on time, miss rate {row['miss_rate']:.1%} "
+                      f"(late={row['late']}, busy={row['busy']}, error={row['error']}), "
+                      f"p99 latency={row.get('latency_p99_ms', float('nan')):.1f}ms, "
+                      f"min slack={row.get('slack_min_ms', float('nan')):.1f}ms")
+        
+        # ★ NEW: Image archival counters
+        if self.image_archiver is not None:
+            archive_summary = self.image_archiver.summary()
+            print(f"Image archive: {archive_summary['archived_steps']} steps, "
+                  f"{archive_summary['images_written']} images written, "
+                  f"{archive_summary['images_missing']} missing, {archive_summary['dropped']} dropped, "
+                  f"{archive_summary['errors']} errors (policy={archive_summary['policy']}, "
+                  f"blocked {archive_summary['backpressure_time_s']:.2f}s)")
 
 
 if __name__ == "__main__":
@@ -593,5 +1460,12 @@ if __name__ == "__main__":
     output_root = os.environ.get('OUTPUT_PATH', '/shared/results')
     exp_id = os.environ.get('EXP_ID', 'exp_default')
     
+    # ★ NEW: SIM_EPISODES > 1 runs several episodes on one loaded network
+    num_episodes = int(os.environ.get('SIM_EPISODES', '1'))
+    
     env = RemoteValveControlEnv(config_path, network_dir, controller_url, output_root, exp_id)
-    env.run()
\ No newline at end of file
+    try:
+        for _ in range(num_episodes):
+            env.run()
+    finally:
+        env.close()
\ No newline at end of file
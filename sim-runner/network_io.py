@@ -0,0 +1,207 @@
+"""
+Vectorized sensor acquisition and bulk actuation for the step loop
+
+Node/link indices of all control loops are compiled into NumPy arrays
+once at init. Each step then reads the network state with one call per
+quantity and fancy-indexes the loop values out of it, instead of one
+getNodePressure/getLinkFlows call per loop.
+
+When the epyt instance exposes its toolkit library, the per-step calls
+(solve, loop reads, setting writes, advance) go through ToolkitBinding
+instead of the epyt wrappers (see toolkit.py).
+"""
+import numpy as np
+
+from toolkit import ToolkitBinding
+
+
+# Full-network quantities: name -> (toolkit constant, epyt getter without indices)
+NODE_QUANTITIES = {
+    "pressure": ("EN_PRESSURE", "getNodePressure"),
+    "head": ("EN_HEAD", "getNodeHydraulicHead"),
+    "demand": ("EN_DEMAND", "getNodeActualDemand"),
+}
+LINK_QUANTITIES = {
+    "flow": ("EN_FLOW", "getLinkFlows"),
+    "setting": ("EN_SETTING", "getLinkSettings"),
+}
+
+
+class NetworkIO:
+    """Batched EPANET reads/writes for a fixed set of control loops"""
+
+    def __init__(self, epanet_api, node_indices, link_indices, direct=True):
+        """
+        Args:
+            epanet_api: epyt epanet instance
+            node_indices: EPANET (1-based) node index of each loop's sensor
+            link_indices: EPANET (1-based) link index of each loop's actuator
+            direct: Use the ctypes toolkit binding for the per-step calls when available
+        """
+        self.api = epanet_api
+        self.node_idx = np.asarray(node_indices, dtype=np.int64)
+        self.link_idx = np.asarray(link_indices, dtype=np.int64)
+
+        # epyt returns index 0 (with a toolkit warning) for unknown IDs.
+        # Such loops read 0.0 and their actuator writes are skipped.
+        self.node_valid = (self.node_idx >= 1) & (self.node_idx <= epanet_api.getNodeCount())
+        self.link_count = epanet_api.getLinkCount()
+        self.link_valid = (self.link_idx >= 1) & (self.link_idx <= self.link_count)
+        if not self.node_valid.all() or not self.link_valid.all():
+            print(f"[WARNING] Unknown sensor nodes at loop positions {np.flatnonzero(~self.node_valid).tolist()}, "
+                  f"unknown actuator links at loop positions {np.flatnonzero(~self.link_valid).tolist()}")
+
+        # 0-based positions into the full-network arrays
+        self.node_pos = np.where(self.node_valid, self.node_idx - 1, 0)
+        self.link_pos = np.where(self.link_valid, self.link_idx - 1, 0)
+
+        self._node_idx_list = self.node_idx[self.node_valid].tolist()
+        self._link_idx_list = self.link_idx[self.link_valid].tolist()
+
+        # Newer epyt exposes the toolkit's whole-network getters
+        # (ENgetnodevalues / ENgetlinkvalues); older versions only have
+        # per-index getters, so fall back to a single list read there.
+        toolkit = getattr(epanet_api, 'api', None)
+        self.bulk = hasattr(toolkit, 'ENgetnodevalues') and hasattr(toolkit, 'ENgetlinkvalues')
+        self._en_pressure = epanet_api.ToolkitConstants.EN_PRESSURE
+        self._en_flow = epanet_api.ToolkitConstants.EN_FLOW
+
+        self.binding = ToolkitBinding.attach(epanet_api, self._node_idx_list, self._link_idx_list) if direct else None
+
+    def solve(self):
+        """Solve the current hydraulic time step; returns the simulation time"""
+        if self.binding is not None:
+            return self.binding.solve()
+        return self.api.runHydraulicAnalysis()
+
+    def advance(self):
+        """Advance to the next hydraulic time step; returns 0 at the end of the simulation"""
+        if self.binding is not None:
+            return self.binding.advance()
+        return self.api.nextHydraulicAnalysisStep()
+
+    def read_network(self):
+        """
+        Read the full-network state
+
+        Returns:
+            (pressures, flows): arrays over all nodes / all links
+        """
+        if self.bulk:
+            pressures = np.asarray(self.api.api.ENgetnodevalues(self._en_pressure), dtype=float)
+            flows = np.asarray(self.api.api.ENgetlinkvalues(self._en_flow), dtype=float)
+        else:
+            pressures = np.asarray(self.api.getNodePressure(), dtype=float)
+            flows = np.asarray(self.api.getLinkFlows(), dtype=float)
+        return pressures, flows
+
+    def read_state(self, node_fields=(), link_fields=()):
+        """
+        Read full-network quantities (network state recording)
+
+        Args:
+            node_fields: Names from NODE_QUANTITIES
+            link_fields: Names from LINK_QUANTITIES
+
+        Returns:
+            dict: field name -> array over all nodes / all links
+        """
+        state = {}
+        for name in node_fields:
+            code, getter = NODE_QUANTITIES[name]
+            if self.bulk:
+                values = self.api.api.ENgetnodevalues(getattr(self.api.ToolkitConstants, code))
+            else:
+                values = getattr(self.api, getter)()
+            state[name] = np.asarray(values, dtype=float).reshape(-1)
+        for name in link_fields:
+            code, getter = LINK_QUANTITIES[name]
+            if self.bulk:
+                values = self.api.api.ENgetlinkvalues(getattr(self.api.ToolkitConstants, code))
+            else:
+                values = getattr(self.api, getter)()
+            state[name] = np.asarray(values, dtype=float).reshape(-1)
+        return state
+
+    def read(self):
+        """
+        Read the controlled quantities of every loop
+
+        Returns:
+            (pressures, flows): arrays with one entry per loop
+        """
+        pressures = np.zeros(len(self.node_idx))
+        flows = np.zeros(len(self.link_idx))
+
+        if self.binding is not None:
+            loop_pressures, loop_flows = self.binding.read_loops()
+            pressures[self.node_valid] = loop_pressures
+            flows[self.link_valid] = loop_flows
+        elif self.bulk:
+            all_pressures, all_flows = self.read_network()
+            pressures[self.node_valid] = all_pressures[self.node_pos[self.node_valid]]
+            flows[self.link_valid] = all_flows[self.link_pos[self.link_valid]]
+        else:
+            if self._node_idx_list:
+                pressures[self.node_valid] = np.asarray(
+                    self.api.getNodePressure(self._node_idx_list), dtype=float).reshape(-1)
+            if self._link_idx_list:
+                flows[self.link_valid] = np.asarray(
+                    self.api.getLinkFlows(self._link_idx_list), dtype=float).reshape(-1)
+        return pressures, flows
+
+    def sensitivity(self, settings, deltas):
+        """
+        Local sensitivity of the loop readings to every loop's actuator setting
+
+        One-sided finite differences around the solution of the current
+        time: each valid actuator is perturbed in turn and the same time is
+        solved again. Finally the current time is solved once more with the
+        unperturbed settings, so advance() continues from the base solution.
+
+        The base is solved again first: the step's own solve stops at the
+        accuracy limit, and every warm-started re-solve moves the flows on
+        by up to that limit, which would dominate a small perturbation.
+
+        Args:
+            settings: Current setting per loop (as solved)
+            deltas: Signed perturbation per loop (0 = skip)
+
+        Returns:
+            (d_pressure, d_flow): (loops x loops) arrays, [i, j] = d reading i / d setting j
+        """
+        self.solve()
+        base_pressures, base_flows = self.read()
+        n = len(self.link_idx)
+        d_pressure = np.zeros((n, n))
+        d_flow = np.zeros((n, n))
+        for j in range(n):
+            if not self.link_valid[j] or deltas[j] == 0:
+                continue
+            link = self.link_idx[j:j + 1]
+            self.write_settings(link, [settings[j] + deltas[j]])
+            self.solve()
+            pressures, flows = self.read()
+            d_pressure[:, j] = (pressures - base_pressures) / deltas[j]
+            d_flow[:, j] = (flows - base_flows) / deltas[j]
+            self.write_settings(link, [settings[j]])
+        self.solve()
+        return d_pressure, d_flow
+
+    def write_settings(self, link_indices, values):
+        """
+        Apply several link settings in one call
+
+        Args:
+            link_indices: EPANET (1-based) link indices
+            values: New settings, same order as link_indices
+        """
+        indices = np.asarray(link_indices, dtype=np.int64).reshape(-1)
+        settings = np.asarray(values, dtype=np.float64).reshape(-1)
+        valid = (indices >= 1) & (indices <= self.link_count)
+        if not valid.any():
+            return
+        if self.binding is not None:
+            self.binding.write_settings(indices[valid].tolist(), settings[valid].tolist())
+        else:
+            self.api.setLinkSettings(indices[valid].tolist(), settings[valid].tolist())
@@ -0,0 +1,234 @@
+"""
+Full-network state recording in chunked compressed arrays
+
+result.csv only holds the controlled node and actuator link of each loop.
+With NETWORK_RECORD=true every step additionally records all node
+pressures/heads/demands and all link flows/settings into
+<exp_dir>/network_state/:
+
+    meta.json              node/link IDs, fields, chunk layout, step count
+    times.npy              simulation time of every recorded step
+    chunk_000000.npz       steps [0, chunk_steps) of every field
+    chunk_000001.npz       ...
+
+Each chunk is a compressed NPZ whose members are column blocks of one
+field ("pressure_000" = nodes [0, column_block), "pressure_001" = the
+next block, ...). NPZ members are decompressed individually, so
+NetworkStateReader.read() only touches the chunks that overlap the
+requested time window and the column blocks that contain the requested
+IDs. The step buffers are preallocated from duration // hydraulic_step.
+
+Values are stored as float32 (the toolkit computes in single precision).
+The directory is written as network_state.partial and renamed when the
+episode ends.
+"""
+import json
+import os
+import shutil
+
+import numpy as np
+
+from network_io import LINK_QUANTITIES, NODE_QUANTITIES
+
+
+FORMAT_VERSION = 1
+DEFAULT_NODE_FIELDS = tuple(NODE_QUANTITIES)
+DEFAULT_LINK_FIELDS = tuple(LINK_QUANTITIES)
+
+
+def _chunk_name(chunk):
+    return f"chunk_{chunk:06d}.npz"
+
+
+def _member(field, block):
+    return f"{field}_{block:03d}"
+
+
+class NetworkRecorder:
+    """Buffers the full-network state per step and writes compressed chunks"""
+
+    def __init__(self, output_dir, node_ids, link_ids, expected_steps, chunk_steps=64,
+                 column_block=1024, node_fields=DEFAULT_NODE_FIELDS, link_fields=DEFAULT_LINK_FIELDS,
+                 dtype=np.float32):
+        """
+        Args:
+            output_dir: Destination directory (e.g. <exp_dir>/network_state)
+            node_ids, link_ids: Network IDs in EPANET index order
+            expected_steps: Number of steps of the episode (duration // hydraulic_step + 1)
+            chunk_steps: Steps per chunk file
+            column_block: Nodes/links per NPZ member
+            node_fields, link_fields: Recorded quantities (see network_io)
+            dtype: Storage dtype
+        """
+        self.output_dir = output_dir
+        self.partial_dir = output_dir + ".partial"
+        self.node_ids = list(node_ids)
+        self.link_ids = list(link_ids)
+        self.node_fields = tuple(node_fields)
+        self.link_fields = tuple(link_fields)
+        self.expected_steps = max(1, int(expected_steps))
+        self.chunk_steps = max(1, min(int(chunk_steps), self.expected_steps))
+        self.column_block = max(1, int(column_block))
+        self.dtype = np.dtype(dtype)
+
+        # Preallocated: times of the whole episode, one chunk of every field
+        self.times = np.zeros(self.expected_steps, dtype=np.int64)
+        self._buffers = {name: np.zeros((self.chunk_steps, len(self.node_ids)), dtype=self.dtype)
+                         for name in self.node_fields}
+        self._buffers.update({name: np.zeros((self.chunk_steps, len(self.link_ids)), dtype=self.dtype)
+                              for name in self.link_fields})
+        self.steps = 0  # recorded steps
+        self._fill = 0  # rows in the current chunk
+        self.chunks = 0
+        self.bytes_written = 0
+
+        if os.path.exists(self.partial_dir):
+            shutil.rmtree(self.partial_dir)
+        os.makedirs(self.partial_dir)
+
+    def append(self, current_time, state):
+        """
+        Record one step
+
+        Args:
+            current_time: Simulation time in seconds
+            state: field name -> full-network array (NetworkIO.read_state())
+        """
+        if self.steps == self.times.size:
+            # Longer than expected (e.g. a snapshot restore shifted the schedule)
+            self.times = np.concatenate([self.times, np.zeros(self.times.size, dtype=np.int64)])
+        self.times[self.steps] = current_time
+        for name, buffer in self._buffers.items():
+            buffer[self._fill] = state[name]
+        self.steps += 1
+        self._fill += 1
+        if self._fill == self.chunk_steps:
+            self._write_chunk()
+
+    def _write_chunk(self):
+        if self._fill == 0:
+            return
+        members = {}
+        for name, buffer in self._buffers.items():
+            width = buffer.shape[1]
+            for block, start in enumerate(range(0, max(width, 1), self.column_block)):
+                members[_member(name, block)] = buffer[:self._fill, start:start + self.column_block]
+        path = os.path.join(self.partial_dir, _chunk_name(self.chunks))
+        np.savez_compressed(path, **members)
+        self.bytes_written += os.path.getsize(path)
+        self.chunks += 1
+        self._fill = 0
+
+    def close(self):
+        """
+        Write the last partial chunk and publish the directory
+
+        Returns:
+            str: Path of the published directory
+        """
+        self._write_chunk()
+        np.save(os.path.join(self.partial_dir, "times.npy"), self.times[:self.steps])
+        meta = {
+            "version": FORMAT_VERSION,
+            "dtype": self.dtype.name,
+            "steps": self.steps,
+            "chunk_steps": self.chunk_steps,
+            "column_block": self.column_block,
+            "chunks": self.chunks,
+            "node_fields": list(self.node_fields),
+            "link_fields": list(self.link_fields),
+            "node_ids": self.node_ids,
+            "link_ids": self.link_ids,
+        }
+        with open(os.path.join(self.partial_dir, "meta.json"), 'w') as f:
+            json.dump(meta, f)
+        if os.path.exists(self.output_dir):
+            shutil.rmtree(self.output_dir)
+        os.replace(self.partial_dir, self.output_dir)
+        return self.output_dir
+
+    def summary(self):
+        """
+        Returns:
+            dict: Steps, chunks, compressed size and compression ratio
+        """
+        raw = self.steps * self.dtype.itemsize * (
+            len(self.node_ids) * len(self.node_fields) + len(self.link_ids) * len(self.link_fields)
+        )
+        return {
+            "steps": self.steps,
+            "chunks": self.chunks,
+            "bytes": self.bytes_written,
+            "compression_ratio": raw / self.bytes_written if self.bytes_written else 0.0,
+        }
+
+
+class NetworkStateReader:
+    """Random access to a recorded network_state directory"""
+
+    def __init__(self, path):
+        """
+        Args:
+            path: network_state directory written by NetworkRecorder
+        """
+        self.path = path
+        with open(os.path.join(path, "meta.json"), 'r') as f:
+            self.meta = json.load(f)
+        if self.meta.get("version") != FORMAT_VERSION:
+            raise ValueError(f"Unsupported network state version: {self.meta.get('version')}")
+        self.times = np.load(os.path.join(path, "times.npy"))
+        self.node_ids = self.meta["node_ids"]
+        self.link_ids = self.meta["link_ids"]
+        self._node_pos = {node_id: i for i, node_id in enumerate(self.node_ids)}
+        self._link_pos = {link_id: i for i, link_id in enumerate(self.link_ids)}
+
+    def read(self, field, start_time=None, end_time=None, ids=None):
+        """
+        Read one field for a time window and a subset of nodes/links
+
+        Only the overlapping chunks and the column blocks containing the
+        requested IDs are decompressed.
+
+        Args:
+            field: e.g. 'pressure', 'head', 'demand', 'flow', 'setting'
+            start_time, end_time: Inclusive time window in seconds (default: all)
+            ids: Node IDs (node fields) or link IDs (link fields) (default: all)
+
+        Returns:
+            (times, values): values has shape (steps in window, len(ids))
+        """
+        if field in self.meta["node_fields"]:
+            positions_of, all_ids = self._node_pos, self.node_ids
+        elif field in self.meta["link_fields"]:
+            positions_of, all_ids = self._link_pos, self.link_ids
+        else:
+            raise KeyError(f"Field {field!r} not recorded "
+                           f"(available: {self.meta['node_fields'] + self.meta['link_fields']})")
+        ids = all_ids if ids is None else list(ids)
+        missing = [i for i in ids if i not in positions_of]
+        if missing:
+            raise KeyError(f"Unknown IDs for {field}: {missing}")
+        positions = np.array([positions_of[i] for i in ids], dtype=np.int64)
+
+        in_window = np.ones(self.times.size, dtype=bool)
+        if start_time is not None:
+            in_window &= self.times >= start_time
+        if end_time is not None:
+            in_window &= self.times <= end_time
+        rows = np.flatnonzero(in_window)
+        values = np.zeros((rows.size, positions.size), dtype=np.dtype(self.meta["dtype"]))
+        if rows.size == 0 or positions.size == 0:
+            return self.times[rows], values
+
+        chunk_steps = self.meta["chunk_steps"]
+        block_size = self.meta["column_block"]
+        blocks = positions // block_size
+        for chunk in np.unique(rows // chunk_steps):
+            in_chunk = rows // chunk_steps == chunk
+            local_rows = rows[in_chunk] - chunk * chunk_steps
+            with np.load(os.path.join(self.path, _chunk_name(int(chunk)))) as npz:
+                for block in np.unique(blocks):
+                    columns = blocks == block
+                    data = npz[_member(field, int(block))]
+                    values[np.ix_(in_chunk, columns)] = data[np.ix_(local_rows, positions[columns] - block * block_size)]
+        return self.times[rows], values
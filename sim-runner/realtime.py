@@ -0,0 +1,261 @@
+"""
+Deadline-paced real-time mode for the sim-runner step loop
+
+With REALTIME_STEP_BUDGET_MS > 0 every step gets a fixed wall-clock
+budget, as in a hardware-in-the-loop setup:
+
+    - The controller call runs on a worker thread and must answer before
+      the step deadline. A reply that misses it is discarded when it
+      arrives, and the configured fallback acts instead:
+          hold  keep the current valve setting
+          pid   local PID on the loop error (gains from pid_params)
+    - While a late call is still in flight the controller is not called
+      again (calls never overlap); those steps use the fallback as well.
+    - Rejected calls (ControllerError) and transport errors also fall
+      back, so simulation time always advances.
+    - After the step the loop sleeps until the budget is used up, so
+      steps are paced at the budget (steps that overran are counted).
+
+Deadline misses, slack and controller latency are recorded per loop
+(deadline.csv) and summarized per loop (deadline_summary.csv).
+"""
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+import numpy as np
+import pandas as pd
+
+from controllers import pid_sample_time
+
+
+FALLBACKS = ('hold', 'pid')
+
+# Outcome of one deadline-bounded call
+OK = 'ok'  # reply before the deadline
+LATE = 'late'  # no reply before the deadline (reply discarded)
+BUSY = 'busy'  # previous late call still in flight, not called
+ERROR = 'error'  # controller rejected the request / transport error
+
+
+class DeadlineCaller:
+    """Runs controller.step() with a deadline on a single worker thread"""
+
+    def __init__(self, controller, recorder):
+        """
+        Args:
+            controller: BaseController plugin
+            recorder: DeadlineRecorder for the call outcomes
+        """
+        self.controller = controller
+        self.recorder = recorder
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='controller-call')
+        self.in_flight = None  # (future, recorder rows) of a late call
+
+    def _timed_step(self, payload):
+        start = time.perf_counter()
+        response = self.controller.step(payload)
+        return response, time.perf_counter() - start
+
+    def _collect_late(self):
+        future, rows = self.in_flight
+        self.in_flight = None
+        if future.exception() is None:
+            self.recorder.late_reply(rows, future.result()[1])
+
+    def call(self, payload, deadline, step, current_time, loop_ids):
+        """
+        Send one request and wait for it until `deadline`
+
+        Args:
+            payload: Controller request
+            deadline: time.perf_counter() value by which the reply must arrive
+            step, current_time, loop_ids: Recorded with the outcome
+
+        Returns:
+            dict: Controller response, or None if the fallback must act
+        """
+        if self.in_flight is not None:
+            if not self.in_flight[0].done():
+                self.recorder.record(step, current_time, loop_ids, BUSY, None, deadline, None)
+                return None
+            self._collect_late()
+
+        sent = time.perf_counter()
+        future = self.executor.submit(self._timed_step, payload)
+        try:
+            response, latency = future.result(timeout=max(0.0, deadline - sent))
+        except TimeoutError:
+            rows = self.recorder.record(step, current_time, loop_ids, LATE, None, deadline, None)
+            self.in_flight = (future, rows)
+            return None
+        except Exception as e:
+            print(f"[WARNING] Controller call failed at step {step}: {e}")
+            self.recorder.record(step, current_time, loop_ids, ERROR, time.perf_counter() - sent, deadline, None)
+            return None
+        self.recorder.record(step, current_time, loop_ids, OK, latency, deadline, sent + latency)
+        return response
+
+    def close(self):
+        """Wait for an in-flight call and stop the worker"""
+        self.executor.shutdown(wait=True)
+        if self.in_flight is not None:
+            self._collect_late()
+
+
+class LocalPID:
+    """
+    Vectorized positional PID over all loops (fallback controller)
+
+    Same law as simple_pid / controller-pid: P on error, integral clamped
+    to the output limits, derivative on measurement. While the remote
+    controller is in charge the integral tracks the applied setting, so
+    switching to the fallback is bumpless.
+    """
+
+    def __init__(self, control_loops, control_mode, lower, upper, sample_time):
+        """
+        Args:
+            control_loops: control_loops section of the experiment config
+            control_mode: 'pressure' or 'flow'
+            lower, upper: Output limits per loop
+            sample_time: Hydraulic step in seconds (period of loops
+                without pid_params.dt)
+        """
+        kp, ki, kd, dt = [], [], [], []
+        for loop in control_loops:
+            params = loop.get('pid_params', {})
+            if control_mode == 'flow':
+                kp.append(params.get('kp_flow', params.get('Kp', params.get('kp', 0.01))))
+                ki.append(params.get('ki_flow', params.get('Ki', params.get('ki', 0.001))))
+                kd.append(params.get('kd_flow', params.get('Kd', params.get('kd', 0.02))))
+            else:
+                kp.append(params.get('Kp', params.get('kp', 1.0)))
+                ki.append(params.get('Ki', params.get('ki', 0.1)))
+                kd.append(params.get('Kd', params.get('kd', 0.05)))
+            dt.append(pid_sample_time(params, sample_time))
+
+        self.kp = np.asarray(kp, dtype=np.float64)
+        self.ki = np.asarray(ki, dtype=np.float64)
+        self.kd = np.asarray(kd, dtype=np.float64)
+        self.dt = np.asarray(dt, dtype=np.float64)
+        self.lower = np.asarray(lower, dtype=np.float64)
+        self.upper = np.asarray(upper, dtype=np.float64)
+        self.reset()
+
+    def reset(self):
+        self.integral = np.zeros(len(self.kp))
+        self.last_input = None
+        self._p = np.zeros(len(self.kp))
+        self._d = np.zeros(len(self.kp))
+
+    def update(self, controlled, target):
+        """
+        Advance the PID by one step
+
+        Returns:
+            (output, p_term, i_term, d_term): arrays over all loops
+        """
+        error = target - controlled
+        self._p = self.kp * error
+        self.integral = np.clip(self.integral + self.ki * error * self.dt, self.lower, self.upper)
+        if self.last_input is None:
+            self._d = np.zeros(len(self.kp))
+        else:
+            self._d = -self.kd * (controlled - self.last_input) / self.dt
+        self.last_input = np.array(controlled, dtype=np.float64)
+        output = np.clip(self._p + self.integral + self._d, self.lower, self.upper)
+        return output, self._p, self.integral.copy(), self._d
+
+    def track(self, positions, applied):
+        """Back-calculate the integral of loops that applied a remote action"""
+        self.integral[positions] = np.clip(
+            applied - self._p[positions] - self._d[positions],
+            self.lower[positions], self.upper[positions]
+        )
+
+
+class DeadlineRecorder:
+    """Per-loop record of deadline outcomes, slack and latency"""
+
+    COLUMNS = ["Step", "Time", "LoopID", "Outcome", "Fallback",
+               "LatencyMs", "SlackMs", "LateLatencyMs"]
+
+    def __init__(self, budget, fallback):
+        """
+        Args:
+            budget: Step budget in seconds
+            fallback: Fallback policy name (recorded on missed calls)
+        """
+        self.budget = budget
+        self.fallback = fallback
+        self.rows = []
+        self.step_overruns = 0
+
+    def record(self, step, current_time, loop_ids, outcome, latency, deadline, replied_at):
+        """
+        Record one call outcome for the loops it served
+
+        Returns:
+            list of row numbers (for late_reply())
+        """
+        latency_ms = latency * 1000.0 if latency is not None else np.nan
+        slack_ms = (deadline - replied_at) * 1000.0 if outcome == OK else np.nan
+        fallback = self.fallback if outcome != OK else ''
+        first = len(self.rows)
+        for loop_id in loop_ids:
+            self.rows.append([step, current_time, loop_id, outcome, fallback, latency_ms, slack_ms, np.nan])
+        return list(range(first, len(self.rows)))
+
+    def late_reply(self, rows, latency):
+        """Fill in the latency of a reply that arrived after its deadline"""
+        for row in rows:
+            self.rows[row][7] = latency * 1000.0
+
+    def frame(self):
+        return pd.DataFrame(self.rows, columns=self.COLUMNS)
+
+    def summary(self):
+        """
+        Returns:
+            pd.DataFrame: One row per loop with calls, misses, miss_rate,
+                latency and slack percentiles (milliseconds)
+        """
+        df = self.frame()
+        rows = []
+        for loop_id, group in df.groupby("LoopID", sort=False):
+            latency = group["LatencyMs"].where(group["Outcome"] == OK).dropna().to_numpy()
+            late = group["LateLatencyMs"].dropna().to_numpy()
+            slack = group["SlackMs"].dropna().to_numpy()
+            row = {
+                "LoopID": loop_id,
+                "steps": len(group),
+                "ok": int((group["Outcome"] == OK).sum()),
+                "late": int((group["Outcome"] == LATE).sum()),
+                "busy": int((group["Outcome"] == BUSY).sum()),
+                "error": int((group["Outcome"] == ERROR).sum()),
+            }
+            row["miss_rate"] = 1.0 - row["ok"] / row["steps"] if row["steps"] else 0.0
+            if latency.size > 0:
+                p50, p95, p99 = np.percentile(latency, [50, 95, 99])
+                row.update({"latency_p50_ms": p50, "latency_p95_ms": p95, "latency_p99_ms": p99,
+                            "latency_max_ms": latency.max()})
+            if slack.size > 0:
+                row.update({"slack_min_ms": slack.min(), "slack_p5_ms": np.percentile(slack, 5),
+                            "slack_mean_ms": slack.mean()})
+            if late.size > 0:
+                row["late_latency_max_ms"] = late.max()
+            rows.append(row)
+        return pd.DataFrame(rows)
+
+    def write(self, exp_dir):
+        """
+        Write deadline.csv (per step and loop) and deadline_summary.csv
+
+        Returns:
+            pd.DataFrame: The per-loop summary
+        """
+        self.frame().to_csv(os.path.join(exp_dir, "deadline.csv"), index=False)
+        summary = self.summary()
+        summary.to_csv(os.path.join(exp_dir, "deadline_summary.csv"), index=False)
+        return summary
@@ -0,0 +1,270 @@
+"""
+Streaming columnar result writer for sim-runner
+
+Rows are appended (one block per step) into preallocated typed column buffers. Every
+`flush_interval` steps the buffers are flushed:
+    - as one Parquet part file (one row group) in result.parquet.parts/
+    - appended to result.csv.partial
+so a crashed run keeps everything up to the last flush and memory stays
+bounded regardless of episode length. finalize() merges the parts into
+result.parquet and renames result.csv.partial to result.csv, both
+atomically, so readers (metrics/analyze.py, the dashboard) never see a
+half-written file.
+
+pyarrow is optional: without it only the CSV is written.
+"""
+import glob
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    PYARROW_AVAILABLE = True
+except ImportError:
+    PYARROW_AVAILABLE = False
+
+
+# Column layout of result.csv (same order as the original DataFrame output)
+BATCH_COLUMNS = [
+    ("Time", np.int64),
+    ("Step", np.int64),
+    ("LoopID", object),
+    ("Pressure", np.float64),
+    ("Flow", np.float64),
+    ("ControlMode", object),
+    ("ControlledValue", np.float64),
+    ("TargetValue", np.float64),
+    ("TargetPressure", np.float64),
+    ("TargetFlow", np.float64),
+    ("ValveSetting", np.float64),
+    ("NewValveSetting", np.float64),
+    ("PID_P", np.float64),
+    ("PID_I", np.float64),
+    ("PID_D", np.float64),
+    ("Error", np.float64),
+]
+
+INDIVIDUAL_COLUMNS = [
+    ("Time", np.int64),
+    ("Step", np.int64),
+    ("LoopID", object),
+    ("Pressure", np.float64),
+    ("Flow", np.float64),
+    ("ControlMode", object),
+    ("ControlledValue", np.float64),
+    ("TargetValue", np.float64),
+    ("TargetPressure", np.float64),
+    ("TargetFlow", np.float64),
+    ("ValveSetting", np.float64),
+    ("DeltaAction", np.float64),
+    ("NewValveSetting", np.float64),
+    ("Error", np.float64),
+]
+
+
+# Appended when a control schedule skips controller calls (control_schedule.py)
+SCHEDULE_COLUMNS = [
+    ("ControllerCalled", np.int64),
+    ("SkippedCalls", np.int64),
+]
+
+
+def columns_for(controller_type, schedule=False):
+    """Result schema for a controller type ('batch' or 'individual')"""
+    columns = BATCH_COLUMNS if controller_type == 'batch' else INDIVIDUAL_COLUMNS
+    return columns + SCHEDULE_COLUMNS if schedule else columns
+
+
+def _to_float(value):
+    # Controllers report e.g. "error": "Controller not initialized" on failure
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def _to_floats(values):
+    try:
+        return np.asarray(values, dtype=np.float64)
+    except (TypeError, ValueError):
+        return np.array([_to_float(value) for value in values], dtype=np.float64)
+
+
+class StreamingResultWriter:
+    """Append-only result table with periodic Parquet/CSV flushes"""
+
+    def __init__(self, exp_dir, columns, rows_per_step, flush_interval=50,
+                 write_parquet=True, write_csv=True):
+        """
+        Args:
+            exp_dir: Experiment output directory
+            columns: List of (name, dtype) pairs
+            rows_per_step: Expected rows per step (number of loops)
+            flush_interval: Flush every N steps
+            write_parquet: Write result.parquet (requires pyarrow)
+            write_csv: Write result.csv
+        """
+        self.exp_dir = exp_dir
+        self.columns = columns
+        self.flush_interval = max(1, int(flush_interval))
+        self.capacity = max(1, int(rows_per_step)) * self.flush_interval
+        self.write_parquet = write_parquet and PYARROW_AVAILABLE
+        self.write_csv = write_csv
+
+        if write_parquet and not PYARROW_AVAILABLE:
+            print("[WARNING] pyarrow not installed, writing result.csv only")
+
+        self.buffers = {name: np.empty(self.capacity, dtype=dtype) for name, dtype in columns}
+        self.size = 0
+        self.total_rows = 0
+        self.num_flushes = 0
+        self.first_row = None
+        self.last_row = None
+        self.loop_ids = set()
+        # Step statistics as counters (a per-step set would grow with the episode)
+        self.num_steps = 0
+        self.step_min = None
+        self.step_max = None
+        self._last_step = None
+        self.time_min = None
+        self.time_max = None
+
+        self.csv_path = os.path.join(exp_dir, "result.csv")
+        self.csv_partial_path = self.csv_path + ".partial"
+        self.parquet_path = os.path.join(exp_dir, "result.parquet")
+        self.parts_dir = self.parquet_path + ".parts"
+
+        # Leftovers from a previous (crashed) run would be merged otherwise
+        if os.path.exists(self.csv_partial_path):
+            os.remove(self.csv_partial_path)
+        if os.path.isdir(self.parts_dir):
+            shutil.rmtree(self.parts_dir)
+        if self.write_parquet:
+            os.makedirs(self.parts_dir, exist_ok=True)
+
+    def append_block(self, columns, count):
+        """
+        Append `count` rows given column-wise (one step of several loops)
+
+        Args:
+            columns: dict keyed by column name; values are arrays/lists of
+                length `count` or scalars (repeated on every row).
+                Missing columns are NaN/None.
+            count: Number of rows
+        """
+        if count <= 0:
+            return
+
+        block = {}
+        for name, dtype in self.columns:
+            value = columns.get(name)
+            if dtype is object:
+                if np.ndim(value) == 0:
+                    block[name] = np.full(count, value, dtype=object)
+                else:
+                    block[name] = np.asarray(value, dtype=object)
+            elif dtype is np.int64:
+                block[name] = np.broadcast_to(np.asarray(value, dtype=np.int64), (count,))
+            else:
+                if value is None:
+                    value = np.nan
+                elif np.ndim(value) > 0:
+                    value = _to_floats(value)
+                block[name] = np.broadcast_to(np.asarray(value, dtype=np.float64), (count,))
+
+        start = 0
+        while start < count:
+            n = min(count - start, self.capacity - self.size)
+            for name, _ in self.columns:
+                self.buffers[name][self.size:self.size + n] = block[name][start:start + n]
+            self.size += n
+            start += n
+            if self.size >= self.capacity:
+                self.flush()
+
+        def row(i):
+            return {name: block[name][i].item() if hasattr(block[name][i], 'item') else block[name][i]
+                    for name, _ in self.columns}
+
+        if self.first_row is None:
+            self.first_row = row(0)
+            self.time_min = int(block['Time'].min())
+            self.time_max = int(block['Time'].max())
+        self.last_row = row(count - 1)
+        self.loop_ids.update(block['LoopID'].tolist())
+        steps = block['Step']
+        # Blocks arrive in step order, so counting step changes counts distinct steps
+        self.num_steps += int(steps[0] != self._last_step) + int(np.count_nonzero(steps[1:] != steps[:-1]))
+        self._last_step = steps[-1]
+        self.step_min = int(steps.min()) if self.step_min is None else min(self.step_min, int(steps.min()))
+        self.step_max = int(steps.max()) if self.step_max is None else max(self.step_max, int(steps.max()))
+        self.time_min = min(self.time_min, int(block['Time'].min()))
+        self.time_max = max(self.time_max, int(block['Time'].max()))
+        self.total_rows += count
+
+    def __len__(self):
+        return self.total_rows
+
+    def _frame(self):
+        return pd.DataFrame({name: self.buffers[name][:self.size] for name, _ in self.columns})
+
+    def flush(self):
+        """Write buffered rows to the part files and reset the buffers"""
+        if self.size == 0:
+            return
+
+        df = self._frame()
+
+        if self.write_parquet:
+            part_path = os.path.join(self.parts_dir, f"part-{self.num_flushes:05d}.parquet")
+            pq.write_table(pa.Table.from_pandas(df, preserve_index=False), part_path)
+
+        if self.write_csv:
+            header = not os.path.exists(self.csv_partial_path)
+            df.to_csv(self.csv_partial_path, mode='a', header=header, index=False)
+
+        self.num_flushes += 1
+        self.size = 0
+
+    def finalize(self):
+        """
+        Flush remaining rows and atomically publish result.parquet / result.csv
+
+        Returns:
+            str: Path of result.csv (or result.parquet if CSV is disabled)
+        """
+        self.flush()
+
+        if self.write_parquet:
+            part_files = sorted(glob.glob(os.path.join(self.parts_dir, "part-*.parquet")))
+            tmp_path = self.parquet_path + ".tmp"
+            schema = self._arrow_schema()
+            with pq.ParquetWriter(tmp_path, schema) as writer:
+                for part_file in part_files:
+                    writer.write_table(pq.read_table(part_file).cast(schema))
+            os.replace(tmp_path, self.parquet_path)
+            shutil.rmtree(self.parts_dir)
+
+        if self.write_csv:
+            if not os.path.exists(self.csv_partial_path):
+                # No rows at all: still publish a header-only CSV
+                self._frame().to_csv(self.csv_partial_path, index=False)
+            os.replace(self.csv_partial_path, self.csv_path)
+            return self.csv_path
+
+        return self.parquet_path
+
+    def _arrow_schema(self):
+        fields = []
+        for name, dtype in self.columns:
+            if dtype is object:
+                fields.append(pa.field(name, pa.string()))
+            elif dtype is np.int64:
+                fields.append(pa.field(name, pa.int64()))
+            else:
+                fields.append(pa.field(name, pa.float64()))
+        return pa.schema(fields)
@@ -0,0 +1,283 @@
+"""
+Parallel Monte Carlo demand-scenario runner
+
+Runs one experiment config over many randomly perturbed demand patterns to
+measure controller robustness. Each scenario perturbs the demand patterns
+of the network:
+    - every pattern multiplier is scaled by lognormal noise
+      (exp(N(0, DEMAND_NOISE)), independent per pattern period)
+    - the global demand multiplier is drawn from
+      U(1 - DEMAND_SCALE_RANGE, 1 + DEMAND_SCALE_RANGE)
+Scenario i always uses the random stream (SCENARIO_SEED, i), so results do
+not depend on the number of workers or on scheduling.
+
+Scenarios run concurrently in a process pool. Each worker loads the
+network once into its own RemoteValveControlEnv (own epyt instance and,
+with the default inprocess transport, its own controller bank) and runs
+its scenarios as consecutive episodes.
+
+Per-scenario metrics are computed with metrics/analyze.py and appended to
+<OUTPUT_PATH>/<EXP_ID>/scenarios.csv as scenarios finish. At the end
+scenarios_summary.csv gives mean/std/quantiles of MAE, RMSE and IAE per
+loop (LoopID "ALL" = network-wide as in metrics.csv).
+
+    CONFIG_PATH=... EXP_ID=robust_pid SCENARIO_COUNT=200 python scenarios.py
+"""
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import util
+
+import numpy as np
+import pandas as pd
+
+
+# Metrics summarized across scenarios
+SUMMARY_METRICS = ["MAE", "RMSE", "IAE"]
+SUMMARY_QUANTILES = [0.05, 0.5, 0.95]
+
+# Per-process state of a pool worker
+_worker = {}
+
+
+def load_metrics_module(plugin_dir):
+    """Import metrics/analyze.py (mounted next to the controller plugins)"""
+    metrics_dir = os.path.join(plugin_dir, 'metrics')
+    if not os.path.isdir(metrics_dir):
+        raise FileNotFoundError(f"metrics directory not found: {metrics_dir}")
+    if metrics_dir not in sys.path:
+        sys.path.insert(0, metrics_dir)
+    import analyze
+    return analyze
+
+
+def demand_patterns(epanet_api):
+    """
+    Patterns used as junction demand patterns
+
+    Returns:
+        dict: pattern index -> original multipliers (np.ndarray)
+    """
+    junctions = np.atleast_1d(np.asarray(epanet_api.getNodeJunctionIndex(), dtype=int))
+    node_patterns = np.asarray(epanet_api.getNodePatternIndex(), dtype=int)
+    used = sorted(set(node_patterns[junctions - 1].tolist()) - {0})
+    return {
+        index: np.asarray(epanet_api.getPattern()[index - 1][:epanet_api.getPatternLengths(index)], dtype=float)
+        for index in used
+    }
+
+
+def perturb_demands(rng, base_patterns, noise, scale_range):
+    """
+    Draw one demand scenario
+
+    Args:
+        rng: np.random.Generator of the scenario
+        base_patterns: dict from demand_patterns()
+        noise: Standard deviation of the lognormal multiplier noise
+        scale_range: Half width of the global demand multiplier range
+
+    Returns:
+        (patterns, demand_multiplier)
+    """
+    patterns = {
+        index: values * np.exp(rng.normal(0.0, noise, size=values.shape))
+        for index, values in base_patterns.items()
+    }
+    demand_multiplier = float(rng.uniform(1.0 - scale_range, 1.0 + scale_range))
+    return patterns, demand_multiplier
+
+
+def private_network_dir(config_path, network_dir):
+    """
+    Copy the experiment's INP file into a temporary directory of this process
+
+    epyt writes <inp>_temp.inp/.txt/.bin next to the INP it loads, so
+    workers loading the same file would overwrite each other's copies.
+    The directory is removed when the worker exits.
+    """
+    with open(config_path, 'r') as f:
+        inp_file = json.load(f).get('network', {}).get('inp_file', 'Net1.inp')
+    private_dir = tempfile.mkdtemp(prefix=f"scenario_net_{os.getpid()}_")
+    shutil.copy(os.path.join(network_dir, inp_file), os.path.join(private_dir, inp_file))
+    util.Finalize(None, shutil.rmtree, args=(private_dir, True), exitpriority=10)
+    return private_dir
+
+
+def _init_worker(config_path, network_dir, controller_url, output_root, exp_id, log_dir):
+    """Pool initializer: load the network once per worker process"""
+    # Worker output goes to a log file; the parent prints progress
+    log = open(os.path.join(log_dir, f"worker_{os.getpid()}.log"), 'w', buffering=1)
+    sys.stdout = log
+    sys.stderr = log
+
+    from main import RemoteValveControlEnv
+    env = RemoteValveControlEnv(config_path, private_network_dir(config_path, network_dir),
+                                controller_url, output_root, exp_id)
+    _worker["env"] = env
+    _worker["base_patterns"] = demand_patterns(env.epanet_api)
+    _worker["base_multiplier"] = float(env.epanet_api.getOptionsPatternDemandMultiplier())
+    _worker["metrics"] = load_metrics_module(os.environ.get('CONTROLLER_PLUGIN_DIR', '/plugins'))
+
+
+def _run_scenario(scenario, seed, noise, scale_range, scenarios_root, exp_id):
+    """Run one scenario in a pool worker and return its metric rows"""
+    env = _worker["env"]
+    rng = np.random.default_rng([seed, scenario])
+    patterns, demand_multiplier = perturb_demands(rng, _worker["base_patterns"], noise, scale_range)
+
+    for index, values in patterns.items():
+        env.epanet_api.setPattern(index, values.tolist())
+    env.epanet_api.setOptionsPatternDemandMultiplier(_worker["base_multiplier"] * demand_multiplier)
+
+    env.set_output(f"{exp_id}_s{scenario:04d}", scenarios_root)
+    summary = env.run()
+
+    metrics = _worker["metrics"].calculate_metrics(os.path.join(env.exp_dir, "result.csv")) or []
+    for row in metrics:
+        row.update({
+            "Scenario": scenario,
+            "DemandMultiplier": demand_multiplier,
+            "LoopSeconds": summary["loop_s"],
+            "Steps": summary["steps"],
+            "Worker": os.getpid(),
+        })
+    return scenario, metrics
+
+
+def summarize(df, failed=0):
+    """
+    Mean/std/quantiles of the summary metrics per loop over all scenarios
+
+    Args:
+        df: Rows of scenarios.csv
+        failed: Number of scenarios that failed (reported on every row)
+
+    Returns:
+        pd.DataFrame: One row per LoopID
+    """
+    rows = []
+    for loop_id, group in df.groupby("LoopID", sort=False):
+        row = {"LoopID": loop_id, "Scenarios": int(group["Scenario"].nunique()), "ScenariosFailed": failed}
+        for metric in SUMMARY_METRICS:
+            values = group[metric].astype(float)
+            row[f"{metric}_mean"] = values.mean()
+            row[f"{metric}_std"] = values.std()
+            for q in SUMMARY_QUANTILES:
+                row[f"{metric}_p{int(q * 100)}"] = values.quantile(q)
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def run_scenarios(config_path, network_dir, controller_url, output_root, exp_id,
+                  count=100, seed=0, workers=None, noise=0.1, scale_range=0.2):
+    """
+    Run `count` demand scenarios in a process pool
+
+    Returns:
+        pd.DataFrame: Aggregated summary (also written to scenarios_summary.csv)
+    """
+    workers = workers or os.cpu_count() or 1
+    exp_dir = os.path.join(output_root, exp_id)
+    scenarios_root = os.path.join(exp_dir, "scenarios")
+    os.makedirs(scenarios_root, exist_ok=True)
+
+    table_path = os.path.join(exp_dir, "scenarios.csv")
+    if os.path.exists(table_path):
+        os.remove(table_path)
+
+    print(f"Running {count} demand scenarios on {workers} workers "
+          f"(seed={seed}, noise={noise}, scale_range=±{scale_range})")
+    print(f"  Worker logs: {scenarios_root}/worker_*.log")
+
+    failed_path = os.path.join(exp_dir, "scenarios_failed.csv")
+    if os.path.exists(failed_path):
+        os.remove(failed_path)
+
+    start = time.perf_counter()
+    done = 0
+    failed = []
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_worker,
+        initargs=(config_path, network_dir, controller_url, output_root, exp_id, scenarios_root)
+    ) as pool:
+        futures = {
+            pool.submit(_run_scenario, scenario, seed, noise, scale_range, scenarios_root, exp_id): scenario
+            for scenario in range(count)
+        }
+        for future in as_completed(futures):
+            done += 1
+            # A failed scenario (or a dead worker) must not lose the others
+            try:
+                scenario, metrics = future.result()
+            except Exception as e:
+                scenario = futures[future]
+                failed.append({"Scenario": scenario, "Error": f"{type(e).__name__}: {e}"})
+                print(f"  [{done}/{count}] scenario {scenario}: FAILED ({type(e).__name__}: {e})")
+                continue
+            if metrics:
+                # Stream rows as scenarios finish
+                pd.DataFrame(metrics).to_csv(table_path, mode='a', header=not os.path.exists(table_path),
+                                             index=False)
+                overall = next((m for m in metrics if m["LoopID"] == "ALL"), metrics[0])
+                print(f"  [{done}/{count}] scenario {scenario}: MAE={overall['MAE']:.3f} "
+                      f"RMSE={overall['RMSE']:.3f} IAE={overall['IAE']:.1f}")
+            else:
+                print(f"  [{done}/{count}] scenario {scenario}: no metrics (see worker log)")
+
+    elapsed = time.perf_counter() - start
+    print(f"{count} scenarios in {elapsed:.1f}s ({count / elapsed if elapsed > 0 else 0.0:.2f} scenarios/s)")
+
+    if failed:
+        pd.DataFrame(failed).sort_values("Scenario").to_csv(failed_path, index=False)
+        print(f"[WARNING] {len(failed)}/{count} scenarios failed: {failed_path}")
+
+    if not os.path.exists(table_path):
+        print("[WARNING] No scenario produced metrics")
+        return pd.DataFrame()
+
+    summary = summarize(pd.read_csv(table_path), failed=len(failed))
+    summary_path = os.path.join(exp_dir, "scenarios_summary.csv")
+    summary.to_csv(summary_path, index=False)
+    print(f"Scenario table: {table_path}")
+    print(f"Scenario summary: {summary_path}")
+    for _, row in summary.iterrows():
+        print(f"  {row['LoopID']}: MAE {row['MAE_mean']:.3f} (p5 {row['MAE_p5']:.3f}, p95 {row['MAE_p95']:.3f}), "
+              f"RMSE {row['RMSE_mean']:.3f}, IAE {row['IAE_mean']:.1f}")
+    return summary
+
+
+if __name__ == "__main__":
+    # Scenarios need no images. A shared controller service would mix the state
+    # of concurrent scenarios (each worker's init resets the others), so workers
+    # use in-process controllers. docker-compose always sets
+    # CONTROLLER_TRANSPORT=http, hence the explicit opt-in for the service.
+    os.environ['ENABLE_IMAGE_GENERATION'] = 'false'
+    os.environ['SAVE_IMAGES'] = 'false'
+    # Wall-clock PID sampling would make scenario results depend on the host load
+    os.environ.setdefault('PID_DT_HYDRAULIC_STEP', 'true')
+    shared_service = os.environ.get('SCENARIO_SHARED_CONTROLLER', 'false').lower() == 'true'
+    if os.environ.get('CONTROLLER_TRANSPORT', 'http') == 'http' and not shared_service:
+        print("Scenario workers use in-process controllers (CONTROLLER_TRANSPORT=inprocess); "
+              "set SCENARIO_SHARED_CONTROLLER=true to use the controller service")
+        os.environ['CONTROLLER_TRANSPORT'] = 'inprocess'
+    elif os.environ.get('CONTROLLER_TRANSPORT', 'http') == 'http':
+        print("[WARNING] SCENARIO_SHARED_CONTROLLER=true: concurrent scenarios share one controller service")
+
+    run_scenarios(
+        os.environ.get('CONFIG_PATH', '/shared/configs/exp_001.json'),
+        os.environ.get('NETWORK_DIR', '/shared/networks'),
+        os.environ.get('CONTROLLER_URL', 'http://localhost:5000/control'),
+        os.environ.get('OUTPUT_PATH', '/shared/results'),
+        os.environ.get('EXP_ID', 'exp_default'),
+        count=int(os.environ.get('SCENARIO_COUNT', '100')),
+        seed=int(os.environ.get('SCENARIO_SEED', '0')),
+        workers=int(os.environ.get('SCENARIO_WORKERS', '0')) or None,
+        noise=float(os.environ.get('DEMAND_NOISE', '0.1')),
+        scale_range=float(os.environ.get('DEMAND_SCALE_RANGE', '0.2'))
+    )
@@ -0,0 +1,101 @@
+"""
+sim-runner/service.py
+
+常駐型 sim-runner サービス。
+
+main.py はエピソードごとにプロセス（コンテナ）を起動し、そのたびに
+pandas / epyt の import と INP ファイルの読み込みを行う。このサービスは
+RemoteValveControlEnv を保持したまま /run のたびに1エピソードを実行するため、
+N エピソードでも起動コストは1回分になる（エピソード間は水理ソルバーの
+再初期化のみ）。
+
+    python service.py                      # ポート5000で待ち受け
+    curl -X POST localhost:5000/run -d '{}' -H 'Content-Type: application/json'
+"""
+import os
+import threading
+import traceback
+
+from flask import Flask, request, jsonify
+
+from main import RemoteValveControlEnv
+
+app = Flask(__name__)
+
+NETWORK_DIR = os.environ.get('NETWORK_DIR', '/shared/networks')
+CONTROLLER_URL = os.environ.get('CONTROLLER_URL', 'http://localhost:5000/control')
+OUTPUT_PATH = os.environ.get('OUTPUT_PATH', '/shared/results')
+DEFAULT_CONFIG_PATH = os.environ.get('CONFIG_PATH', '/shared/configs/exp_001.json')
+DEFAULT_EXP_ID = os.environ.get('EXP_ID', 'exp_default')
+
+# (config_path, exp_id) -> RemoteValveControlEnv（ネットワーク読み込み済み）
+envs = {}
+# エピソードは1つずつ実行する（epyt インスタンスはスレッドセーフではない）
+run_lock = threading.Lock()
+
+
+@app.route('/run', methods=['POST'])
+def run_episode():
+    """
+    1エピソードを実行して終了後に結果を返す
+
+    Request body (すべて省略可):
+        {"config_path": "...", "exp_id": "..."}
+
+    Returns:
+        エピソードのサマリー（episode, load_s, setup_s, loop_s, steps, records）
+    """
+    data = request.get_json(silent=True) or {}
+    config_path = data.get('config_path', DEFAULT_CONFIG_PATH)
+    exp_id = data.get('exp_id', DEFAULT_EXP_ID)
+
+    if not run_lock.acquire(blocking=False):
+        return jsonify({"error": "An episode is already running"}), 409
+
+    try:
+        key = (config_path, exp_id)
+        env = envs.get(key)
+        if env is None:
+            env = RemoteValveControlEnv(config_path, NETWORK_DIR, CONTROLLER_URL, OUTPUT_PATH, exp_id)
+            envs[key] = env
+        summary = env.run()
+        summary["exp_id"] = exp_id
+        return jsonify(summary)
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"error": str(e)}), 500
+    finally:
+        run_lock.release()
+
+
+@app.route('/status', methods=['GET'])
+def status():
+    """読み込み済みの環境と実行状況"""
+    return jsonify({
+        "running": run_lock.locked(),
+        "environments": [
+            {"config_path": config_path, "exp_id": exp_id, "episodes": env.episode}
+            for (config_path, exp_id), env in envs.items()
+        ]
+    })
+
+
+@app.route('/health', methods=['GET'])
+def health():
+    return jsonify({"status": "healthy"})
+
+
+if __name__ == '__main__':
+    print("=" * 60)
+    print("sim-runner service")
+    print("=" * 60)
+    print(f"Default config: {DEFAULT_CONFIG_PATH}")
+    print(f"Default exp_id: {DEFAULT_EXP_ID}")
+    print(f"Controller: {CONTROLLER_URL}")
+    print("=" * 60)
+
+    try:
+        app.run(host='0.0.0.0', port=int(os.environ.get('SIM_RUNNER_PORT', '5000')), debug=False, threaded=True)
+    finally:
+        for env in envs.values():
+            env.close()
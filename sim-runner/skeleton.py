@@ -0,0 +1,428 @@
+"""
+Network skeletonization for fast training runs
+
+The controllers only observe the nodes and links of `control_loops`, yet
+every step solves the whole network. skeletonize() writes a reduced INP
+of the experiment's network:
+
+    dead ends       a junction hanging on a single pipe is removed and its
+                    demand moved to the neighbouring junction (repeated,
+                    so whole branches collapse)
+    series pipes    a junction joining exactly two pipes is removed; the
+                    pipes become one pipe with the same head loss (equal
+                    flow) and the demand is split onto both ends by distance
+
+Moving a dead end's demand to its neighbour is exact; splitting the demand
+of a series junction is not. Junctions whose peak demand (base demand x
+largest pattern multiplier) exceeds `merge_demand` of the network's total
+peak demand are therefore not merged (SKELETON_MERGE_DEMAND, default 1%).
+
+Controlled nodes, actuator links, tanks, reservoirs, pumps, valves, check
+valves, closed pipes, quality sources, emitters and every element used by
+a control or rule are kept. Patterns, curves, controls and options are
+written unchanged by the toolkit (EN_saveinpfile).
+
+compare_networks() solves the full network and the skeleton with the
+initial valve settings of the config and reports the error at the
+controlled nodes / actuator links and the solver speedup.
+RemoteValveControlEnv trains on a skeleton with SKELETON_NETWORK and
+replays episodes on the full network (SKELETON_VALIDATE_EVERY).
+
+Usage:
+    python skeleton.py CONFIG.json SKELETON.inp    # writes SKELETON.inp and SKELETON.json
+"""
+import json
+import os
+import sys
+
+import numpy as np
+
+
+# EN_deletenode / EN_deletelink: refuse to delete an element used by a control
+EN_CONDITIONAL = 1
+DEFAULT_MERGE_DEMAND = 0.01
+
+
+def protected_elements(epanet_api, control_loops):
+    """
+    Node and link IDs the skeleton must keep
+
+    Returns:
+        (node_ids, link_ids): sets of IDs
+    """
+    api, c = epanet_api.api, epanet_api.ToolkitConstants
+    nodes = {str(loop['target']['node_id']) for loop in control_loops}
+    links = {str(loop['actuator']['link_id']) for loop in control_loops}
+
+    for i in range(1, api.ENgetcount(c.EN_CONTROLCOUNT) + 1):
+        _, link_index, _, node_index, _ = api.ENgetcontrol(i)
+        links.add(api.ENgetlinkid(link_index))
+        if node_index:
+            nodes.add(api.ENgetnodeid(node_index))
+    for rule in range(1, api.ENgetcount(c.EN_RULECOUNT) + 1):
+        premises, then_actions, else_actions, _ = api.ENgetrule(rule)
+        for p in range(1, premises + 1):
+            _, rule_object, object_index = api.ENgetpremise(rule, p)[:3]
+            if rule_object == c.EN_R_NODE:
+                nodes.add(api.ENgetnodeid(object_index))
+            elif rule_object == c.EN_R_LINK:
+                links.add(api.ENgetlinkid(object_index))
+        for a in range(1, then_actions + 1):
+            links.add(api.ENgetlinkid(api.ENgetthenaction(rule, a)[0]))
+        for a in range(1, else_actions + 1):
+            links.add(api.ENgetlinkid(api.ENgetelseaction(rule, a)[0]))
+
+    for i in range(1, api.ENgetcount(c.EN_NODECOUNT) + 1):
+        if api.ENgetnodevalue(i, c.EN_EMITTER) > 0:
+            nodes.add(api.ENgetnodeid(i))
+            continue
+        # Nodes without a quality source answer with error 240 (epyt returns the code)
+        quality = api.ENgetnodevalue(i, c.EN_SOURCEQUAL)
+        if api.errcode != 240 and quality != 0:
+            nodes.add(api.ENgetnodeid(i))
+    return nodes, links
+
+
+def read_network(epanet_api):
+    """
+    Graph and pipe data of a loaded network
+
+    Returns:
+        (nodes, links): dicts keyed by ID. Junction demands are summed per pattern index.
+    """
+    api, c = epanet_api.api, epanet_api.ToolkitConstants
+    nodes = {}
+    for i in range(1, api.ENgetcount(c.EN_NODECOUNT) + 1):
+        node_type = api.ENgetnodetype(i)
+        demands = {}
+        if node_type == c.EN_JUNCTION:
+            for k in range(1, api.ENgetnumdemands(i) + 1):
+                pattern = api.ENgetdemandpattern(i, k)
+                demands[pattern] = demands.get(pattern, 0.0) + api.ENgetbasedemand(i, k)
+        nodes[api.ENgetnodeid(i)] = {"type": node_type, "demands": demands, "changed": False}
+
+    links = {}
+    for i in range(1, api.ENgetcount(c.EN_LINKCOUNT) + 1):
+        from_index, to_index = api.ENgetlinknodes(i)
+        links[api.ENgetlinkid(i)] = {
+            "type": api.ENgetlinktype(i),
+            "from": api.ENgetnodeid(from_index),
+            "to": api.ENgetnodeid(to_index),
+            "length": api.ENgetlinkvalue(i, c.EN_LENGTH),
+            "diameter": api.ENgetlinkvalue(i, c.EN_DIAMETER),
+            "roughness": api.ENgetlinkvalue(i, c.EN_ROUGHNESS),
+            "minorloss": api.ENgetlinkvalue(i, c.EN_MINORLOSS),
+            "open": api.ENgetlinkvalue(i, c.EN_INITSTATUS) != 0,
+            "merged": False,
+        }
+    return nodes, links
+
+
+def pattern_peaks(epanet_api):
+    """
+    Largest absolute multiplier of every time pattern
+
+    Returns:
+        dict: pattern index -> peak multiplier (index 0, no pattern: 1.0)
+    """
+    api, c = epanet_api.api, epanet_api.ToolkitConstants
+    peaks = {0: 1.0}
+    for i in range(1, api.ENgetcount(c.EN_PATCOUNT) + 1):
+        values = [abs(api.ENgetpatternvalue(i, k)) for k in range(1, api.ENgetpatternlen(i) + 1)]
+        peaks[i] = max(values) if values else 1.0
+    return peaks
+
+
+def peak_demand(node, peaks):
+    """Base demand x peak pattern multiplier, summed over the node's demand categories"""
+    return sum(abs(base) * peaks.get(pattern, 1.0) for pattern, base in node["demands"].items())
+
+
+def equivalent_pipe(pipes, headloss_formula):
+    """
+    One pipe with the head loss of several pipes in series (same flow)
+
+    The diameter of the longest pipe is kept and the roughness adjusted
+    (Hazen-Williams, Chezy-Manning). For Darcy-Weisbach the friction
+    factor is taken as equal, so the diameter is adjusted instead and the
+    roughness is length-weighted. Minor losses are scaled to the new
+    diameter (same velocity head).
+
+    Args:
+        pipes: link dicts (read_network)
+        headloss_formula: EN_HW (0), EN_DW (1) or EN_CM (2)
+
+    Returns:
+        dict: length, diameter, roughness, minorloss
+    """
+    length = sum(p["length"] for p in pipes)
+    diameter = max(pipes, key=lambda p: p["length"])["diameter"]
+    if headloss_formula == 0:
+        # h ~ L / (C^1.852 D^4.87)
+        resistance = sum(p["length"] / (p["roughness"] ** 1.852 * p["diameter"] ** 4.87) for p in pipes)
+        roughness = (length / (resistance * diameter ** 4.87)) ** (1 / 1.852)
+    elif headloss_formula == 2:
+        # h ~ n^2 L / D^5.33
+        resistance = sum(p["roughness"] ** 2 * p["length"] / p["diameter"] ** 5.33 for p in pipes)
+        roughness = (resistance * diameter ** 5.33 / length) ** 0.5
+    else:
+        # h ~ f L / D^5
+        diameter = (length / sum(p["length"] / p["diameter"] ** 5 for p in pipes)) ** 0.2
+        roughness = sum(p["roughness"] * p["length"] for p in pipes) / length
+    minorloss = sum(p["minorloss"] * (diameter / p["diameter"]) ** 4 for p in pipes)
+    return {"length": length, "diameter": diameter, "roughness": roughness, "minorloss": minorloss}
+
+
+def _add_demands(node, demands, weight):
+    for pattern, base in demands.items():
+        if base != 0 and weight > 0:
+            node["demands"][pattern] = node["demands"].get(pattern, 0.0) + weight * base
+            node["changed"] = True
+
+
+def reduce_network(nodes, links, keep_nodes, keep_links, headloss_formula, peaks=None,
+                   merge_demand_limit=float('inf'), junction_type=0, pipe_type=1):
+    """
+    Remove dead ends and merge series pipes until nothing changes (in place)
+
+    Args:
+        nodes, links: read_network() output, modified in place
+        keep_nodes, keep_links: protected_elements() output
+        headloss_formula: see equivalent_pipe()
+        peaks: pattern_peaks() output (default: every multiplier 1)
+        merge_demand_limit: Series junctions with a larger peak demand are kept
+
+    Returns:
+        dict: trimmed (dead-end junctions removed), merged (series junctions
+            removed), kept_for_demand (series junctions kept by the limit)
+    """
+    peaks = peaks or {}
+    adjacency = {node_id: set() for node_id in nodes}
+    for link_id, link in links.items():
+        adjacency[link["from"]].add(link_id)
+        adjacency[link["to"]].add(link_id)
+
+    def removable(node_id):
+        return nodes[node_id]["type"] == junction_type and node_id not in keep_nodes
+
+    def plain_pipe(link_id):
+        link = links[link_id]
+        return link["type"] == pipe_type and link["open"] and link_id not in keep_links
+
+    def other_end(link_id, node_id):
+        link = links[link_id]
+        return link["to"] if link["from"] == node_id else link["from"]
+
+    def drop_link(link_id):
+        link = links.pop(link_id)
+        adjacency[link["from"]].discard(link_id)
+        adjacency[link["to"]].discard(link_id)
+
+    def drop_node(node_id):
+        del nodes[node_id]
+        del adjacency[node_id]
+
+    counts = {"trimmed": 0, "merged": 0, "kept_for_demand": 0}
+    changed = True
+    while changed:
+        changed = False
+
+        # Dead ends (the neighbour may become one in turn)
+        queue = sorted(nodes)
+        while queue:
+            node_id = queue.pop()
+            if node_id not in nodes or not removable(node_id) or len(adjacency[node_id]) != 1:
+                continue
+            (link_id,) = adjacency[node_id]
+            neighbour = other_end(link_id, node_id)
+            # Tanks and reservoirs carry no demand
+            if not plain_pipe(link_id) or nodes[neighbour]["type"] != junction_type:
+                continue
+            _add_demands(nodes[neighbour], nodes[node_id]["demands"], 1.0)
+            drop_link(link_id)
+            drop_node(node_id)
+            queue.append(neighbour)
+            counts["trimmed"] += 1
+            changed = True
+
+        # Series pipes
+        counts["kept_for_demand"] = 0
+        for node_id in sorted(nodes):
+            if node_id not in nodes or not removable(node_id) or len(adjacency[node_id]) != 2:
+                continue
+            first, second = sorted(adjacency[node_id])
+            if not (plain_pipe(first) and plain_pipe(second)):
+                continue
+            a, b = other_end(first, node_id), other_end(second, node_id)
+            a_junction = nodes[a]["type"] == junction_type
+            b_junction = nodes[b]["type"] == junction_type
+            if a == b or not (a_junction or b_junction):
+                continue
+            if peak_demand(nodes[node_id], peaks) > merge_demand_limit:
+                counts["kept_for_demand"] += 1
+                continue
+            # Demand split by distance: the closer end takes the larger share
+            length_a, length_b = links[first]["length"], links[second]["length"]
+            weight_a = length_b / (length_a + length_b) if length_a + length_b > 0 else 0.5
+            if not b_junction:
+                weight_a = 1.0
+            elif not a_junction:
+                weight_a = 0.0
+            _add_demands(nodes[a], nodes[node_id]["demands"], weight_a)
+            _add_demands(nodes[b], nodes[node_id]["demands"], 1.0 - weight_a)
+
+            # The merged pipe keeps the ID of the longer pipe
+            merged_id = first if length_a >= length_b else second
+            merged = dict(links[merged_id])
+            merged.update(equivalent_pipe([links[first], links[second]], headloss_formula))
+            merged.update({"from": a, "to": b, "merged": True})
+            drop_link(first)
+            drop_link(second)
+            drop_node(node_id)
+            links[merged_id] = merged
+            adjacency[a].add(merged_id)
+            adjacency[b].add(merged_id)
+            counts["merged"] += 1
+            changed = True
+    return counts
+
+
+def _write_reduced(epanet_api, original_nodes, original_links, nodes, links, output_path):
+    """Apply a reduced graph to the loaded network and save it as INP"""
+    api, c = epanet_api.api, epanet_api.ToolkitConstants
+    for link_id in original_links:
+        if link_id not in links or links[link_id]["merged"]:
+            api.ENdeletelink(api.ENgetlinkindex(link_id), EN_CONDITIONAL)
+    for node_id in original_nodes:
+        if node_id not in nodes:
+            api.ENdeletenode(api.ENgetnodeindex(node_id), EN_CONDITIONAL)
+    for link_id, link in links.items():
+        if link["merged"]:
+            index = api.ENaddlink(link_id, c.EN_PIPE, link["from"], link["to"])
+            api.ENsetpipedata(index, link["length"], link["diameter"], link["roughness"], link["minorloss"])
+    for node_id, node in nodes.items():
+        if not node["changed"]:
+            continue
+        index = api.ENgetnodeindex(node_id)
+        for _ in range(api.ENgetnumdemands(index)):
+            api.ENdeletedemand(index, 1)
+        for pattern, base in node["demands"].items():
+            api.ENadddemand(index, base, api.ENgetpatternid(pattern) if pattern else "", "")
+    api.ENsaveinpfile(output_path)
+
+
+def skeletonize(network_path, control_loops, output_path, merge_demand=DEFAULT_MERGE_DEMAND):
+    """
+    Write the skeleton of a network
+
+    Args:
+        network_path: Full network INP
+        control_loops: `control_loops` of the experiment config (elements to keep)
+        output_path: Skeleton INP
+        merge_demand: Largest peak demand of a merged series junction, as a
+            fraction of the total peak demand
+
+    Returns:
+        dict: Node/link counts before and after, reduction ratios, trimmed/merged junctions
+    """
+    from epyt import epanet
+
+    d = epanet(network_path)
+    try:
+        keep_nodes, keep_links = protected_elements(d, control_loops)
+        nodes, links = read_network(d)
+        original_nodes, original_links = list(nodes), list(links)
+        peaks = pattern_peaks(d)
+        total_peak = sum(peak_demand(node, peaks) for node in nodes.values())
+        c = d.ToolkitConstants
+        counts = reduce_network(nodes, links, keep_nodes, keep_links, int(d.api.ENgetoption(c.EN_HEADLOSSFORM)),
+                                peaks, merge_demand * total_peak, c.EN_JUNCTION, c.EN_PIPE)
+        _write_reduced(d, original_nodes, original_links, nodes, links, output_path)
+    finally:
+        d.unload()
+    return {
+        "nodes": len(original_nodes),
+        "links": len(original_links),
+        "skeleton_nodes": len(nodes),
+        "skeleton_links": len(links),
+        "node_reduction": 1.0 - len(nodes) / len(original_nodes) if original_nodes else 0.0,
+        "link_reduction": 1.0 - len(links) / len(original_links) if original_links else 0.0,
+        "merge_demand": merge_demand,
+        **counts,
+    }
+
+
+def compare_networks(network_path, skeleton_path, control_loops, duration, hydraulic_step):
+    """
+    Error of the skeleton at the control loops with the initial valve settings
+
+    Returns:
+        dict: Solver seconds and speedup, and per loop the pressure (target
+            node) and flow (actuator link) RMSE / max abs error
+    """
+    from fidelity import replay
+
+    times = np.zeros(1, dtype=np.int64)
+    valves = np.array([[float(loop['actuator']['initial_setting']) for loop in control_loops]])
+    full = replay(network_path, control_loops, times, valves, duration, hydraulic_step, None)
+    skeleton = replay(skeleton_path, control_loops, times, valves, duration, hydraulic_step, None)
+    _, in_full, in_skeleton = np.intersect1d(full["times"], skeleton["times"], return_indices=True)
+    dp = skeleton["pressure"][in_skeleton] - full["pressure"][in_full]
+    dq = skeleton["flow"][in_skeleton] - full["flow"][in_full]
+    loops = []
+    for i, loop in enumerate(control_loops):
+        loops.append({
+            "loop_id": str(loop['loop_id']),
+            "pressure_rmse": float(np.sqrt(np.mean(dp[:, i] ** 2))) if dp.size else 0.0,
+            "pressure_max_abs": float(np.max(np.abs(dp[:, i]))) if dp.size else 0.0,
+            "flow_rmse": float(np.sqrt(np.mean(dq[:, i] ** 2))) if dq.size else 0.0,
+            "flow_max_abs": float(np.max(np.abs(dq[:, i]))) if dq.size else 0.0,
+        })
+    return {
+        "compared_steps": int(in_full.size),
+        "solver_s": full["solver_s"],
+        "skeleton_solver_s": skeleton["solver_s"],
+        "speedup": full["solver_s"] / skeleton["solver_s"] if skeleton["solver_s"] > 0 else 0.0,
+        "loops": loops,
+    }
+
+
+def build_skeleton(config, network_path, output_path, merge_demand=DEFAULT_MERGE_DEMAND):
+    """
+    Skeletonize, compare and write the report next to the skeleton (.json)
+
+    Returns:
+        dict: skeletonize() and compare_networks() results
+    """
+    control_loops = config.get('control_loops', [])
+    report = skeletonize(network_path, control_loops, output_path, merge_demand)
+    report.update(compare_networks(network_path, output_path, control_loops,
+                                   config['simulation']['duration'], config['simulation']['hydraulic_step']))
+    report["network"] = os.path.basename(network_path)
+    report_path = os.path.splitext(output_path)[0] + ".json"
+    with open(report_path, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    print(f"Skeleton: {output_path} ({report['network']}: nodes {report['nodes']} -> {report['skeleton_nodes']}, "
+          f"links {report['links']} -> {report['skeleton_links']}, "
+          f"reduction {report['node_reduction']:.0%} / {report['link_reduction']:.0%}; "
+          f"{report['trimmed']} dead ends, {report['merged']} series junctions, "
+          f"{report['kept_for_demand']} kept for their demand)")
+    print(f"  Solver: {report['solver_s'] * 1000:.1f} ms -> {report['skeleton_solver_s'] * 1000:.1f} ms "
+          f"({report['speedup']:.2f}x) over {report['compared_steps']} steps")
+    for loop in report["loops"]:
+        print(f"  {loop['loop_id']}: pressure RMSE {loop['pressure_rmse']:.4f} (max {loop['pressure_max_abs']:.4f}), "
+              f"flow RMSE {loop['flow_rmse']:.4f} (max {loop['flow_max_abs']:.4f})")
+    print(f"  Report: {report_path}")
+    return report
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print(__doc__)
+        sys.exit(1)
+    with open(sys.argv[1], 'r') as f:
+        experiment = json.load(f)
+    inp_file = experiment.get('network', {}).get('inp_file', 'Net1.inp')
+    build_skeleton(experiment, os.path.join(os.environ.get('NETWORK_DIR', '/shared/networks'), inp_file),
+                   sys.argv[2], float(os.environ.get('SKELETON_MERGE_DEMAND', DEFAULT_MERGE_DEMAND)))
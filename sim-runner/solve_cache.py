@@ -0,0 +1,332 @@
+"""
+Memoized hydraulic solves for repeated training states
+
+Multi-episode training keeps solving nearly the same hydraulic state:
+same time of day, same demand pattern, valve settings a tiny delta apart.
+With SOLVE_CACHE=true the step solve is memoized on
+
+    (pattern time, quantized loop valve settings, quantized tank levels,
+     status of the links switched by level controls)
+
+pattern time is the time within the longest demand pattern (pattern start
++ hydraulic time, modulo pattern step x pattern length). Valve settings
+are binned by SOLVE_CACHE_VALVE_QUANTUM (setting units), tank levels by
+SOLVE_CACHE_TANK_QUANTUM (network length units). The control link
+statuses are part of the key because level controls with a dead band
+(pump on below 17.1, off above 19.1) depend on history, not only on the
+current level.
+
+A cache entry holds what the step loop takes from a solve: the loop
+pressures/flows, the control link statuses after the solve and how far
+the tank levels moved until the next step. On a hit EN_runH is skipped:
+
+    - the control link statuses of the entry are written (EN_STATUS),
+      as the controls evaluated by EN_runH would have switched them
+    - EN_nextH advances the clock, integrating the tanks with the flows
+      of the last real solve
+    - the tank levels are set to the level at the start of the step plus
+      the cached change (EN_TANKLEVEL)
+
+EN_nextH shortens a step when a tank fills/drains or a control fires, and
+with stale flows it cannot see such an event coming. Only entries that
+advanced a full hydraulic step are served, so the clock never runs past
+an event the real solve would have stopped at; steps that end early are
+always solved. When the stale flows end a served step early (a tank they
+would fill), EN_nextH is called again until the full step has elapsed,
+with the tank levels set in proportion at every stop. Timer controls
+(AT TIME / AT CLOCKTIME) only fire in a solve at exactly their time, so
+those steps are always solved too. Rule-based controls are evaluated by
+EN_nextH and see the stale flows on a hit; their error shows up in the
+verification.
+
+EN_TANKLEVEL and EN_STATUS also overwrite the initial levels/statuses;
+the caller resets the network before the next episode
+(snapshot.reset_network).
+
+Entries are evicted least recently used beyond SOLVE_CACHE_MAX_ENTRIES.
+The cache lives across the episodes of one process and is saved after
+every episode (SOLVE_CACHE_PATH, default <exp_dir>/solve_cache.npz), so
+a later experiment on the same network and settings can start from it.
+
+Every SOLVE_CACHE_VERIFY_EVERY-th hit is solved anyway and compared with
+the cached entry; the largest pressure/flow/tank deviation seen is the
+error bound of the quantization, reported per episode in solve_cache.csv
+together with the hit rate and the solver time saved.
+"""
+import json
+import os
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+CACHE_VERSION = 1
+
+
+class SolveCache:
+    """LRU memo of step solves around a NetworkIO (same solve/read/advance interface)"""
+
+    def __init__(self, epanet_api, network_io, loops, valve_quantum=0.01, tank_quantum=0.01,
+                 max_entries=100000, verify_every=0, meta=None):
+        """
+        Args:
+            epanet_api: epyt epanet instance
+            network_io: NetworkIO of the control loops
+            loops: LoopState; current_valve is the setting in effect at each solve
+            valve_quantum: Bin width of the loop valve settings
+            tank_quantum: Bin width of the tank levels
+            max_entries: LRU bound
+            verify_every: Solve every N-th hit anyway to measure the error (0 = never)
+            meta: Extra identification stored with the file (network, step, profile, ...)
+        """
+        if valve_quantum <= 0 or tank_quantum <= 0:
+            raise ValueError("Solve cache quanta must be positive")
+        self.api = epanet_api
+        self.network_io = network_io
+        self.loops = loops
+        self.valve_quantum = float(valve_quantum)
+        self.tank_quantum = float(tank_quantum)
+        self.max_entries = max(1, int(max_entries))
+        self.verify_every = max(0, int(verify_every))
+
+        constants = epanet_api.ToolkitConstants
+        self._en_head = constants.EN_HEAD
+        self._en_tanklevel = constants.EN_TANKLEVEL
+        self._en_status = constants.EN_STATUS
+        self._en_timer = constants.EN_TIMER
+        self._en_timeofday = constants.EN_TIMEOFDAY
+        self.tank_idx = np.atleast_1d(np.asarray(epanet_api.getNodeTankIndex(), dtype=int)).tolist()
+        self.tank_elevation = np.array([float(np.asarray(epanet_api.getNodeElevations(i)).item())
+                                        for i in self.tank_idx], dtype=np.float64)
+        lengths = np.atleast_1d(np.asarray(epanet_api.getPatternLengths(), dtype=int))
+        self.pattern_period = int(epanet_api.getTimePatternStep()) * max(1, int(lengths.max()) if lengths.size else 1)
+
+        # Links switched by level controls (the loop actuators are written every step anyway)
+        level_links = set()
+        for ctype, link_index, _, _, _ in self._controls():
+            if ctype not in (self._en_timer, self._en_timeofday):
+                level_links.add(link_index)
+        self.control_links = sorted(level_links - set(network_io.link_idx.tolist()))
+
+        self.meta = {
+            "version": CACHE_VERSION,
+            "valve_quantum": self.valve_quantum,
+            "tank_quantum": self.tank_quantum,
+            "link_idx": network_io.link_idx.tolist(),
+            "node_idx": network_io.node_idx.tolist(),
+            "tank_idx": self.tank_idx,
+            "control_links": self.control_links,
+            "pattern_period": self.pattern_period,
+            **(meta or {}),
+        }
+
+        # key -> (pressures, flows, tank level change, advance step, control link statuses)
+        self.entries = OrderedDict()
+        self.evictions = 0
+        self.start_episode()
+
+    def _controls(self):
+        """(type, link index, setting, node index, level/time) of every simple control"""
+        return [
+            (int(ctype), int(link_index), setting, int(node_index), level)
+            for ctype, link_index, setting, node_index, level in (
+                self.api.api.ENgetcontrol(index) for index in range(1, int(self.api.getControlRulesCount()) + 1)
+            )
+        ]
+
+    def start_episode(self):
+        """Reset the per-episode statistics (call after the solver is opened / restored)"""
+        self.pattern_start = int(self.api.getTimePatternStart())
+        self.hydraulic_step = int(self.api.getTimeHydraulicStep())
+        # Solver times at which a timer control fires (a snapshot restore shifts them)
+        clock_start = int(self.api.api.ENgettimeparam(self.api.ToolkitConstants.EN_STARTTIME))
+        self.timer_times, self.clock_times = set(), set()
+        for ctype, _, _, _, level in self._controls():
+            if ctype == self._en_timer:
+                self.timer_times.add(int(level))
+            elif ctype == self._en_timeofday:
+                self.clock_times.add((int(level) - clock_start) % 86400)
+        self.hydraulic_time = 0
+        self._entry = None  # served entry of the current step (hit)
+        self._key = None  # key to store after advance() (miss)
+        self._levels = None
+        self._readings = None
+        self._verify = None
+        self.lookups = 0
+        self.hits = 0
+        self.verified = 0
+        self.step_mismatches = 0
+        self.solve_seconds = 0.0
+        self.solves = 0
+        self._pressure_errors = []
+        self._flow_errors = []
+        self._tank_errors = []
+
+    def _tank_levels(self):
+        call = self.api.api.ENgetnodevalue
+        heads = np.array([call(i, self._en_head) for i in self.tank_idx], dtype=np.float64)
+        return heads - self.tank_elevation
+
+    def _control_statuses(self):
+        call = self.api.api.ENgetlinkvalue
+        return tuple(int(call(i, self._en_status)) for i in self.control_links)
+
+    def _make_key(self, levels):
+        pattern_time = (self.pattern_start + self.hydraulic_time) % self.pattern_period
+        valves = np.round(np.asarray(self.loops.current_valve, dtype=np.float64) / self.valve_quantum)
+        tanks = np.round(levels / self.tank_quantum)
+        return ((int(pattern_time),) + tuple(valves.astype(np.int64).tolist())
+                + tuple(tanks.astype(np.int64).tolist()) + self._control_statuses())
+
+    def _servable(self, entry):
+        t = self.hydraulic_time
+        return (entry[3] == self.hydraulic_step and t not in self.timer_times
+                and t % 86400 not in self.clock_times)
+
+    def solve(self):
+        """Solve the current step, or serve it from the cache; returns the simulation time"""
+        self.lookups += 1
+        self._levels = self._tank_levels()
+        key = self._make_key(self._levels)
+        entry = self.entries.get(key)
+        self._entry, self._key, self._verify = None, key, None
+        if entry is not None and self._servable(entry):
+            self.entries.move_to_end(key)
+            self.hits += 1
+            if self.verify_every == 0 or self.hits % self.verify_every != 0:
+                self._entry = entry
+                self._key = None
+                return self.hydraulic_time
+            # Solved anyway; the deviation from the entry is the quantization error
+            self.verified += 1
+            self._verify = entry
+
+        start = time.perf_counter()
+        t = self.network_io.solve()
+        self.solve_seconds += time.perf_counter() - start
+        self.solves += 1
+        self.hydraulic_time = int(t)
+        return t
+
+    def read(self):
+        """Loop pressures and flows of the current step (see NetworkIO.read)"""
+        if self._entry is not None:
+            return self._entry[0].copy(), self._entry[1].copy()
+        pressures, flows = self.network_io.read()
+        self._readings = (pressures.copy(), flows.copy())
+        if self._verify is not None:
+            self._pressure_errors.append(np.max(np.abs(pressures - self._verify[0]), initial=0.0))
+            self._flow_errors.append(np.max(np.abs(flows - self._verify[1]), initial=0.0))
+        return pressures, flows
+
+    def advance(self):
+        """Advance to the next step; returns 0 at the end of the simulation"""
+        entry = self._entry
+        if entry is not None:
+            set_link = self.api.api.ENsetlinkvalue
+            for index, before, after in zip(self.control_links, self._control_statuses(), entry[4]):
+                if before != after:
+                    set_link(index, self._en_status, float(after))
+            # Tanks are integrated at constant flow over a step, so a stop
+            # the stale flows make early gets a proportional change
+            set_node = self.api.api.ENsetnodevalue
+            elapsed = 0
+            while elapsed < entry[3]:
+                tstep = self.network_io.advance()
+                if tstep == 0:
+                    break
+                elapsed += tstep
+                for index, level in zip(self.tank_idx, self._levels + entry[2] * (elapsed / entry[3])):
+                    set_node(index, self._en_tanklevel, float(level))
+            if elapsed != entry[3]:
+                self.step_mismatches += 1
+            self.hydraulic_time += elapsed
+            self._entry = None
+            return elapsed
+
+        statuses = self._control_statuses()
+        start = time.perf_counter()
+        tstep = self.network_io.advance()
+        self.solve_seconds += time.perf_counter() - start
+        self.hydraulic_time += tstep
+        if self._key is not None and self._readings is not None and tstep > 0:
+            change = self._tank_levels() - self._levels
+            if self._verify is not None:
+                self._tank_errors.append(np.max(np.abs(change - self._verify[2]), initial=0.0))
+            self._store(self._key, (self._readings[0], self._readings[1], change, int(tstep), statuses))
+        self._key, self._readings, self._verify = None, None, None
+        return tstep
+
+    def _store(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def summary(self):
+        """
+        Returns:
+            dict: Hit rate, observed error bound and solver time of the episode (one solve_cache.csv row)
+        """
+        served = self.hits - self.verified
+        mean_solve = self.solve_seconds / self.solves if self.solves else 0.0
+        return {
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "served": served,
+            "hit_rate": self.hits / self.lookups if self.lookups else 0.0,
+            "verified": self.verified,
+            "pressure_max_abs": float(max(self._pressure_errors, default=0.0)),
+            "flow_max_abs": float(max(self._flow_errors, default=0.0)),
+            "tank_max_abs": float(max(self._tank_errors, default=0.0)),
+            "step_mismatches": self.step_mismatches,
+            "entries": len(self.entries),
+            "evictions": self.evictions,
+            "solve_s": self.solve_seconds,
+            # Served hits at the mean solve+advance time of this episode's real solves
+            "saved_s_est": served * mean_solve,
+        }
+
+    def save(self, path):
+        """Write the entries (in LRU order) as a compressed NPZ (atomically)"""
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        n = len(self.entries)
+        n_loops = len(self.network_io.node_idx)
+        keys = np.array(list(self.entries.keys()), dtype=np.int64).reshape(
+            n, 1 + n_loops + len(self.tank_idx) + len(self.control_links))
+        values = list(self.entries.values())
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            np.savez_compressed(
+                f,
+                meta=np.array(json.dumps(self.meta)),
+                keys=keys,
+                pressures=np.array([v[0] for v in values], dtype=np.float64).reshape(n, n_loops),
+                flows=np.array([v[1] for v in values], dtype=np.float64).reshape(n, n_loops),
+                tank_change=np.array([v[2] for v in values], dtype=np.float64).reshape(n, len(self.tank_idx)),
+                steps=np.array([v[3] for v in values], dtype=np.int64),
+                statuses=np.array([v[4] for v in values], dtype=np.int8).reshape(n, len(self.control_links)),
+            )
+        os.replace(tmp_path, path)
+
+    def load(self, path):
+        """
+        Add the entries of a file written by save()
+
+        Returns:
+            int: Entries loaded (0 when the file was written for another network or quantization)
+        """
+        with np.load(path) as npz:
+            meta = json.loads(str(npz["meta"]))
+            if meta != self.meta:
+                differing = sorted(k for k in set(meta) | set(self.meta) if meta.get(k) != self.meta.get(k))
+                print(f"[WARNING] Solve cache {path} not loaded: written with different {differing}")
+                return 0
+            keys, pressures, flows = npz["keys"], npz["pressures"], npz["flows"]
+            tank_change, steps, statuses = npz["tank_change"], npz["steps"], npz["statuses"]
+        for i in range(keys.shape[0]):
+            self._store(tuple(keys[i].tolist()),
+                        (pressures[i], flows[i], tank_change[i], int(steps[i]), tuple(statuses[i].tolist())))
+        return keys.shape[0]
@@ -0,0 +1,137 @@
+"""
+Per-phase step timing for the sim-runner step loop
+
+The loop calls lap(phase) at each phase boundary. A lap costs one
+perf_counter() call and one array store, so the timer can stay on in
+production runs. Durations go into a preallocated NumPy table (one row
+per step, one column per phase) that grows by doubling.
+
+At the end of the run the table is written to timings.csv (and
+timings.parquet when pyarrow is available), and summary() returns totals,
+means and percentiles per phase.
+"""
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+
+# Phases of one step, in loop order
+PHASES = [
+    "hydraulics",  # runHydraulicAnalysis
+    "sensors",  # network read
+    "sensitivity",  # perturbation solves (SENSITIVITY=true)
+    "bookkeeping",  # sensor payloads, history, snapshots, progress output
+    "images",  # image generation (request or pipeline submit)
+    "controller",  # controller round-trip(s) and result recording
+    "actuation",  # bulk valve write
+    "advance",  # nextHydraulicAnalysisStep
+    "pacing",  # real-time mode: sleep until the step budget is used up
+]
+
+
+class StepTimer:
+    """Lap timer with one row per step"""
+
+    def __init__(self, phases=PHASES, capacity=256):
+        """
+        Args:
+            phases: Phase names (columns)
+            capacity: Initial number of rows
+        """
+        self.phases = list(phases)
+        self.col = {phase: i for i, phase in enumerate(self.phases)}
+        self.durations = np.zeros((capacity, len(self.phases)))
+        self.steps = np.zeros(capacity, dtype=np.int64)
+        self.times = np.zeros(capacity, dtype=np.int64)
+        self.n = 0
+        self._row = -1
+        self._last = None
+
+    def start_step(self, step, current_time):
+        """Open a new row and start the lap clock"""
+        if self.n == len(self.steps):
+            self.durations = np.concatenate([self.durations, np.zeros_like(self.durations)])
+            self.steps = np.concatenate([self.steps, np.zeros_like(self.steps)])
+            self.times = np.concatenate([self.times, np.zeros_like(self.times)])
+        self._row = self.n
+        self.steps[self._row] = step
+        self.times[self._row] = current_time
+        self.n += 1
+        self._last = time.perf_counter()
+
+    def lap(self, phase):
+        """Charge the time since the previous lap to `phase`"""
+        now = time.perf_counter()
+        self.durations[self._row, self.col[phase]] += now - self._last
+        self._last = now
+
+    def frame(self):
+        """
+        Returns:
+            pd.DataFrame: Step, Time, <phase>_ms..., total_ms
+        """
+        durations_ms = self.durations[:self.n] * 1000.0
+        data = {"Step": self.steps[:self.n], "Time": self.times[:self.n]}
+        for phase, i in self.col.items():
+            data[f"{phase}_ms"] = durations_ms[:, i]
+        data["total_ms"] = durations_ms.sum(axis=1)
+        return pd.DataFrame(data)
+
+    def summary(self):
+        """
+        Returns:
+            pd.DataFrame: One row per phase (plus total) with total_s,
+                share, mean/p50/p95/p99/max in milliseconds
+        """
+        durations_ms = self.durations[:self.n] * 1000.0
+        columns = [(phase, durations_ms[:, i]) for phase, i in self.col.items()]
+        columns.append(("total", durations_ms.sum(axis=1)))
+        grand_total = columns[-1][1].sum()
+
+        rows = []
+        for phase, values in columns:
+            if values.size == 0:
+                continue
+            p50, p95, p99 = np.percentile(values, [50, 95, 99])
+            rows.append({
+                "phase": phase,
+                "total_s": float(values.sum() / 1000.0),
+                "share": float(values.sum() / grand_total) if grand_total > 0 else 0.0,
+                "mean_ms": float(values.mean()),
+                "p50_ms": float(p50),
+                "p95_ms": float(p95),
+                "p99_ms": float(p99),
+                "max_ms": float(values.max()),
+            })
+        return pd.DataFrame(rows)
+
+    def write(self, exp_dir):
+        """
+        Write per-step timings next to result.csv
+
+        Returns:
+            list of written paths
+        """
+        df = self.frame()
+        paths = [os.path.join(exp_dir, "timings.csv")]
+        df.to_csv(paths[0], index=False)
+        try:
+            df.to_parquet(os.path.join(exp_dir, "timings.parquet"), index=False)
+            paths.append(os.path.join(exp_dir, "timings.parquet"))
+        except ImportError:
+            pass
+        return paths
+
+
+class NullStepTimer:
+    """Drop-in replacement when timing is disabled (STEP_TIMING=false)"""
+
+    n = 0
+
+    def start_step(self, step, current_time):
+        pass
+
+    def lap(self, phase):
+        pass
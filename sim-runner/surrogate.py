@@ -0,0 +1,450 @@
+"""
+Learned surrogate of the hydraulic solver for high-throughput training
+
+A small linear-dynamic model predicts, per control loop, the sensor
+pressure and actuator flow of the next step from the current ones, the
+valve settings of all loops and the time of day:
+
+    [p, f](t+1) = W_loop . phi(p(t), f(t), v(t), v(t+1), time of day)
+
+It is fitted by ridge regression on recorded result.csv runs (runs with
+varied valve actions generalize best, e.g. scenarios.py or exploratory
+VLA episodes). SurrogateNetwork stands in for the epyt epanet object, so
+RemoteValveControlEnv runs unchanged on top of it (SURROGATE_MODEL):
+same controllers, payloads, images and result.csv, at a fraction of the
+cost of a hydraulic solve. Tank levels and demands are not modeled
+explicitly; their daily cycle is captured by the time-of-day features.
+
+validate_against_epanet() replays the valve trajectory of a surrogate
+episode on the real network and reports the error of the surrogate
+(SURROGATE_VALIDATE_EVERY in main.py).
+
+Usage:
+    python surrogate.py fit MODEL.npz RESULT.csv [RESULT.csv ...]
+"""
+import json
+import os
+import sys
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+
+
+DAY_SECONDS = 86400.0
+MODEL_VERSION = 1
+
+
+def _time_features(time_of_day):
+    """Daily harmonics (first and second) of the time of day"""
+    w = 2.0 * np.pi * np.asarray(time_of_day, dtype=np.float64) / DAY_SECONDS
+    return np.stack([np.sin(w), np.cos(w), np.sin(2 * w), np.cos(2 * w)], axis=-1)
+
+
+def features(pressure, flow, valve, next_valve, next_time):
+    """
+    Regression features of every loop for one transition
+
+    Args:
+        pressure, flow: Loop values at step t, shape (..., loops)
+        valve: Valve settings during step t, shape (..., loops)
+        next_valve: Valve settings during step t+1, shape (..., loops)
+        next_time: Simulation time of step t+1 in seconds, shape (...)
+
+    Returns:
+        np.ndarray: shape (..., loops, num_features)
+    """
+    pressure = np.asarray(pressure, dtype=np.float64)
+    num_loops = pressure.shape[-1]
+    harmonics = _time_features(np.asarray(next_time, dtype=np.float64) % DAY_SECONDS)
+    harmonics = np.broadcast_to(harmonics[..., None, :], pressure.shape + (4,))
+    own = np.asarray(next_valve, dtype=np.float64)
+    all_valves = np.broadcast_to(own[..., None, :], pressure.shape + (num_loops,))
+    return np.concatenate([
+        np.ones(pressure.shape + (1,)),
+        pressure[..., None],
+        np.asarray(flow, dtype=np.float64)[..., None],
+        all_valves,
+        (own ** 2)[..., None],
+        (own - np.asarray(valve, dtype=np.float64))[..., None],
+        harmonics,
+        own[..., None] * harmonics[..., :2],
+    ], axis=-1)
+
+
+def load_transitions(result_path, loop_ids):
+    """
+    Step-to-step transitions of one recorded run
+
+    Returns:
+        dict of arrays: time (steps,), pressure/flow/valve (steps, loops);
+            rows are consecutive steps of one episode (None if the run
+            has fewer than two complete steps)
+    """
+    if result_path.endswith('.parquet'):
+        df = pd.read_parquet(result_path)
+    else:
+        df = pd.read_csv(result_path)
+    df = df[df['LoopID'].astype(str).isin(loop_ids)]
+    # A step is usable only when every loop has a row
+    wide = df.pivot_table(index=['Step', 'Time'], columns=df['LoopID'].astype(str),
+                          values=['Pressure', 'Flow', 'ValveSetting'], aggfunc='first')
+    wide = wide.dropna().sort_index()
+    if len(wide) < 2:
+        return None
+    return {
+        "step": wide.index.get_level_values('Step').to_numpy(),
+        "time": wide.index.get_level_values('Time').to_numpy(dtype=np.float64),
+        "pressure": wide['Pressure'][loop_ids].to_numpy(dtype=np.float64),
+        "flow": wide['Flow'][loop_ids].to_numpy(dtype=np.float64),
+        "valve": wide['ValveSetting'][loop_ids].to_numpy(dtype=np.float64),
+    }
+
+
+class SurrogateModel:
+    """Per-loop ridge regression of the next pressure and flow"""
+
+    def __init__(self, loop_ids, weights, mean, std, initial, hydraulic_step, info=None):
+        """
+        Args:
+            loop_ids: Loop IDs in loop position order
+            weights: shape (loops, num_features, 2)
+            mean, std: Feature standardization, shape (loops, num_features)
+            initial: Pressure/flow at step 0, shape (loops, 2)
+            hydraulic_step: Hydraulic step of the training runs in seconds
+            info: Training metadata (errors, sample counts)
+        """
+        self.loop_ids = list(loop_ids)
+        self.weights = np.asarray(weights, dtype=np.float64)
+        self.mean = np.asarray(mean, dtype=np.float64)
+        self.std = np.asarray(std, dtype=np.float64)
+        self.initial = np.asarray(initial, dtype=np.float64)
+        self.hydraulic_step = hydraulic_step
+        self.info = info or {}
+
+    @classmethod
+    def fit(cls, runs, loop_ids, hydraulic_step, ridge=1e-3):
+        """
+        Fit on transitions from load_transitions()
+
+        Args:
+            runs: List of transition dicts
+            loop_ids: Loop IDs in loop position order
+            hydraulic_step: Hydraulic step of the runs in seconds
+            ridge: L2 regularization on the standardized features
+        """
+        x, y, initial = [], [], []
+        for run in runs:
+            consecutive = np.flatnonzero(np.diff(run["step"]) == 1)
+            if consecutive.size == 0:
+                continue
+            x.append(features(run["pressure"][consecutive], run["flow"][consecutive],
+                              run["valve"][consecutive], run["valve"][consecutive + 1],
+                              run["time"][consecutive + 1]))
+            y.append(np.stack([run["pressure"][consecutive + 1], run["flow"][consecutive + 1]], axis=-1))
+            if run["step"][0] == 0:
+                initial.append(np.stack([run["pressure"][0], run["flow"][0]], axis=-1))
+        if not x:
+            raise ValueError("No consecutive steps to fit the surrogate on")
+        x = np.concatenate(x)  # (samples, loops, features)
+        y = np.concatenate(y)  # (samples, loops, 2)
+
+        mean = x.mean(axis=0)
+        std = x.std(axis=0)
+        mean[:, 0], std[:, 0] = 0.0, 1.0  # bias column
+        std[std < 1e-12] = 1.0  # constant features (e.g. a valve that never moved)
+        z = (x - mean) / std
+
+        num_features = z.shape[-1]
+        weights = np.empty((len(loop_ids), num_features, 2))
+        penalty = ridge * np.eye(num_features)
+        penalty[0, 0] = 0.0
+        for i in range(len(loop_ids)):
+            zi = z[:, i, :]
+            weights[i] = np.linalg.solve(zi.T @ zi + penalty * len(zi), zi.T @ y[:, i, :])
+
+        initial = np.mean(initial, axis=0) if initial else y[0]
+        return cls(loop_ids, weights, mean, std, initial, hydraulic_step,
+                   info={"samples": int(len(x)), "runs": len(runs), "ridge": ridge})
+
+    def predict(self, pressure, flow, valve, next_valve, next_time):
+        """
+        Pressure and flow of every loop at the next step
+
+        Arguments as for features(); leading dimensions are batched.
+
+        Returns:
+            (pressure, flow): arrays over loops
+        """
+        z = (features(pressure, flow, valve, next_valve, next_time) - self.mean) / self.std
+        out = np.einsum('...lf,lfk->...lk', z, self.weights)
+        return out[..., 0], out[..., 1]
+
+    def rollout(self, run):
+        """
+        Open-loop prediction of a recorded run from its valve trajectory
+
+        Returns:
+            (pressure, flow): shape (steps, loops); step 0 is the recorded state
+        """
+        pressure = np.empty_like(run["pressure"])
+        flow = np.empty_like(run["flow"])
+        pressure[0], flow[0] = run["pressure"][0], run["flow"][0]
+        for t in range(1, len(pressure)):
+            pressure[t], flow[t] = self.predict(pressure[t - 1], flow[t - 1], run["valve"][t - 1],
+                                                run["valve"][t], run["time"][t])
+        return pressure, flow
+
+    def evaluate(self, run):
+        """
+        One-step and open-loop rollout RMSE per loop on a recorded run
+
+        Returns:
+            dict: loop_id -> {one_step_pressure, one_step_flow, rollout_pressure, rollout_flow}
+        """
+        one_p, one_f = self.predict(run["pressure"][:-1], run["flow"][:-1], run["valve"][:-1],
+                                    run["valve"][1:], run["time"][1:])
+        roll_p, roll_f = self.rollout(run)
+
+        def rmse(a, b):
+            return np.sqrt(np.mean((a - b) ** 2, axis=0))
+
+        errors = {}
+        for i, loop_id in enumerate(self.loop_ids):
+            errors[loop_id] = {
+                "one_step_pressure": float(rmse(one_p, run["pressure"][1:])[i]),
+                "one_step_flow": float(rmse(one_f, run["flow"][1:])[i]),
+                "rollout_pressure": float(rmse(roll_p, run["pressure"])[i]),
+                "rollout_flow": float(rmse(roll_f, run["flow"])[i]),
+            }
+        return errors
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        meta = {"version": MODEL_VERSION, "loop_ids": self.loop_ids,
+                "hydraulic_step": self.hydraulic_step, "info": self.info}
+        np.savez(path, weights=self.weights, mean=self.mean, std=self.std, initial=self.initial,
+                 meta=np.array(json.dumps(meta)))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            meta = json.loads(str(data["meta"]))
+            if meta.get("version") != MODEL_VERSION:
+                raise ValueError(f"Unsupported surrogate model version {meta.get('version')}: {path}")
+            return cls(meta["loop_ids"], data["weights"], data["mean"], data["std"], data["initial"],
+                       meta["hydraulic_step"], info=meta.get("info"))
+
+
+class SurrogateNetwork:
+    """
+    Stand-in for the epyt epanet object, driven by a SurrogateModel
+
+    Implements the calls RemoteValveControlEnv makes during a run. Each
+    loop's sensor node and actuator link get the loop position + 1 as
+    their index; readings of other nodes/links are 0.
+    """
+
+    def __init__(self, model, control_loops):
+        """
+        Args:
+            model: SurrogateModel
+            control_loops: control_loops section of the experiment config
+        """
+        loop_ids = [str(loop['loop_id']) for loop in control_loops]
+        if loop_ids != [str(loop_id) for loop_id in model.loop_ids]:
+            raise ValueError(f"Surrogate model was fitted for loops {model.loop_ids}, config has {loop_ids}")
+        self.model = model
+        self.node_ids = [str(loop['target']['node_id']) for loop in control_loops]
+        self.link_ids = [str(loop['actuator']['link_id']) for loop in control_loops]
+        self.ToolkitConstants = SimpleNamespace(EN_PRESSURE=11, EN_FLOW=8, EN_SAVE_AND_INIT=11)
+
+        num_loops = len(loop_ids)
+        self.settings = np.array([loop['actuator'].get('initial_setting', 1.0) for loop in control_loops],
+                                 dtype=np.float64)
+        self.pressure = np.zeros(num_loops)
+        self.flow = np.zeros(num_loops)
+        self.duration = 0
+        self.hydraulic_step = model.hydraulic_step
+        self.time = 0
+        self.steps = 0  # Solves since the last initialization
+        self._solved_settings = self.settings.copy()
+
+    # --- network data ---
+    def getNodeCount(self):
+        return len(self.node_ids)
+
+    def getLinkCount(self):
+        return len(self.link_ids)
+
+    def getNodeNameID(self):
+        return list(self.node_ids)
+
+    def getLinkNameID(self):
+        return list(self.link_ids)
+
+    def getNodeIndex(self, node_id):
+        return self.node_ids.index(str(node_id)) + 1 if str(node_id) in self.node_ids else 0
+
+    def getLinkIndex(self, link_id):
+        return self.link_ids.index(str(link_id)) + 1 if str(link_id) in self.link_ids else 0
+
+    def setTimeSimulationDuration(self, duration):
+        self.duration = int(duration)
+
+    def setTimeHydraulicStep(self, step):
+        if step != self.model.hydraulic_step:
+            print(f"[WARNING] Surrogate was fitted at a {self.model.hydraulic_step}s step, run uses {step}s")
+        self.hydraulic_step = int(step)
+
+    # --- hydraulic analysis ---
+    def openHydraulicAnalysis(self):
+        pass
+
+    def initializeHydraulicAnalysis(self, flag=None):
+        self.time = 0
+        self.steps = 0
+
+    def runHydraulicAnalysis(self):
+        if self.steps == 0:
+            self.pressure, self.flow = self.model.initial[:, 0].copy(), self.model.initial[:, 1].copy()
+        else:
+            self.pressure, self.flow = self.model.predict(
+                self.pressure, self.flow, self._solved_settings, self.settings, self.time
+            )
+        self._solved_settings = self.settings.copy()
+        self.steps += 1
+        return self.time
+
+    def nextHydraulicAnalysisStep(self):
+        if self.time >= self.duration:
+            return 0
+        self.time += self.hydraulic_step
+        return self.hydraulic_step
+
+    def closeHydraulicAnalysis(self):
+        pass
+
+    # --- readings / actuation (NetworkIO indexed path) ---
+    def getNodePressure(self, indices=None):
+        if indices is None:
+            return self.pressure.copy()
+        return self.pressure[np.asarray(indices, dtype=np.int64) - 1]
+
+    def getLinkFlows(self, indices=None):
+        if indices is None:
+            return self.flow.copy()
+        return self.flow[np.asarray(indices, dtype=np.int64) - 1]
+
+    def setLinkSettings(self, indices, values):
+        self.settings[np.asarray(indices, dtype=np.int64) - 1] = values
+
+
+def validate_against_epanet(network_path, control_loops, result_path, duration, hydraulic_step):
+    """
+    Replay the valve trajectory of a (surrogate) run on the real network
+
+    The recorded ValveSetting of every step is applied before the solve,
+    as in the step loop of RemoteValveControlEnv.
+
+    Returns:
+        pd.DataFrame: RMSE/MAE per loop of the recorded vs. EPANET pressure and flow
+    """
+    from epyt import epanet
+    from network_io import NetworkIO
+
+    loop_ids = [str(loop['loop_id']) for loop in control_loops]
+    run = load_transitions(result_path, loop_ids)
+    if run is None:
+        raise ValueError(f"Not enough steps to validate: {result_path}")
+
+    api = epanet(network_path)
+    try:
+        node_idx = [int(np.asarray(api.getNodeIndex(loop['target']['node_id'])).item()) for loop in control_loops]
+        link_idx = [int(np.asarray(api.getLinkIndex(loop['actuator']['link_id'])).item()) for loop in control_loops]
+        io = NetworkIO(api, node_idx, link_idx)
+        api.setTimeSimulationDuration(duration)
+        api.setTimeHydraulicStep(hydraulic_step)
+        steps = {step: t for t, step in enumerate(run["step"].tolist())}
+
+        pressure = np.full_like(run["pressure"], np.nan)
+        flow = np.full_like(run["flow"], np.nan)
+        api.openHydraulicAnalysis()
+        api.initializeHydraulicAnalysis(api.ToolkitConstants.EN_SAVE_AND_INIT)
+        step = 0
+        while step <= run["step"][-1]:
+            t = steps.get(step)
+            if t is not None:
+                io.write_settings(io.link_idx, run["valve"][t])
+            api.runHydraulicAnalysis()
+            if t is not None:
+                pressure[t], flow[t] = io.read()
+            step += 1
+            if api.nextHydraulicAnalysisStep() == 0:
+                break
+        api.closeHydraulicAnalysis()
+    finally:
+        api.unload()
+
+    rows = []
+    for i, loop_id in enumerate(loop_ids):
+        dp = pressure[:, i] - run["pressure"][:, i]
+        df = flow[:, i] - run["flow"][:, i]
+        rows.append({
+            "LoopID": loop_id,
+            "steps": int(np.count_nonzero(np.isfinite(dp))),
+            "pressure_rmse": float(np.sqrt(np.nanmean(dp ** 2))),
+            "pressure_mae": float(np.nanmean(np.abs(dp))),
+            "flow_rmse": float(np.sqrt(np.nanmean(df ** 2))),
+            "flow_mae": float(np.nanmean(np.abs(df))),
+        })
+    return pd.DataFrame(rows)
+
+
+def fit_from_results(model_path, result_paths, config=None, ridge=1e-3):
+    """
+    Fit a surrogate on recorded runs and save it
+
+    The last run is held out for validation when there are several;
+    the model saved is refitted on all runs.
+
+    Args:
+        model_path: Output .npz path
+        result_paths: result.csv / result.parquet files of one network and loop set
+        config: Experiment config (loop order, hydraulic step); by default
+            the <exp_id>_config.json next to the first result file
+    """
+    if config is None:
+        exp_dir = os.path.dirname(os.path.abspath(result_paths[0]))
+        config_path = os.path.join(exp_dir, f"{os.path.basename(exp_dir)}_config.json")
+        with open(config_path, 'r') as f:
+            config = json.load(f)
+    loop_ids = [str(loop['loop_id']) for loop in config['control_loops']]
+    hydraulic_step = config['simulation']['hydraulic_step']
+
+    runs = [run for run in (load_transitions(path, loop_ids) for path in result_paths) if run is not None]
+    if not runs:
+        raise ValueError("No usable runs (each needs at least two complete steps)")
+
+    if len(runs) > 1:
+        held_out = SurrogateModel.fit(runs[:-1], loop_ids, hydraulic_step, ridge=ridge).evaluate(runs[-1])
+        print(f"Held-out run ({result_paths[-1]}):")
+        for loop_id, errors in held_out.items():
+            print(f"  {loop_id}: one-step RMSE p={errors['one_step_pressure']:.4f} f={errors['one_step_flow']:.4f}, "
+                  f"rollout RMSE p={errors['rollout_pressure']:.4f} f={errors['rollout_flow']:.4f}")
+    else:
+        held_out = None
+
+    model = SurrogateModel.fit(runs, loop_ids, hydraulic_step, ridge=ridge)
+    model.info["held_out"] = held_out
+    model.info["train"] = model.evaluate(runs[-1])
+    model.save(model_path)
+    print(f"Surrogate saved to {model_path} ({model.info['samples']} transitions from {len(runs)} runs)")
+    return model
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 4 or sys.argv[1] != 'fit':
+        print(__doc__)
+        sys.exit(1)
+    fit_from_results(sys.argv[2], sys.argv[3:], ridge=float(os.environ.get('SURROGATE_RIDGE', '1e-3')))
@@ -0,0 +1,235 @@
+"""
+Thin ctypes binding for the per-step EPANET toolkit calls
+
+epyt's general-purpose wrappers (getNodePressure(list), setLinkSettings,
+runHydraulicAnalysis, ...) rebuild argument lists, wrap every value in a
+new ctypes object and convert results to fresh ndarrays on every call.
+The step loop only needs a handful of operations on a fixed set of
+indices, so ToolkitBinding calls the toolkit functions of the library
+epyt has already loaded (same project handle, same solver state) with
+preallocated output buffers:
+
+    solve()           EN_runH
+    advance()         EN_nextH
+    read_loops()      EN_getnodevalue / EN_getlinkvalue per loop index
+                      (EN_getnodevalues / EN_getlinkvalues when the library has them)
+    write_settings()  EN_setlinkvalue(EN_SETTING)
+
+Everything else keeps going through epyt. Toolkit errors and warnings are
+reported as warnings, exactly like epyt does, so results and logs do not
+change. ToolkitBinding.attach() returns None when the epanet object does
+not expose its ctypes library (other epyt versions, the surrogate), and
+the caller falls back to epyt.
+
+    python toolkit.py Net3.inp    # per-call overhead, epyt vs binding
+"""
+import ctypes
+import sys
+import time
+import warnings
+
+import numpy as np
+
+
+class ToolkitBinding:
+    """Direct calls into the EPANET library loaded by an epyt instance"""
+
+    def __init__(self, epanet_api, node_indices, link_indices):
+        """
+        Args:
+            epanet_api: epyt epanet instance (EPANET 2.2 API with a project handle)
+            node_indices: Valid EPANET (1-based) node indices read every step
+            link_indices: Valid EPANET (1-based) link indices read every step
+        """
+        api = epanet_api.api
+        # Own function objects over the same loaded library, so declaring
+        # argtypes does not change how epyt calls it. The getters and
+        # runH/nextH get none: ctypes converts plain ints faster without them.
+        lib = ctypes.CDLL(api._lib._name)
+        self._ph = ctypes.c_void_p(api._ph.value)
+        constants = epanet_api.ToolkitConstants
+        self._en_pressure = constants.EN_PRESSURE
+        self._en_flow = constants.EN_FLOW
+        self._en_setting = constants.EN_SETTING
+
+        self._runH = lib.EN_runH
+        self._nextH = lib.EN_nextH
+        self._getnode = lib.EN_getnodevalue
+        self._getlink = lib.EN_getlinkvalue
+        self._setlink = lib.EN_setlinkvalue
+        self._setlink.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.c_int, ctypes.c_double]
+        self._geterror = lib.EN_geterror
+        self._geterror.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int]
+
+        # Preallocated outputs
+        self._time = ctypes.c_long()
+        self._time_ref = ctypes.byref(self._time)
+        self._value = ctypes.c_double()
+        self._value_ref = ctypes.byref(self._value)
+        self.node_indices = [int(i) for i in node_indices]
+        self.link_indices = [int(i) for i in link_indices]
+        self.pressures = np.zeros(len(self.node_indices))
+        self.flows = np.zeros(len(self.link_indices))
+
+        # EPANET 2.3 reads a property of the whole network in one call
+        self.bulk = hasattr(lib, 'EN_getnodevalues') and hasattr(lib, 'EN_getlinkvalues')
+        if self.bulk:
+            self._getnodes = lib.EN_getnodevalues
+            self._getlinks = lib.EN_getlinkvalues
+            self._all_nodes = np.zeros(epanet_api.getNodeCount())
+            self._all_links = np.zeros(epanet_api.getLinkCount())
+            self._all_nodes_ptr = self._all_nodes.ctypes.data_as(ctypes.POINTER(ctypes.c_double))
+            self._all_links_ptr = self._all_links.ctypes.data_as(ctypes.POINTER(ctypes.c_double))
+            self._node_pos = np.asarray(self.node_indices, dtype=np.int64) - 1
+            self._link_pos = np.asarray(self.link_indices, dtype=np.int64) - 1
+
+    @classmethod
+    def attach(cls, epanet_api, node_indices, link_indices):
+        """
+        Binding for an epanet object, or None if it does not expose its library
+
+        Returns:
+            ToolkitBinding or None
+        """
+        api = getattr(epanet_api, 'api', None)
+        lib = getattr(api, '_lib', None)
+        ph = getattr(api, '_ph', None)
+        if lib is None or ph is None or not hasattr(lib, 'EN_runH'):
+            return None
+        try:
+            return cls(epanet_api, node_indices, link_indices)
+        except (AttributeError, OSError, TypeError):
+            return None
+
+    def _check(self, errcode):
+        # Same reporting as epyt's ENgeterror: every non-zero code is a warning
+        message = ctypes.create_string_buffer(150)
+        self._geterror(errcode, message, 150)
+        warnings.warn(message.value.decode())
+
+    def solve(self):
+        """EN_runH: solve the current time; returns the simulation time in seconds"""
+        errcode = self._runH(self._ph, self._time_ref)
+        if errcode:
+            self._check(errcode)
+        return self._time.value
+
+    def advance(self):
+        """EN_nextH: returns the time to the next hydraulic step (0 at the end)"""
+        errcode = self._nextH(self._ph, self._time_ref)
+        if errcode:
+            self._check(errcode)
+        return self._time.value
+
+    def read_loops(self):
+        """
+        Pressure at the loop nodes and flow in the loop links
+
+        Returns:
+            (pressures, flows): Preallocated arrays, overwritten by the next call
+        """
+        if self.bulk:
+            errcode = self._getnodes(self._ph, self._en_pressure, self._all_nodes_ptr)
+            if errcode:
+                self._check(errcode)
+            errcode = self._getlinks(self._ph, self._en_flow, self._all_links_ptr)
+            if errcode:
+                self._check(errcode)
+            np.take(self._all_nodes, self._node_pos, out=self.pressures)
+            np.take(self._all_links, self._link_pos, out=self.flows)
+            return self.pressures, self.flows
+
+        ph, ref, value = self._ph, self._value_ref, self._value
+        getnode, code = self._getnode, self._en_pressure
+        pressures = []
+        for index in self.node_indices:
+            errcode = getnode(ph, index, code, ref)
+            if errcode:
+                self._check(errcode)
+            pressures.append(value.value)
+        getlink, code = self._getlink, self._en_flow
+        flows = []
+        for index in self.link_indices:
+            errcode = getlink(ph, index, code, ref)
+            if errcode:
+                self._check(errcode)
+            flows.append(value.value)
+        self.pressures[:] = pressures
+        self.flows[:] = flows
+        return self.pressures, self.flows
+
+    def write_settings(self, link_indices, values):
+        """
+        EN_setlinkvalue(EN_SETTING) for each link
+
+        Args:
+            link_indices: Valid EPANET (1-based) link indices
+            values: New settings, same order
+        """
+        setlink, ph, code = self._setlink, self._ph, self._en_setting
+        for index, value in zip(link_indices, values):
+            if value == value:  # NaN is skipped, as in epyt
+                errcode = setlink(ph, index, code, value)
+                if errcode:
+                    self._check(errcode)
+
+
+def benchmark(inp_path, loops=4, repeat=2000):
+    """
+    Per-call time of the hot operations through epyt and through the binding
+
+    Args:
+        inp_path: EPANET INP file
+        loops: Number of sensor nodes / actuator links read per call
+        repeat: Calls per operation
+
+    Returns:
+        list of dict: operation, epyt_us, binding_us, speedup
+    """
+    from epyt import epanet
+
+    d = epanet(inp_path)
+    node_idx = list(range(1, min(loops, d.getNodeCount()) + 1))
+    link_idx = list(range(1, min(loops, d.getLinkCount()) + 1))
+    settings = [float(s) for s in d.getLinkSettings(link_idx)]
+    binding = ToolkitBinding.attach(d, node_idx, link_idx)
+    if binding is None:
+        raise RuntimeError("This epyt version does not expose its toolkit library")
+
+    d.openHydraulicAnalysis()
+    d.initializeHydraulicAnalysis(d.ToolkitConstants.EN_SAVE_AND_INIT)
+    d.runHydraulicAnalysis()
+
+    def timed(fn):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            fn()
+        return (time.perf_counter() - start) / repeat * 1e6
+
+    operations = [
+        ("read pressures+flows", lambda: (d.getNodePressure(node_idx), d.getLinkFlows(link_idx)),
+         binding.read_loops),
+        ("write settings", lambda: d.setLinkSettings(link_idx, settings),
+         lambda: binding.write_settings(link_idx, settings)),
+        # Re-solving the same time step: solver work is identical on both paths
+        ("runH", d.runHydraulicAnalysis, binding.solve),
+    ]
+    rows = []
+    for name, epyt_call, binding_call in operations:
+        epyt_us = timed(epyt_call)
+        binding_us = timed(binding_call)
+        rows.append({"operation": name, "epyt_us": epyt_us, "binding_us": binding_us,
+                     "speedup": epyt_us / binding_us if binding_us > 0 else 0.0})
+    d.closeHydraulicAnalysis()
+    d.unload()
+    return rows
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python toolkit.py NETWORK.inp [LOOPS]")
+        sys.exit(1)
+    results = benchmark(sys.argv[1], loops=int(sys.argv[2]) if len(sys.argv) > 2 else 4)
+    print(f"{'operation':<22}{'epyt':>12}{'binding':>12}{'speedup':>10}")
+    for row in results:
+        print(f"{row['operation']:<22}{row['epyt_us']:>10.2f}us{row['binding_us']:>10.2f}us{row['speedup']:>9.1f}x")
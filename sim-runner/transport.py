@@ -0,0 +1,181 @@
+"""
+Pooled HTTP transport for sim-runner -> service calls
+
+One ServiceTransport per downstream service (controller, image-generator).
+Each keeps a persistent keep-alive session, applies connect/read timeouts,
+retries connection failures a bounded number of times and records the
+latency of every call.
+"""
+import os
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class LatencyRecorder:
+    """Collects per-call latencies and summarizes them as percentiles (thread-safe)"""
+
+    def __init__(self, service):
+        """
+        Args:
+            service: Service name (used as a column in the report)
+        """
+        self.service = service
+        self.samples = {}  # endpoint -> [seconds, ...]
+        self.errors = {}  # endpoint -> count
+        self.retries = {}  # endpoint -> count
+        self._lock = threading.Lock()  # concurrent per-loop requests share a recorder
+
+    def record(self, endpoint, seconds):
+        with self._lock:
+            self.samples.setdefault(endpoint, []).append(seconds)
+
+    def record_error(self, endpoint):
+        with self._lock:
+            self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+    def record_retry(self, endpoint):
+        with self._lock:
+            self.retries[endpoint] = self.retries.get(endpoint, 0) + 1
+
+    def summary(self):
+        """
+        Returns:
+            list of dicts: one row per endpoint (latencies in milliseconds)
+        """
+        rows = []
+        endpoints = set(self.samples) | set(self.errors)
+        for endpoint in sorted(endpoints):
+            samples = np.asarray(self.samples.get(endpoint, []), dtype=float) * 1000.0
+            row = {
+                "service": self.service,
+                "endpoint": endpoint,
+                "calls": int(samples.size),
+                "errors": self.errors.get(endpoint, 0),
+                "retries": self.retries.get(endpoint, 0),
+            }
+            if samples.size > 0:
+                p50, p95, p99 = np.percentile(samples, [50, 95, 99])
+                row.update({
+                    "mean_ms": float(samples.mean()),
+                    "p50_ms": float(p50),
+                    "p95_ms": float(p95),
+                    "p99_ms": float(p99),
+                    "max_ms": float(samples.max()),
+                    "total_s": float(samples.sum() / 1000.0),
+                })
+            rows.append(row)
+        return rows
+
+
+class ServiceTransport:
+    """Keep-alive HTTP session with timeouts, bounded retries and latency accounting"""
+
+    def __init__(self, service, connect_timeout=3.0, read_timeout=30.0,
+                 max_retries=2, retry_backoff=0.5, pool_size=4):
+        """
+        Args:
+            service: Service name (for logging and the latency report)
+            connect_timeout: TCP connect timeout in seconds
+            read_timeout: Response read timeout in seconds
+            max_retries: Retries after a failed connection (0 = no retry).
+                Read timeouts are never retried, because the service may
+                already have processed the request (e.g. PID integral update).
+            retry_backoff: Base sleep between retries in seconds (doubles each retry)
+            pool_size: Number of pooled keep-alive connections
+        """
+        self.service = service
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.latency = LatencyRecorder(service)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    @classmethod
+    def from_env(cls, service, prefix, read_timeout=30.0, max_retries=2, pool_size=4):
+        """
+        Build a transport from environment variables
+
+        Reads {prefix}_CONNECT_TIMEOUT, {prefix}_READ_TIMEOUT,
+        {prefix}_MAX_RETRIES and {prefix}_RETRY_BACKOFF.
+        """
+        return cls(
+            service,
+            connect_timeout=float(os.environ.get(f'{prefix}_CONNECT_TIMEOUT', '3')),
+            read_timeout=float(os.environ.get(f'{prefix}_READ_TIMEOUT', str(read_timeout))),
+            max_retries=int(os.environ.get(f'{prefix}_MAX_RETRIES', str(max_retries))),
+            retry_backoff=float(os.environ.get(f'{prefix}_RETRY_BACKOFF', '0.5')),
+            pool_size=pool_size
+        )
+
+    def post(self, url, json=None, read_timeout=None, data=None, headers=None):
+        """
+        POST with retries on connection failure
+
+        Args:
+            url: Full request URL
+            json: JSON payload
+            read_timeout: Override the default read timeout for this call
+            data: Raw (already encoded) request body instead of `json`
+            headers: Extra request headers (e.g. Content-Type of `data`)
+
+        Returns:
+            requests.Response
+        """
+        endpoint = url.rsplit('/', 1)[-1] or url
+        timeout = (self.connect_timeout, read_timeout if read_timeout is not None else self.read_timeout)
+
+        attempt = 0
+        while True:
+            start = time.perf_counter()
+            try:
+                response = self.session.post(url, json=json, data=data, headers=headers, timeout=timeout)
+            except requests.exceptions.ConnectionError:
+                self.latency.record_error(endpoint)
+                if attempt >= self.max_retries:
+                    raise
+                self.latency.record_retry(endpoint)
+                time.sleep(self.retry_backoff * (2 ** attempt))
+                attempt += 1
+                continue
+            except requests.exceptions.RequestException:
+                self.latency.record_error(endpoint)
+                raise
+
+            self.latency.record(endpoint, time.perf_counter() - start)
+            return response
+
+    def close(self):
+        self.session.close()
+
+
+def write_latency_report(transports, output_path, recorders=()):
+    """
+    Write the latency summary of all transports to a CSV file
+
+    Args:
+        transports: Iterable of ServiceTransport
+        output_path: Destination CSV path (e.g. <exp_dir>/latency.csv)
+        recorders: Additional LatencyRecorders (e.g. per-loop controller latency)
+
+    Returns:
+        pd.DataFrame: The written summary
+    """
+    rows = []
+    for transport in transports:
+        rows.extend(transport.latency.summary())
+    for recorder in recorders:
+        rows.extend(recorder.summary())
+
+    df = pd.DataFrame(rows)
+    df.to_csv(output_path, index=False)
+    return df
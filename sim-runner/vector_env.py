@@ -0,0 +1,272 @@
+"""
+Vectorized environments for RL training
+
+Runs N RemoteValveControlEnv instances (Gym-style reset() / step()) in
+subprocess workers. Observations, actions, rewards and done flags live in
+shared-memory NumPy arrays, so a step exchanges only a one-word command
+per worker over a pipe; the arrays themselves are never pickled:
+
+    obs      (N, loops, len(OBS_FIELDS))
+    actions  (N, loops)   absolute valve settings, NaN holds the setting
+    rewards  (N,)
+    dones    (N,)
+
+A finished environment is reset automatically in the same step(): its
+row of `obs` then holds the first observation of the next episode and
+its `dones` flag is set.
+
+Each worker loads its own copy of the network (see
+scenarios.private_network_dir). With demand_noise / demand_scale_range
+every episode of every environment draws perturbed demand patterns from
+the random stream (seed, env, episode), as in scenarios.py.
+
+    envs = VectorEnv(CONFIG_PATH, NETWORK_DIR, num_envs=8)
+    obs = envs.reset()
+    obs, rewards, dones = envs.step(actions)
+    envs.close()
+"""
+import json
+import multiprocessing as mp
+import os
+import sys
+import tempfile
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+def _shared_array(shape, dtype):
+    """Allocate a zeroed NumPy array in a new shared-memory block"""
+    size = max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize)
+    shm = shared_memory.SharedMemory(create=True, size=size)
+    array = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    array.fill(0)
+    return shm, array
+
+
+def _attach(name, shape, dtype):
+    """Attach a shared-memory block created by the parent"""
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def _worker_main(index, conn, config_path, network_dir, log_dir, buffers, seed, noise, scale_range):
+    """Worker process: own environment, driven by commands from the parent"""
+    log = open(os.path.join(log_dir, f"env_{index:03d}.log"), 'w', buffering=1)
+    sys.stdout = log
+    sys.stderr = log
+
+    # Shared blocks belong to the parent; the workers only attach to them
+    blocks = {}
+    arrays = {}
+    for key, (name, shape, dtype) in buffers.items():
+        blocks[key], arrays[key] = _attach(name, shape, dtype)
+    obs, actions, rewards, dones = arrays["obs"], arrays["actions"], arrays["rewards"], arrays["dones"]
+
+    env = None
+    try:
+        from main import RemoteValveControlEnv
+        from scenarios import demand_patterns, perturb_demands, private_network_dir
+        # The caller acts as the controller: no controller calls, images or result files
+        env = RemoteValveControlEnv(config_path, private_network_dir(config_path, network_dir),
+                                    'http://localhost:5000/control', log_dir, f"env_{index:03d}")
+        randomize = (noise > 0 or scale_range > 0) and env.surrogate is None
+        if randomize:
+            base_patterns = demand_patterns(env.epanet_api)
+            base_multiplier = float(env.epanet_api.getOptionsPatternDemandMultiplier())
+        episode = 0
+
+        def reset():
+            nonlocal episode
+            if randomize:
+                rng = np.random.default_rng([seed, index, episode])
+                patterns, demand_multiplier = perturb_demands(rng, base_patterns, noise, scale_range)
+                for pattern_index, values in patterns.items():
+                    env.epanet_api.setPattern(pattern_index, values.tolist())
+                env.epanet_api.setOptionsPatternDemandMultiplier(base_multiplier * demand_multiplier)
+            episode += 1
+            obs[index] = env.reset()
+
+        conn.send(("ready", None))
+        while True:
+            command = conn.recv()
+            if command == "reset":
+                reset()
+                dones[index] = False
+                rewards[index] = 0.0
+            elif command == "step":
+                observation, reward, done, _ = env.step(actions[index])
+                rewards[index] = reward
+                dones[index] = done
+                if done:
+                    reset()
+                else:
+                    obs[index] = observation
+            elif command == "close":
+                break
+            conn.send(("ok", None))
+    except Exception as e:
+        conn.send(("error", f"{type(e).__name__}: {e}"))
+    finally:
+        if env is not None:
+            env.close()
+        for shm in blocks.values():
+            shm.close()
+        conn.close()
+
+
+class VectorEnv:
+    """N environments in subprocess workers over shared-memory arrays"""
+
+    def __init__(self, config_path, network_dir, num_envs=None, log_dir=None, seed=0,
+                 demand_noise=0.0, demand_scale_range=0.0):
+        """
+        Args:
+            config_path: Experiment config (JSON)
+            network_dir: Directory containing the INP file
+            num_envs: Number of environments (default: number of CPUs)
+            log_dir: Directory for the worker logs (default: a temporary directory)
+            seed: Seed of the demand perturbations
+            demand_noise: Lognormal pattern noise per episode (0 = base demands)
+            demand_scale_range: Half width of the demand multiplier range per episode
+        """
+        self.num_envs = num_envs or os.cpu_count() or 1
+        if log_dir is None:
+            log_dir = tempfile.mkdtemp(prefix="vector_env_")
+        os.makedirs(log_dir, exist_ok=True)
+        self.log_dir = log_dir
+
+        # Observation shape is taken from the config without loading the network
+        with open(config_path, 'r') as f:
+            num_loops = len(json.load(f).get('control_loops', []))
+        from main import RemoteValveControlEnv
+        self.obs_fields = RemoteValveControlEnv.OBS_FIELDS
+        self.num_loops = num_loops
+
+        shapes = {
+            "obs": ((self.num_envs, num_loops, len(self.obs_fields)), np.float64),
+            "actions": ((self.num_envs, num_loops), np.float64),
+            "rewards": ((self.num_envs,), np.float64),
+            "dones": ((self.num_envs,), np.bool_),
+        }
+        self._blocks = {}
+        arrays = {}
+        for key, (shape, dtype) in shapes.items():
+            self._blocks[key], arrays[key] = _shared_array(shape, dtype)
+        self.obs = arrays["obs"]
+        self.actions = arrays["actions"]
+        self.rewards = arrays["rewards"]
+        self.dones = arrays["dones"]
+        buffers = {key: (self._blocks[key].name, shape, dtype) for key, (shape, dtype) in shapes.items()}
+
+        # spawn: a forked epyt/toolkit state must not be shared with the workers
+        ctx = mp.get_context('spawn')
+        self._conns = []
+        self._procs = []
+        for i in range(self.num_envs):
+            parent, child = ctx.Pipe()
+            proc = ctx.Process(
+                target=_worker_main,
+                args=(i, child, config_path, network_dir, log_dir, buffers, seed,
+                      demand_noise, demand_scale_range),
+                daemon=True
+            )
+            proc.start()
+            child.close()
+            self._conns.append(parent)
+            self._procs.append(proc)
+        self._closed = False
+        self._collect()
+        print(f"VectorEnv: {self.num_envs} environments, {num_loops} loops, "
+              f"obs {tuple(self.obs.shape)} (logs: {log_dir})")
+
+    def _collect(self):
+        """Wait for every worker's reply; raise if one failed"""
+        errors = []
+        for i, conn in enumerate(self._conns):
+            status, message = conn.recv()
+            if status == "error":
+                errors.append(f"env {i}: {message}")
+        if errors:
+            self.close()
+            raise RuntimeError(f"VectorEnv worker failed ({'; '.join(errors)}); see {self.log_dir}")
+
+    def _broadcast(self, command):
+        for conn in self._conns:
+            conn.send(command)
+        self._collect()
+
+    def reset(self):
+        """
+        Returns:
+            np.ndarray: Observations, shape (N, loops, obs fields) (shared; copy to keep)
+        """
+        self._broadcast("reset")
+        return self.obs
+
+    def step(self, actions):
+        """
+        Args:
+            actions: Valve settings, shape (N, loops)
+
+        Returns:
+            (obs, rewards, dones): Shared arrays, valid until the next step()
+        """
+        self.actions[...] = actions
+        self._broadcast("step")
+        return self.obs, self.rewards, self.dones
+
+    def close(self):
+        """Stop the workers and free the shared memory"""
+        if self._closed:
+            return
+        self._closed = True
+        for conn in self._conns:
+            try:
+                conn.send("close")
+            except (BrokenPipeError, OSError):
+                pass
+        for proc in self._procs:
+            proc.join(timeout=10)
+            if proc.is_alive():
+                proc.terminate()
+        for conn in self._conns:
+            conn.close()
+        del self.obs, self.actions, self.rewards, self.dones
+        for shm in self._blocks.values():
+            shm.close()
+            shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if __name__ == "__main__":
+    # Throughput check: random valve settings within the actuator limits
+    num_envs = int(os.environ.get('VECTOR_ENVS', '0')) or None
+    steps = int(os.environ.get('VECTOR_BENCH_STEPS', '1000'))
+    with VectorEnv(
+        os.environ.get('CONFIG_PATH', '/shared/configs/exp_001.json'),
+        os.environ.get('NETWORK_DIR', '/shared/networks'),
+        num_envs=num_envs,
+        seed=int(os.environ.get('SCENARIO_SEED', '0')),
+        demand_noise=float(os.environ.get('DEMAND_NOISE', '0.0')),
+        demand_scale_range=float(os.environ.get('DEMAND_SCALE_RANGE', '0.0'))
+    ) as envs:
+        rng = np.random.default_rng(0)
+        obs = envs.reset()
+        valve = obs[:, :, envs.obs_fields.index("valve")].copy()
+        episodes = 0
+        start = time.perf_counter()
+        for _ in range(steps):
+            valve = valve * (1.0 + rng.normal(0.0, 0.05, size=valve.shape))
+            obs, rewards, dones = envs.step(valve)
+            episodes += int(np.count_nonzero(dones))
+        elapsed = time.perf_counter() - start
+        env_steps = steps * envs.num_envs
+        print(f"{env_steps} env steps in {elapsed:.2f}s: {env_steps / elapsed:.0f} env steps/s "
+              f"({episodes} episodes finished)")
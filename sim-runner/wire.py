@@ -0,0 +1,204 @@
+"""
+Wire encoding between sim-runner and the controller services
+
+Kept in sim-runner/ only. The controller images (controller-pid/,
+controller-mpc/, controller-vla/) copy it at build time through the
+"wire" additional build context in docker-compose.yml.
+
+Formats:
+    json     - the original encoding (always available)
+    msgpack  - binary; lists of dicts (sensor_data, actions) are sent
+               column-wise, with numeric columns as raw little-endian
+               float64/int64 buffers and constant columns as one value,
+               so keys are not repeated per loop and numbers are not
+               formatted as text
+
+The format is negotiated in the init handshake: sim-runner offers
+"wire_formats" in its init request, the controller answers with the
+"wire_format" it picked. Controllers without msgpack (or older ones that
+ignore the offer) answer in JSON, and sim-runner keeps using JSON.
+Responses always use the format of the request.
+
+Decoding restores exactly the JSON structure (same keys, int/float/None
+types, bit-identical floats), so the controller banks are unchanged.
+"""
+import json
+import time
+
+import numpy as np
+
+try:
+    import msgpack
+    MSGPACK_AVAILABLE = True
+except ImportError:
+    MSGPACK_AVAILABLE = False
+
+
+JSON = 'json'
+MSGPACK = 'msgpack'
+
+CONTENT_TYPES = {
+    JSON: 'application/json',
+    MSGPACK: 'application/x-msgpack',
+}
+
+# Marker of a column-wise packed list of dicts
+_RECORDS = '__records__'
+
+
+def supported_formats():
+    """Formats this process can decode, in order of preference"""
+    return [MSGPACK, JSON] if MSGPACK_AVAILABLE else [JSON]
+
+
+def negotiate(offered):
+    """Pick the first offered format this process supports (JSON if none)"""
+    supported = supported_formats()
+    for fmt in offered or []:
+        if fmt in supported:
+            return fmt
+    return JSON
+
+
+def format_of(content_type):
+    """Wire format of an HTTP Content-Type header"""
+    if content_type and content_type.split(';')[0].strip() == CONTENT_TYPES[MSGPACK]:
+        return MSGPACK
+    return JSON
+
+
+def _pack_column(values):
+    # Typed buffers only where the JSON types are uniform, so decoding is exact
+    types = {type(v) for v in values}
+    if types == {float}:
+        array = np.asarray(values, dtype='<f8')
+        bits = array.view('<i8')
+        if (bits == bits[0]).all():  # bitwise, so -0.0 and NaN payloads survive
+            return {"const": values[0]}
+        return {"f8": array.tobytes()}
+    if len(types) == 1 and not types & {dict, list} and all(v == values[0] for v in values):
+        return {"const": values[0]}
+    if types == {int}:
+        try:
+            return {"i8": np.asarray(values, dtype='<i8').tobytes()}
+        except OverflowError:
+            return {"list": values}
+    if types == {dict}:
+        packed = _pack_records(values)
+        if packed is not None:
+            return {"records": packed}
+    return {"list": values}
+
+
+def _pack_records(records):
+    """Column-wise form of a list of dicts with identical keys (None otherwise)"""
+    keys = list(records[0].keys())
+    if any(list(r.keys()) != keys for r in records):
+        return None
+    return {
+        "n": len(records),
+        "keys": keys,
+        "columns": [_pack_column([r[k] for r in records]) for k in keys],
+    }
+
+
+def _unpack_column(column, n):
+    if "const" in column:
+        return [column["const"]] * n
+    if "f8" in column:
+        return np.frombuffer(column["f8"], dtype='<f8').tolist()
+    if "i8" in column:
+        return np.frombuffer(column["i8"], dtype='<i8').tolist()
+    if "records" in column:
+        return _unpack_records(column["records"])
+    return column["list"]
+
+
+def _unpack_records(packed):
+    columns = [_unpack_column(c, packed["n"]) for c in packed["columns"]]
+    keys = packed["keys"]
+    if not keys:
+        return [{} for _ in range(packed["n"])]
+    return [dict(zip(keys, values)) for values in zip(*columns)]
+
+
+def _pack(obj):
+    if isinstance(obj, dict):
+        return {k: _pack(v) for k, v in obj.items()}
+    if isinstance(obj, list) and len(obj) > 1 and all(isinstance(v, dict) for v in obj):
+        packed = _pack_records(obj)
+        if packed is not None:
+            return {_RECORDS: packed}
+    return obj
+
+
+def _unpack(obj):
+    if isinstance(obj, dict):
+        if _RECORDS in obj and len(obj) == 1:
+            return _unpack_records(obj[_RECORDS])
+        return {k: _unpack(v) for k, v in obj.items()}
+    return obj
+
+
+def encode(obj, fmt):
+    """Serialize a request/response dict"""
+    if fmt == MSGPACK:
+        return msgpack.packb(_pack(obj), use_bin_type=True)
+    return json.dumps(obj).encode('utf-8')
+
+
+def decode(body, fmt):
+    """Deserialize a request/response body"""
+    if fmt == MSGPACK:
+        return _unpack(msgpack.unpackb(body, raw=False, strict_map_key=False))
+    return json.loads(body)
+
+
+def benchmark(num_loops=500, repeat=200):
+    """
+    Encode+decode cost and size of one batch step request and response
+
+    Returns:
+        list of dicts: one row per format
+    """
+    request = {
+        "exp_id": "bench",
+        "step": 10,
+        "time_step": 36000,
+        "sensor_data": [
+            {"loop_id": f"loop_{i}", "pressure": 30.0 + i * 0.123456789, "target": 30.0,
+             "prev_action": 0.5 + i * 1e-4, "step": 10, "time_step": 36000}
+            for i in range(num_loops)
+        ]
+    }
+    response = {
+        "actions": [
+            {"loop_id": f"loop_{i}", "action": 0.5 + i * 1e-4, "p_term": 0.1, "i_term": 0.2, "d_term": -0.0,
+             "error": 1.5, "control_mode": "pressure", "current_value": 28.5, "target_value": 30.0}
+            for i in range(num_loops)
+        ]
+    }
+    rows = []
+    for fmt in supported_formats():
+        start = time.perf_counter()
+        for _ in range(repeat):
+            request_body = encode(request, fmt)
+            decode(request_body, fmt)
+            response_body = encode(response, fmt)
+            decode(response_body, fmt)
+        elapsed = (time.perf_counter() - start) / repeat
+        rows.append({
+            "format": fmt,
+            "loops": num_loops,
+            "request_bytes": len(request_body),
+            "response_bytes": len(response_body),
+            "roundtrip_codec_ms": elapsed * 1000.0,
+        })
+    return rows
+
+
+if __name__ == '__main__':
+    for n in (10, 100, 1000):
+        for row in benchmark(n):
+            print(f"{row['format']:>8} loops={row['loops']:>5} request={row['request_bytes']:>8}B "
+                  f"response={row['response_bytes']:>8}B codec={row['roundtrip_codec_ms']:.3f}ms")